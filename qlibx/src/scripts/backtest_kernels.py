@@ -0,0 +1,223 @@
+"""
+回测路径依赖规则的编译内核
+100 股整手、跨调仓的现金结转、上次买入的日期/价格间隔等规则无法向量化，只能逐日推进状态。
+这里把逐日状态机写成只操作 NumPy 数组的函数：
+- 安装了 numba 时用 njit 编译
+- 否则按普通 Python 函数运行（结果相同，只是较慢）
+运算顺序与参考实现（qlib_backtest_simple.simulate_portfolio、qlib_backtest_intraday.simulate_symbol）
+逐步一致，浮点结果完全相同
+"""
+
+import numpy as np
+
+try:
+    from numba import njit
+    HAS_NUMBA = True
+except ImportError:
+    HAS_NUMBA = False
+
+    def njit(*args, **kwargs):
+        if len(args) == 1 and callable(args[0]) and not kwargs:
+            return args[0]
+        return lambda func: func
+
+
+# ---------------------------------------------------------------------------
+# 等权 TOP_K 调仓（对应 simulate_portfolio）
+# ---------------------------------------------------------------------------
+
+@njit(cache=True)
+def portfolio_kernel(prices, present, selected, rebalance_freq, cash, day_index, held_idx, held_shares, n_held):
+    """
+    Args:
+        prices: (n_dates, n_inst) 收盘价
+        present: (n_dates, n_inst) 该 (交易日, 股票) 是否有数据行
+        selected: (n_dates, k) 当日选股的股票下标，-1 表示空位；只在调仓日使用
+        rebalance_freq: 调仓间隔
+        cash: 初始现金
+        day_index: 第一天的全局交易日序号
+        held_idx, held_shares: 持仓（按建仓顺序），长度 >= n_inst，原地更新
+        n_held: 当前持仓数
+    Returns:
+        (每日组合市值, 现金, 持仓数)
+    """
+    n_dates = prices.shape[0]
+    values = np.empty(n_dates)
+    for t in range(n_dates):
+        i = day_index + t
+
+        holding_value = 0.0
+        for h in range(n_held):
+            j = held_idx[h]
+            if present[t, j]:
+                holding_value += held_shares[h] * prices[t, j]
+        values[t] = cash + holding_value
+
+        if i % rebalance_freq == 0 or i == 0:
+            for h in range(n_held):
+                j = held_idx[h]
+                if present[t, j]:
+                    cash += held_shares[h] * prices[t, j]
+            n_held = 0
+
+            n_selected = 0
+            for s in range(selected.shape[1]):
+                if selected[t, s] >= 0:
+                    n_selected += 1
+            position_size = cash / n_selected if n_selected > 0 else 0.0
+
+            for s in range(selected.shape[1]):
+                j = selected[t, s]
+                if j < 0 or not present[t, j]:
+                    continue
+                buy_price = prices[t, j]
+                if buy_price > 0:
+                    lots = position_size / buy_price / 100
+                    if lots != lots:
+                        # 参考实现中 int(nan) 抛出异常，当日剩余的买入被跳过
+                        break
+                    shares = int(lots) * 100
+                    if shares > 0:
+                        held_idx[n_held] = j
+                        held_shares[n_held] = shares
+                        n_held += 1
+                        cash -= shares * buy_price
+    return values, cash, n_held
+
+
+def simulate_portfolio_fast(momentum_data, price_data, trade_dates, state, top_k, rebalance_freq, selections=None):
+    """simulate_portfolio 的内核版本，参数和返回值相同（不支持 verbose）"""
+    import pandas as pd
+
+    trade_dates = pd.DatetimeIndex(trade_dates)
+    n_dates = len(trade_dates)
+
+    # 调仓日的选股（未给出 selections 时与参考实现相同，按 score 降序取前 top_k）
+    picks = {}
+    for t, date in enumerate(trade_dates):
+        i = state["day_index"] + t
+        if not (i % rebalance_freq == 0 or i == 0):
+            continue
+        if selections is not None:
+            picks[t] = list(selections.get(date, []))
+            continue
+        try:
+            day_scores = momentum_data.xs(date, level='datetime').dropna()
+        except KeyError:
+            continue
+        picks[t] = day_scores.sort_values('score', ascending=False).head(top_k).index.tolist()
+
+    close = price_data['close'].unstack(level='instrument')
+    # 区分“没有数据行”和“有数据行但值为 NaN”，两者在参考实现中的处理不同
+    present = pd.Series(True, index=price_data.index).unstack(level='instrument')
+    held = list(state["holdings"].items())
+    instruments = list(dict.fromkeys(
+        list(close.columns) + [s for s, _ in held] + [s for stocks in picks.values() for s in stocks]))
+    position = {s: j for j, s in enumerate(instruments)}
+
+    prices = close.reindex(index=trade_dates, columns=instruments).to_numpy(dtype=np.float64)
+    present = present.reindex(index=trade_dates, columns=instruments).notna().to_numpy(dtype=np.bool_)
+
+    width = max([1] + [len(stocks) for stocks in picks.values()])
+    selected = np.full((n_dates, width), -1, dtype=np.int64)
+    for t, stocks in picks.items():
+        for s, stock in enumerate(stocks):
+            selected[t, s] = position[stock]
+
+    held_idx = np.zeros(max(len(instruments), len(held), 1), dtype=np.int64)
+    held_shares = np.zeros(len(held_idx), dtype=np.int64)
+    for h, (stock, shares) in enumerate(held):
+        held_idx[h] = position[stock]
+        held_shares[h] = shares
+
+    values, cash, n_held = portfolio_kernel(prices, present, selected, int(rebalance_freq), float(state["cash"]),
+                                            int(state["day_index"]), held_idx, held_shares, len(held))
+    state["cash"] = float(cash)
+    state["holdings"] = {instruments[held_idx[h]]: int(held_shares[h]) for h in range(n_held)}
+    state["day_index"] += n_dates
+    return list(trade_dates), [float(v) for v in values]
+
+
+# ---------------------------------------------------------------------------
+# 交易程序的买卖规则（对应 simulate_symbol）
+# ---------------------------------------------------------------------------
+
+@njit(cache=True)
+def symbol_kernel(days, price, post_low, post_high, close, buy_point, sell_point, buy_total,
+                  buy_limit_price, sell_limit_price, day_interval, price_interval, max_position, cash):
+    """
+    Args:
+        days: 交易日的日序号（自 1970-01-01 起的天数）
+        price, post_low, post_high, close: 每日决策数据
+        其余为策略参数和初始资金
+    Returns:
+        (每日市值, 成交方向 0=无/1=买/2=卖, 成交数量, 成交价)
+    """
+    n = len(days)
+    values = np.empty(n)
+    actions = np.zeros(n, dtype=np.int64)
+    quantities = np.zeros(n, dtype=np.int64)
+    fill_prices = np.zeros(n)
+    position = 0
+    has_last_buy = False
+    last_buy_day = 0
+    last_buy_price = 0.0
+
+    for t in range(n):
+        p = price[t]
+        if p > 0:
+            quantity = int(buy_total / p)
+            if p <= buy_point:
+                allowed = quantity > 0
+                if allowed and day_interval > 0 and has_last_buy:
+                    allowed = days[t] - last_buy_day >= day_interval
+                if allowed and has_last_buy and last_buy_price != 0 and price_interval > 0:
+                    allowed = abs((p - last_buy_price) / last_buy_price * 100) >= price_interval
+                limit = buy_limit_price if buy_limit_price > 0 else p + -1
+                if allowed:
+                    equity = cash + position * p
+                    if max_position < 100 and (position + quantity) * limit > equity * max_position / 100:
+                        allowed = False
+                if allowed and quantity * limit <= cash and post_low[t] <= limit:
+                    cash -= quantity * limit
+                    position += quantity
+                    has_last_buy = True
+                    last_buy_day = days[t]
+                    last_buy_price = limit
+                    actions[t] = 1
+                    quantities[t] = quantity
+                    fill_prices[t] = limit
+            elif p >= sell_point and 0 < quantity <= position:
+                limit = sell_limit_price if sell_limit_price > 0 else p + 1
+                if post_high[t] >= limit:
+                    cash += quantity * limit
+                    position -= quantity
+                    actions[t] = 2
+                    quantities[t] = quantity
+                    fill_prices[t] = limit
+        values[t] = cash + position * close[t]
+    return values, actions, quantities, fill_prices
+
+
+def simulate_symbol_fast(decisions, strategy, init_cash):
+    """simulate_symbol 的内核版本，参数和返回值相同"""
+    import pandas as pd
+
+    days = decisions.index.values.astype('datetime64[D]').astype(np.int64)
+    values, actions, quantities, fill_prices = symbol_kernel(
+        days,
+        decisions['decision_price'].to_numpy(dtype=np.float64),
+        decisions['post_low'].to_numpy(dtype=np.float64),
+        decisions['post_high'].to_numpy(dtype=np.float64),
+        decisions['close'].to_numpy(dtype=np.float64),
+        float(strategy['buy_point']), float(strategy['sell_point']), float(strategy['buy_total']),
+        float(strategy.get('buy_limit_price', 0)), float(strategy.get('sell_limit_price', 0)),
+        int(strategy.get('buy_day_interval', 0)), float(strategy.get('buy_price_interval', 0)),
+        float(strategy.get('max_position', 100)), float(init_cash),
+    )
+    trades = [
+        {"date": decisions.index[t], "action": "buy" if actions[t] == 1 else "sell",
+         "quantity": int(quantities[t]), "price": float(fill_prices[t])}
+        for t in np.flatnonzero(actions)
+    ]
+    return trades, pd.Series(values, index=decisions.index, name='portfolio_value')
@@ -0,0 +1,315 @@
+"""
+回测任务服务
+供后端调用的回测任务队列：
+- 回测在进程池中运行，并发数受限，不阻塞调用方（如 FastAPI 的事件循环）
+- 工作进程按段回测（见 qlib_backtest_walkforward.py），每段完成后通过队列回报进度
+- 结果按 参数 + 数据版本 的哈希缓存到磁盘，重复请求直接返回；相同参数的任务在运行中时复用同一个任务
+"""
+
+import hashlib
+import json
+import logging
+import math
+import multiprocessing as mp
+import os
+import queue
+import threading
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".backtest_cache")
+
+# 与 qlib_backtest_simple.run_backtest 相同的默认参数
+DEFAULT_PARAMS = {
+    "instruments": [
+        "SH600000", "SH600036", "SH601318", "SH600519",
+        "SH600030", "SH601166", "SH601288", "SH600887",
+        "SH601398", "SH601939", "SH600016", "SH601328"
+    ],
+    "start_time": "2024-01-01",
+    "end_time": "2024-01-31",
+    "init_cash": 1000000,
+    "top_k": 3,
+    "rebalance_freq": 5,
+    "chunk_days": 120,
+}
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+
+def _finite(value):
+    """NaN / inf -> None：标准 JSON 不支持非有限浮点数，FastAPI 序列化时会报错"""
+    value = float(value)
+    return value if math.isfinite(value) else None
+
+
+def normalize_params(params):
+    """补全默认值并校验参数，未知参数抛出 ValueError"""
+    params = dict(params or {})
+    unknown = set(params) - set(DEFAULT_PARAMS)
+    if unknown:
+        raise ValueError(f"未知参数: {', '.join(sorted(unknown))}")
+    merged = {key: params.get(key) if params.get(key) is not None else default
+              for key, default in DEFAULT_PARAMS.items()}
+    merged["instruments"] = sorted(str(code).upper() for code in merged["instruments"])
+    merged["init_cash"] = float(merged["init_cash"])
+    for key in ("top_k", "rebalance_freq", "chunk_days"):
+        merged[key] = int(merged[key])
+        if merged[key] <= 0:
+            raise ValueError(f"{key} 必须为正数")
+    if not merged["instruments"]:
+        raise ValueError("股票池为空")
+    if merged["start_time"] > merged["end_time"]:
+        raise ValueError("start_time 晚于 end_time")
+    return merged
+
+
+def data_version(provider_uri):
+    """qlib 数据目录的版本：交易日历和股票列表文件的大小与修改时间"""
+    parts = []
+    for rel in ("calendars/day.txt", "instruments/all.txt"):
+        path = os.path.join(provider_uri, rel)
+        if os.path.exists(path):
+            st = os.stat(path)
+            parts.append(f"{rel}:{st.st_size}:{st.st_mtime_ns}")
+    return "|".join(parts)
+
+
+def cache_key(params, version):
+    raw = json.dumps({"params": params, "data_version": version}, sort_keys=True)
+    return hashlib.sha1(raw.encode('utf-8')).hexdigest()
+
+
+# ---------------------------------------------------------------------------
+# 工作进程
+# ---------------------------------------------------------------------------
+
+_progress_queue = None
+_provider_uri = None
+_qlib_ready = False
+
+
+def _init_worker(progress_queue, provider_uri):
+    global _progress_queue, _provider_uri
+    _progress_queue = progress_queue
+    _provider_uri = provider_uri
+
+
+def _run_job(job_id, params):
+    """工作进程入口：回测并返回可 JSON 序列化的结果"""
+    global _qlib_ready
+    import qlib
+    from qlib.config import REG_CN
+    from qlib_backtest_simple import compute_metrics
+    from qlib_backtest_walkforward import run_walkforward
+
+    if not _qlib_ready:
+        qlib.init(provider_uri=_provider_uri, region=REG_CN)
+        _qlib_ready = True
+    _progress_queue.put((job_id, RUNNING, 0, 0, None, None))
+
+    def report(done, total, chunk_end, value):
+        _progress_queue.put((job_id, RUNNING, done, total, chunk_end.strftime('%Y-%m-%d'), _finite(value)))
+
+    result_df, _ = run_walkforward(
+        instruments=params["instruments"], start_time=params["start_time"], end_time=params["end_time"],
+        init_cash=params["init_cash"], top_k=params["top_k"], rebalance_freq=params["rebalance_freq"],
+        chunk_days=params["chunk_days"], verbose=False, progress=report,
+    )
+    metrics = {key: (bool(value) if key == "sufficient" else _finite(value))
+               for key, value in compute_metrics(result_df, params["init_cash"]).items()}
+    return {
+        "params": params,
+        "dates": [d.strftime('%Y-%m-%d') for d in result_df.index],
+        # 参考实现在现金为 NaN 时净值也为 NaN，内核保留了这一行为
+        "portfolio_value": [_finite(v) for v in result_df['portfolio_value']],
+        "metrics": metrics,
+    }
+
+
+# ---------------------------------------------------------------------------
+# 任务管理
+# ---------------------------------------------------------------------------
+
+class BacktestJob:
+    def __init__(self, job_id, key, params):
+        self.job_id = job_id
+        self.key = key
+        self.params = params
+        self.status = QUEUED
+        self.cached = False
+        self.progress = {"done": 0, "total": 0, "date": None, "portfolio_value": None}
+        self.result = None
+        self.error = None
+        self.created_at = time.time()
+        self.finished_at = None
+        self.revision = 0   # 状态或进度每变化一次加一，供进度推送判断是否有更新
+
+    def to_dict(self, include_result=False):
+        data = {
+            "job_id": self.job_id,
+            "status": self.status,
+            "cached": self.cached,
+            "params": self.params,
+            "progress": dict(self.progress),
+            "error": self.error,
+            "created_at": self.created_at,
+            "finished_at": self.finished_at,
+        }
+        if include_result:
+            data["result"] = self.result
+        return data
+
+
+class BacktestService:
+    """
+    回测任务队列
+    Args:
+        provider_uri: qlib 数据目录
+        max_workers: 同时运行的回测数
+        max_pending: 排队 + 运行中的任务上限，超过时 submit 抛出 RuntimeError
+        cache_dir: 结果缓存目录
+        max_jobs: 内存中保留的任务记录数
+    """
+
+    def __init__(self, provider_uri, max_workers=2, max_pending=16, cache_dir=CACHE_DIR, max_jobs=200):
+        self.provider_uri = provider_uri
+        self.max_pending = max_pending
+        self.cache_dir = cache_dir
+        self.max_jobs = max_jobs
+        self._jobs = {}
+        self._active = {}   # cache key -> 运行中的任务，相同参数复用
+        self._lock = threading.Lock()
+
+        # spawn 避免把后端的事件循环和线程状态 fork 到工作进程
+        ctx = mp.get_context("spawn")
+        self._progress = ctx.Queue()
+        self._pool = ProcessPoolExecutor(max_workers=max_workers, mp_context=ctx,
+                                         initializer=_init_worker, initargs=(self._progress, provider_uri))
+        self._stop = threading.Event()
+        self._listener = threading.Thread(target=self._drain_progress, name="backtest-progress", daemon=True)
+        self._listener.start()
+
+    # -- 结果缓存 --
+
+    def _cache_path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.json")
+
+    def _load_cached(self, key):
+        path = self._cache_path(key)
+        if not os.path.exists(path):
+            return None
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                result = json.load(f)
+            # 早期版本写入的缓存可能含 NaN
+            result["portfolio_value"] = [None if v is None else _finite(v) for v in result["portfolio_value"]]
+            result["metrics"] = {key: value if value is None or isinstance(value, bool) else _finite(value)
+                                 for key, value in result["metrics"].items()}
+            return result
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            logger.warning("回测缓存 %s 无法读取: %s", path, e)
+            return None
+
+    def _store_cached(self, key, result):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        path = self._cache_path(key)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(result, f)
+        os.replace(tmp_path, path)
+
+    # -- 任务 --
+
+    def submit(self, params):
+        """
+        提交回测
+        Returns:
+            BacktestJob；命中缓存时任务已是 done 状态
+        """
+        params = normalize_params(params)
+        key = cache_key(params, data_version(self.provider_uri))
+        with self._lock:
+            active = self._active.get(key)
+            if active is not None:
+                return active
+
+            job = BacktestJob(uuid.uuid4().hex[:12], key, params)
+            cached = self._load_cached(key)
+            if cached is not None:
+                job.status, job.cached, job.result = DONE, True, cached
+                job.finished_at = time.time()
+                self._remember(job)
+                return job
+
+            if len(self._active) >= self.max_pending:
+                raise RuntimeError("回测任务过多，请稍后再试")
+            self._active[key] = job
+            self._remember(job)
+
+        future = self._pool.submit(_run_job, job.job_id, params)
+        future.add_done_callback(lambda f, job=job: self._finish(job, f))
+        return job
+
+    def _remember(self, job):
+        self._jobs[job.job_id] = job
+        if len(self._jobs) > self.max_jobs:
+            # 丢弃最早的已结束任务
+            for job_id, old in list(self._jobs.items()):
+                if old.status in (DONE, FAILED):
+                    del self._jobs[job_id]
+                    if len(self._jobs) <= self.max_jobs:
+                        break
+
+    def _finish(self, job, future):
+        try:
+            result = future.result()
+        except Exception as e:
+            logger.error("回测任务 %s 失败: %s", job.job_id, e)
+            status, result, error = FAILED, None, str(e)
+        else:
+            status, error = DONE, None
+            try:
+                self._store_cached(job.key, result)
+            except OSError as e:
+                logger.warning("回测结果缓存写入失败: %s", e)
+        with self._lock:
+            job.status, job.result, job.error = status, result, error
+            job.finished_at = time.time()
+            job.revision += 1
+            self._active.pop(job.key, None)
+
+    def _drain_progress(self):
+        while not self._stop.is_set():
+            try:
+                job_id, status, done, total, date, value = self._progress.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            except (EOFError, OSError):
+                break
+            with self._lock:
+                job = self._jobs.get(job_id)
+                if job is None or job.status in (DONE, FAILED):
+                    continue
+                job.status = status
+                if total:
+                    job.progress = {"done": done, "total": total, "date": date, "portfolio_value": value}
+                job.revision += 1
+
+    def get(self, job_id):
+        return self._jobs.get(job_id)
+
+    def list_jobs(self):
+        with self._lock:
+            return [job.to_dict() for job in sorted(self._jobs.values(), key=lambda j: j.created_at, reverse=True)]
+
+    def shutdown(self):
+        self._stop.set()
+        self._pool.shutdown(wait=False, cancel_futures=True)
+        self._listener.join(timeout=2)
@@ -0,0 +1,104 @@
+"""
+交易程序日志配置
+- 同步模式：与原先一致，直接写文件和终端
+- 队列模式：热路径只把 LogRecord 放入内存队列，由后台线程格式化并写出
+- 支持按大小或按时间轮转，轮转后的文件自动 gzip 压缩
+"""
+
+import atexit
+import gzip
+import logging
+import logging.handlers
+import os
+import queue
+import shutil
+
+LOG_FORMAT = '%(asctime)s [%(levelname)s] %(message)s'
+
+
+class _DeferredQueueHandler(logging.handlers.QueueHandler):
+    """
+    QueueHandler 默认会在调用线程里执行 format()，
+    这里改为原样入队，格式化（包括 %-参数拼接和时间戳）全部交给后台线程。
+    注意：日志参数应为不可变值，入队后再修改会反映到最终输出中。
+    """
+
+    def prepare(self, record):
+        return record
+
+
+def _gzip_namer(name):
+    return name + ".gz"
+
+
+def _gzip_rotator(source, dest):
+    with open(source, 'rb') as f_in, gzip.open(dest, 'wb') as f_out:
+        shutil.copyfileobj(f_in, f_out)
+    os.remove(source)
+
+
+def _build_file_handler(log_file, rotate, max_bytes, backup_count, when, compress):
+    if rotate == "size":
+        handler = logging.handlers.RotatingFileHandler(
+            log_file, maxBytes=max_bytes, backupCount=backup_count, encoding='utf-8')
+    elif rotate == "time":
+        handler = logging.handlers.TimedRotatingFileHandler(
+            log_file, when=when, backupCount=backup_count, encoding='utf-8')
+    else:
+        return logging.FileHandler(log_file, encoding='utf-8')
+
+    if compress:
+        handler.namer = _gzip_namer
+        handler.rotator = _gzip_rotator
+    return handler
+
+
+def setup_logging(log_file='trading.log', level=logging.INFO, queued=True, rotate="size",
+                  max_bytes=50 * 1024 * 1024, backup_count=10, when="midnight", compress=True):
+    """
+    配置根日志
+    Args:
+        log_file: 日志文件路径
+        level: 日志级别
+        queued: True 时使用队列 + 后台写线程，False 时同步写出
+        rotate: "size" 按大小轮转，"time" 按时间轮转，None 不轮转
+        max_bytes: 按大小轮转时单个文件上限
+        backup_count: 保留的历史文件个数
+        when: 按时间轮转时的周期，同 TimedRotatingFileHandler
+        compress: 轮转后的历史文件是否 gzip 压缩
+    Returns:
+        队列模式下返回 QueueListener（已启动，退出时自动 stop），否则返回 None
+    """
+    formatter = logging.Formatter(LOG_FORMAT)
+    handlers = [
+        _build_file_handler(log_file, rotate, max_bytes, backup_count, when, compress),
+        logging.StreamHandler()
+    ]
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.setLevel(level)
+
+    if not queued:
+        for handler in handlers:
+            root.addHandler(handler)
+        return None
+
+    log_queue = queue.SimpleQueue()
+    root.addHandler(_DeferredQueueHandler(log_queue))
+    listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    # 退出前把队列中剩余的记录写完
+    atexit.register(_stop_listener, listener)
+    return listener
+
+
+def _stop_listener(listener):
+    # 调用方可能已经提前手动 stop()，再次 stop 时（不同 Python 版本）会抛出异常，忽略即可
+    try:
+        listener.stop()
+    except (AttributeError, RuntimeError):
+        pass
@@ -0,0 +1,316 @@
+"""
+因子评估
+对 (因子 × 交易日 × 股票) 的因子块和未来收益，一次性计算所有因子的：
+- 每日 IC（Pearson）和 Rank IC（横截面秩相关），以及均值、ICIR、正值比例
+- IC 衰减：不同持有期的 Rank IC 均值
+- 换手：头部分位组合的成员变化比例，以及因子秩的日间自相关
+- 分位组合收益：按因子值分成 n 组的等权未来收益，及多空收益
+全部计算是沿股票维度的数组运算（包括带并列均值的排名），不逐日循环；因子按块拆分，可在多个进程中并行
+用法: python factor_eval.py --market csi300 --start 2020-01-01 --end 2024-12-31 --jobs 4
+"""
+
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+PROVIDER_URI = "/Users/Zeyu/Documents/q_trade/qlibx/data/qlib_data/cn_data"
+
+# 入门教程（qlib_tutorial_complete.py）中的因子
+TUTORIAL_FACTORS = {
+    "return_1d": "$close / Ref($close, 1) - 1",
+    "return_5d": "$close / Ref($close, 5) - 1",
+    "return_20d": "$close / Ref($close, 20) - 1",
+    "ma5_ratio": "$close / Mean($close, 5) - 1",
+    "ma20_ratio": "$close / Mean($close, 20) - 1",
+    "volatility_20d": "Std($close / Ref($close, 1) - 1, 20)",
+    "volume_ratio": "$volume / Mean($volume, 20)",
+    "price_volume_corr": "Corr($close, $volume, 10)",
+}
+
+DEFAULT_HORIZONS = (1, 5, 10, 20)
+
+
+# ---------------------------------------------------------------------------
+# 数据整理
+# ---------------------------------------------------------------------------
+
+def to_block(df, dates=None, instruments=None):
+    """
+    把 D.features 的结果转换为因子块
+    Args:
+        df: (instrument, datetime) 索引、每列一个因子的 DataFrame
+        dates, instruments: 对齐到的交易日和股票，默认取 df 中出现的全部
+    Returns:
+        (values, factor_names, dates, instruments)，values 形状 (n_factors, n_dates, n_instruments)
+    """
+    wide = df.unstack(level='instrument')
+    dates = pd.DatetimeIndex(dates if dates is not None else wide.index)
+    instruments = list(instruments if instruments is not None else df.index.get_level_values('instrument').unique())
+    names = list(df.columns)
+    values = np.empty((len(names), len(dates), len(instruments)), dtype=np.float64)
+    for k, name in enumerate(names):
+        values[k] = wide[name].reindex(index=dates, columns=instruments).to_numpy(dtype=np.float64)
+    return values, names, dates, instruments
+
+
+def forward_returns(close, horizons=DEFAULT_HORIZONS):
+    """
+    Args:
+        close: (n_dates, n_instruments) 收盘价
+        horizons: 持有期（交易日）
+    Returns:
+        (n_horizons, n_dates, n_instruments)，第 t 天为 close[t + h] / close[t] - 1，末尾不足 h 天的为 NaN
+    """
+    close = np.asarray(close, dtype=np.float64)
+    out = np.full((len(horizons),) + close.shape, np.nan)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for i, h in enumerate(horizons):
+            if h < close.shape[0]:
+                out[i, :-h] = close[h:] / close[:-h] - 1
+    return out
+
+
+# ---------------------------------------------------------------------------
+# 向量化的横截面运算（最后一维为股票）
+# ---------------------------------------------------------------------------
+
+def rank_last_axis(x):
+    """
+    沿最后一维排名（从 1 开始，并列取平均名次，NaN / inf 视为缺失），对前面所有维度同时计算
+    """
+    x = np.asarray(x, dtype=np.float64)
+    x = np.where(np.isfinite(x), x, np.nan)
+    shape = x.shape
+    flat = x.reshape(-1, shape[-1])
+    n = flat.shape[1]
+
+    order = np.argsort(flat, axis=1, kind='mergesort')   # NaN 排在最后
+    xs = np.take_along_axis(flat, order, axis=1)
+    idx = np.broadcast_to(np.arange(n), xs.shape)
+
+    # 并列组的起止位置：组首为与前一个值不同的位置（NaN 与任何值不同，各自成组）
+    starts_flag = np.ones(xs.shape, dtype=bool)
+    starts_flag[:, 1:] = xs[:, 1:] != xs[:, :-1]
+    ends_flag = np.ones(xs.shape, dtype=bool)
+    ends_flag[:, :-1] = starts_flag[:, 1:]
+    start = np.maximum.accumulate(np.where(starts_flag, idx, 0), axis=1)
+    end = np.minimum.accumulate(np.where(ends_flag, idx, n)[:, ::-1], axis=1)[:, ::-1]
+
+    sorted_rank = (start + end) / 2.0 + 1.0
+    sorted_rank[np.isnan(xs)] = np.nan
+    ranks = np.empty_like(flat)
+    np.put_along_axis(ranks, order, sorted_rank, axis=1)
+    return ranks.reshape(shape)
+
+
+def cross_corr(x, y, min_obs=5):
+    """
+    沿最后一维的 Pearson 相关，只使用两者都有效的位置；有效数不足 min_obs 时为 NaN
+    Args:
+        x, y: 可广播的数组
+    """
+    x, y = np.broadcast_arrays(np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64))
+    valid = np.isfinite(x) & np.isfinite(y)
+    n = valid.sum(axis=-1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        xv = np.where(valid, x, 0.0)
+        yv = np.where(valid, y, 0.0)
+        xd = np.where(valid, xv - (xv.sum(axis=-1) / n)[..., None], 0.0)
+        yd = np.where(valid, yv - (yv.sum(axis=-1) / n)[..., None], 0.0)
+        corr = (xd * yd).sum(axis=-1) / np.sqrt((xd * xd).sum(axis=-1) * (yd * yd).sum(axis=-1))
+    corr[n < min_obs] = np.nan
+    return corr
+
+
+def _joint(x, y):
+    """两者任一缺失的位置都置为 NaN，使排名只在共同有效的股票中进行"""
+    x, y = np.broadcast_arrays(x, y)
+    valid = np.isfinite(x) & np.isfinite(y)
+    return np.where(valid, x, np.nan), np.where(valid, y, np.nan)
+
+
+def quantile_labels(values, quantiles):
+    """
+    按横截面名次分组，0 为因子值最小的一组，NaN 为 -1
+    """
+    ranks = rank_last_axis(values)
+    n = np.isfinite(ranks).sum(axis=-1, keepdims=True)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        labels = np.floor((ranks - 1) / n * quantiles)
+    return np.where(np.isfinite(labels), labels, -1).astype(np.int64)
+
+
+def _series_stats(series):
+    """沿最后一维（交易日）忽略 NaN 的均值、标准差、正值比例"""
+    valid = np.isfinite(series)
+    count = valid.sum(axis=-1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = np.where(valid, series, 0.0).sum(axis=-1) / count
+        var = np.where(valid, (series - mean[..., None]) ** 2, 0.0).sum(axis=-1) / (count - 1)
+        positive = (np.where(valid, series, 0.0) > 0).sum(axis=-1) / count
+    return mean, np.sqrt(var), positive
+
+
+# ---------------------------------------------------------------------------
+# 评估
+# ---------------------------------------------------------------------------
+
+def _evaluate_chunk(task):
+    """
+    一块因子的全部指标（可在子进程中执行）
+    Returns:
+        dict，各数组第一维为本块的因子
+    """
+    values, returns, horizons, quantiles, min_obs = task
+    base = returns[0]
+
+    ic = cross_corr(values, base, min_obs)
+    factor_rank, return_rank = _joint(values, base)
+    rank_ic = cross_corr(rank_last_axis(factor_rank), rank_last_axis(return_rank), min_obs)
+
+    decay = np.empty((values.shape[0], len(horizons)))
+    for i in range(len(horizons)):
+        x, y = _joint(values, returns[i])
+        decay[:, i] = _series_stats(cross_corr(rank_last_axis(x), rank_last_axis(y), min_obs))[0]
+
+    # 因子秩的日间自相关，越高换手越低
+    ranks = rank_last_axis(values)
+    autocorr = np.full(values.shape[:2], np.nan)
+    x, y = _joint(ranks[:, 1:], ranks[:, :-1])
+    autocorr[:, 1:] = cross_corr(rank_last_axis(x), rank_last_axis(y), min_obs)
+
+    labels = quantile_labels(values, quantiles)
+    top = labels == quantiles - 1
+    top_count = top.sum(axis=-1)
+    turnover = np.full(values.shape[:2], np.nan)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        kept = (top[:, 1:] & top[:, :-1]).sum(axis=-1)
+        turnover[:, 1:] = np.where(top_count[:, 1:] > 0, 1.0 - kept / top_count[:, 1:], np.nan)
+
+    quantile_returns = np.full((values.shape[0], quantiles, values.shape[1]), np.nan)
+    base_valid = np.isfinite(base)
+    base_filled = np.where(base_valid, base, 0.0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        for q in range(quantiles):
+            member = (labels == q) & base_valid
+            count = member.sum(axis=-1)
+            quantile_returns[:, q] = np.where(count > 0, (member * base_filled).sum(axis=-1) / count, np.nan)
+
+    return {"ic": ic, "rank_ic": rank_ic, "decay": decay, "autocorr": autocorr,
+            "turnover": turnover, "quantile_returns": quantile_returns}
+
+
+def evaluate_factors(values, returns, factor_names, dates, horizons=DEFAULT_HORIZONS, quantiles=5,
+                     min_obs=5, chunk_size=16, n_jobs=1):
+    """
+    评估一组因子
+    Args:
+        values: (n_factors, n_dates, n_instruments) 因子值
+        returns: (n_horizons, n_dates, n_instruments) 未来收益（见 forward_returns），第一个持有期用于 IC、换手和分位收益
+        factor_names: 因子名
+        dates: 交易日
+        horizons: returns 对应的持有期
+        quantiles: 分位组数
+        min_obs: 计算当日相关系数所需的最少股票数
+        chunk_size: 每块因子数，决定单块内存
+        n_jobs: 并行进程数
+    Returns:
+        dict:
+        - summary: 以因子名为索引的 DataFrame（ic_mean, ic_std, icir, ic_positive, rank_ic_mean, rank_icir,
+          autocorr, turnover, q1..qn 的日均收益, long_short）
+        - ic, rank_ic, turnover: 交易日 × 因子 的 DataFrame
+        - decay: 因子 × 持有期 的 Rank IC 均值
+        - quantile_returns: 以 (因子, 分位) 为列的每日分位收益
+    """
+    values = np.asarray(values)
+    returns = np.asarray(returns, dtype=np.float64)
+    tasks = [(values[i:i + chunk_size], returns, tuple(horizons), quantiles, min_obs)
+             for i in range(0, len(factor_names), chunk_size)]
+    if n_jobs > 1 and len(tasks) > 1:
+        with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+            parts = list(pool.map(_evaluate_chunk, tasks))
+    else:
+        parts = [_evaluate_chunk(task) for task in tasks]
+    merged = {key: np.concatenate([p[key] for p in parts]) for key in parts[0]}
+
+    ic_mean, ic_std, ic_positive = _series_stats(merged["ic"])
+    rank_mean, rank_std, _ = _series_stats(merged["rank_ic"])
+    qret_mean = _series_stats(merged["quantile_returns"])[0]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        summary = pd.DataFrame({
+            "ic_mean": ic_mean,
+            "ic_std": ic_std,
+            "icir": ic_mean / ic_std,
+            "ic_positive": ic_positive,
+            "rank_ic_mean": rank_mean,
+            "rank_icir": rank_mean / rank_std,
+            "autocorr": _series_stats(merged["autocorr"])[0],
+            "turnover": _series_stats(merged["turnover"])[0],
+        }, index=pd.Index(factor_names, name="factor"))
+    for q in range(quantiles):
+        summary[f"q{q + 1}"] = qret_mean[:, q]
+    summary["long_short"] = qret_mean[:, -1] - qret_mean[:, 0]
+
+    dates = pd.DatetimeIndex(dates, name="datetime")
+    qret = merged["quantile_returns"]
+    return {
+        "summary": summary,
+        "ic": pd.DataFrame(merged["ic"].T, index=dates, columns=factor_names),
+        "rank_ic": pd.DataFrame(merged["rank_ic"].T, index=dates, columns=factor_names),
+        "turnover": pd.DataFrame(merged["turnover"].T, index=dates, columns=factor_names),
+        "decay": pd.DataFrame(merged["decay"], index=pd.Index(factor_names, name="factor"),
+                              columns=[f"{h}d" for h in horizons]),
+        "quantile_returns": pd.DataFrame(
+            qret.transpose(2, 0, 1).reshape(len(dates), -1), index=dates,
+            columns=pd.MultiIndex.from_product([factor_names, range(1, quantiles + 1)], names=["factor", "quantile"])),
+    }
+
+
+def load_and_evaluate(factors, instruments, start_time, end_time, horizons=DEFAULT_HORIZONS, **kwargs):
+    """
+    用 qlib 加载因子和收盘价并评估（调用前需已 qlib.init）
+    Args:
+        factors: {因子名: qlib 表达式}
+        instruments: 股票列表或 D.instruments(market)
+        start_time, end_time: 评估区间
+        kwargs: 透传给 evaluate_factors
+    """
+    from qlib.data import D
+
+    df = D.features(instruments, list(factors.values()), start_time=start_time, end_time=end_time)
+    df.columns = list(factors.keys())
+    values, names, dates, insts = to_block(df)
+    # 收盘价向后多取一段（按自然日留足 max(horizons) 个交易日），使区间末尾的未来收益也有值
+    extra_end = pd.Timestamp(dates[-1]) + pd.Timedelta(days=max(horizons) * 2 + 10)
+    close = D.features(insts, ["$close"], start_time=start_time, end_time=extra_end)
+    close_wide = close.iloc[:, 0].unstack(level='instrument').reindex(columns=insts)
+    all_dates = close_wide.index.union(dates)
+    returns = forward_returns(close_wide.reindex(all_dates).to_numpy(), horizons)
+    returns = returns[:, all_dates.get_indexer(dates)]
+    return evaluate_factors(values, returns, names, dates, horizons=horizons, **kwargs)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="因子评估：IC、Rank IC、IC 衰减、换手、分位收益")
+    parser.add_argument("--market", default="csi300", help="qlib 市场名")
+    parser.add_argument("--start", default="2020-01-01")
+    parser.add_argument("--end", default="2024-12-31")
+    parser.add_argument("--quantiles", type=int, default=5)
+    parser.add_argument("--chunk-size", type=int, default=16, help="每块因子数")
+    parser.add_argument("--jobs", type=int, default=1, help="并行计算的进程数")
+    parser.add_argument("--provider-uri", default=PROVIDER_URI)
+    args = parser.parse_args()
+
+    import qlib
+    from qlib.config import REG_CN
+    from qlib.data import D
+
+    qlib.init(provider_uri=args.provider_uri, region=REG_CN)
+    result = load_and_evaluate(TUTORIAL_FACTORS, D.instruments(args.market), args.start, args.end,
+                               quantiles=args.quantiles, chunk_size=args.chunk_size, n_jobs=args.jobs)
+    pd.set_option('display.width', 200)
+    print(result["summary"].round(4))
+    print("\nIC 衰减（Rank IC 均值）:")
+    print(result["decay"].round(4))
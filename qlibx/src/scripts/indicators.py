@@ -0,0 +1,295 @@
+"""
+流式技术指标
+与 qlib 表达式对应的增量版本，基于定长环形缓冲区，每次更新 O(1)：
+    RollingMean   Mean(x, N)
+    RollingStd    Std(x, N)（样本标准差，与 pandas/qlib 一致）
+    EMA           EMA(x, N)
+    RollingCorr   Corr(x, y, N)
+    VolumeRatio   $volume / Mean($volume, N)
+实盘中的“一个样本”是一次报价，窗口长度按样本数计算；交易程序盘中每个检查间隔批量采样一次，
+每个交易日重新开始（见 TradingStrategy.sample_indicators），默认窗口 20 个样本约为最近 20 分钟
+"""
+
+import math
+
+
+class RingBuffer:
+    """定长环形缓冲区"""
+
+    def __init__(self, capacity):
+        if capacity <= 0:
+            raise ValueError("capacity 必须为正数")
+        self.capacity = capacity
+        self._data = [0.0] * capacity
+        self._pos = 0
+        self.count = 0
+
+    def push(self, value):
+        """
+        追加一个值
+        Returns:
+            被挤出的旧值；缓冲区未满时为 None
+        """
+        evicted = self._data[self._pos] if self.count == self.capacity else None
+        self._data[self._pos] = value
+        self._pos = (self._pos + 1) % self.capacity
+        if self.count < self.capacity:
+            self.count += 1
+        return evicted
+
+    @property
+    def full(self):
+        return self.count == self.capacity
+
+    def values(self):
+        """按时间顺序返回当前内容（O(N)，仅用于校正和调试）"""
+        if self.count < self.capacity:
+            return self._data[:self.count]
+        return self._data[self._pos:] + self._data[:self._pos]
+
+    def __len__(self):
+        return self.count
+
+
+class RollingMean:
+    def __init__(self, window):
+        self.buffer = RingBuffer(window)
+        self._sum = 0.0
+
+    def update(self, x):
+        evicted = self.buffer.push(x)
+        self._sum += x - (evicted or 0.0)
+        return self.value
+
+    @property
+    def ready(self):
+        return self.buffer.full
+
+    @property
+    def value(self):
+        return self._sum / self.buffer.count if self.buffer.count else None
+
+
+class RollingStd:
+    """
+    滚动样本标准差
+    维护和与平方和；每滚动一整个窗口按缓冲区重算一次，消除浮点累积误差（均摊 O(1)）
+    """
+
+    def __init__(self, window):
+        self.buffer = RingBuffer(window)
+        self._sum = 0.0
+        self._sumsq = 0.0
+        self._since_resync = 0
+
+    def update(self, x):
+        evicted = self.buffer.push(x)
+        if evicted is None:
+            self._sum += x
+            self._sumsq += x * x
+        else:
+            self._sum += x - evicted
+            self._sumsq += x * x - evicted * evicted
+        self._since_resync += 1
+        if self._since_resync >= self.buffer.capacity:
+            values = self.buffer.values()
+            self._sum = math.fsum(values)
+            self._sumsq = math.fsum(v * v for v in values)
+            self._since_resync = 0
+        return self.value
+
+    @property
+    def ready(self):
+        return self.buffer.full
+
+    @property
+    def value(self):
+        n = self.buffer.count
+        if n < 2:
+            return None
+        var = (self._sumsq - self._sum * self._sum / n) / (n - 1)
+        return math.sqrt(var) if var > 0 else 0.0
+
+
+class EMA:
+    """指数移动平均，alpha = 2 / (span + 1)，以第一个值作为初值"""
+
+    def __init__(self, span):
+        self.span = span
+        self.alpha = 2.0 / (span + 1)
+        self.count = 0
+        self.value = None
+
+    def update(self, x):
+        self.value = x if self.value is None else self.value + self.alpha * (x - self.value)
+        self.count += 1
+        return self.value
+
+    @property
+    def ready(self):
+        return self.count >= self.span
+
+
+class RollingCorr:
+    """滚动皮尔逊相关系数"""
+
+    def __init__(self, window):
+        self.xs = RingBuffer(window)
+        self.ys = RingBuffer(window)
+        self._sx = self._sy = self._sxx = self._syy = self._sxy = 0.0
+        self._since_resync = 0
+
+    def update(self, x, y):
+        ex = self.xs.push(x)
+        ey = self.ys.push(y)
+        self._sx += x
+        self._sy += y
+        self._sxx += x * x
+        self._syy += y * y
+        self._sxy += x * y
+        if ex is not None:
+            self._sx -= ex
+            self._sy -= ey
+            self._sxx -= ex * ex
+            self._syy -= ey * ey
+            self._sxy -= ex * ey
+        self._since_resync += 1
+        if self._since_resync >= self.xs.capacity:
+            xs, ys = self.xs.values(), self.ys.values()
+            self._sx, self._sy = math.fsum(xs), math.fsum(ys)
+            self._sxx = math.fsum(v * v for v in xs)
+            self._syy = math.fsum(v * v for v in ys)
+            self._sxy = math.fsum(a * b for a, b in zip(xs, ys))
+            self._since_resync = 0
+        return self.value
+
+    @property
+    def ready(self):
+        return self.xs.full
+
+    @property
+    def value(self):
+        n = self.xs.count
+        if n < 2:
+            return None
+        cov = self._sxy - self._sx * self._sy / n
+        var_x = self._sxx - self._sx * self._sx / n
+        var_y = self._syy - self._sy * self._sy / n
+        if var_x <= 0 or var_y <= 0:
+            return None
+        return cov / math.sqrt(var_x * var_y)
+
+
+class VolumeRatio:
+    """当前样本成交量 / 最近 N 个样本的平均成交量（含当前样本）"""
+
+    def __init__(self, window):
+        self.mean = RollingMean(window)
+        self.last = None
+
+    def update(self, volume):
+        self.last = volume
+        self.mean.update(volume)
+        return self.value
+
+    @property
+    def ready(self):
+        return self.mean.ready
+
+    @property
+    def value(self):
+        mean = self.mean.value
+        if self.last is None or not mean:
+            return None
+        return self.last / mean
+
+
+class SymbolIndicators:
+    """
+    单只股票的一组流式指标，由报价驱动
+    报价中的 volume 是当日累计成交量，这里换算成两次报价之间的成交量
+    """
+
+    def __init__(self, ma_short=5, ma_long=20, ema_span=20, vol_window=20, corr_window=10, volume_window=20):
+        self.ma_short = RollingMean(ma_short)
+        self.ma_long = RollingMean(ma_long)
+        self.ema = EMA(ema_span)
+        self.volatility = RollingStd(vol_window)       # Std($close / Ref($close, 1) - 1, N)
+        self.price_volume_corr = RollingCorr(corr_window)
+        self.volume_ratio = VolumeRatio(volume_window)
+        self.last_price = None
+        self.last_cum_volume = None
+        self.last_ts = None
+        self.samples = 0
+
+    def update(self, price, cum_volume=None, ts=None):
+        """
+        用一次报价更新全部指标
+        Args:
+            price: 最新价
+            cum_volume: 当日累计成交量
+            ts: 报价时间（仅记录）
+        """
+        if not price or price <= 0:
+            return self
+        if self.last_price:
+            self.volatility.update(price / self.last_price - 1)
+        self.ma_short.update(price)
+        self.ma_long.update(price)
+        self.ema.update(price)
+
+        if cum_volume is not None:
+            if self.last_cum_volume is not None:
+                delta = cum_volume - self.last_cum_volume
+                # 累计量变小说明进入了新的交易日
+                tick_volume = cum_volume if delta < 0 else delta
+                self.volume_ratio.update(tick_volume)
+                self.price_volume_corr.update(price, tick_volume)
+            self.last_cum_volume = cum_volume
+
+        self.last_price = price
+        self.last_ts = ts
+        self.samples += 1
+        return self
+
+    def snapshot(self):
+        """当前指标值；窗口未填满的指标为 None"""
+        def ready_value(indicator):
+            return indicator.value if indicator.ready else None
+
+        ma_long = ready_value(self.ma_long)
+        return {
+            "price": self.last_price,
+            "ma_short": ready_value(self.ma_short),
+            "ma_long": ma_long,
+            "ma_long_ratio": self.last_price / ma_long - 1 if ma_long else None,
+            "ema": ready_value(self.ema),
+            "volatility": ready_value(self.volatility),
+            "price_volume_corr": ready_value(self.price_volume_corr),
+            "volume_ratio": ready_value(self.volume_ratio),
+            "samples": self.samples,
+        }
+
+
+class IndicatorBook:
+    """所有股票的流式指标"""
+
+    def __init__(self, **windows):
+        self.windows = windows
+        self._symbols = {}
+
+    def get(self, symbol):
+        indicators = self._symbols.get(symbol)
+        if indicators is None:
+            indicators = self._symbols[symbol] = SymbolIndicators(**self.windows)
+        return indicators
+
+    def update(self, symbol, price, cum_volume=None, ts=None):
+        return self.get(symbol).update(price, cum_volume, ts)
+
+    def snapshot(self, symbol):
+        return self.get(symbol).snapshot()
+
+    def reset(self):
+        """清空全部股票的指标（新的交易日）"""
+        self._symbols.clear()
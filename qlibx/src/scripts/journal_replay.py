@@ -0,0 +1,214 @@
+"""
+网关请求日志回放
+把 tick_journal 记录的行情、持仓、委托回报重新喂给 TradingStrategy，用于复盘收盘窗口的决策和回归基准测试：
+- 查询接口返回“模拟时刻之前最近一次记录的响应”，按接口 + 请求参数匹配
+- 下单不发送，只记录并与日志中真实发出的委托对比
+- 模拟时钟按日志中的轮次推进，轮次之间按 speed 倍速等待（speed=0 表示不等待）
+- 交易记录写入临时目录，不影响真实交易记录
+用法: python journal_replay.py journal/gateway_20240105.qtj --speed 100 [--seed-ledger-dir .]
+"""
+
+import argparse
+import bisect
+import csv
+import glob
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+from datetime import datetime
+
+from single_flight import SingleFlight
+from tick_journal import read_journal
+from tqqq_trading_bot import HuashengGatewayAPI, TradingStrategy
+
+logger = logging.getLogger(__name__)
+
+ORDER_ENDPOINT = "trade/TradeEntrust"
+QUOTE_ENDPOINT = "hq/BasicQot"
+
+
+def _params_key(params):
+    return json.dumps(params, sort_keys=True, separators=(",", ":"), default=str)
+
+
+def _order_summary(params):
+    return (params.get("stockCode"), str(params.get("entrustBs")),
+            int(float(params.get("entrustAmount", 0))), round(float(params.get("entrustPrice", 0)), 4))
+
+
+class SimulatedClock:
+    """由回放驱动推进的时钟"""
+
+    def __init__(self, start_ts):
+        self.ts = start_ts
+
+    def now(self):
+        return self.ts
+
+    def set(self, ts):
+        self.ts = max(self.ts, ts)
+
+
+class ReplayGateway(HuashengGatewayAPI):
+    """以日志中的响应代替真实网关"""
+
+    def __init__(self, records, clock):
+        # 不调用父类构造函数：回放不登录、不建立连接
+        self.gateway_url = "replay"
+        self.timeout = 0
+        self.session_file = None
+        self.session_ttl = 0
+        self.journal = None
+        self._http = None
+        self._session_restored = False
+        # 模拟时钟下不按真实时间复用结果，每次查询都按模拟时刻取日志中的响应
+        self.coalesce_ttl = {}
+        self._flight = SingleFlight()
+
+        self.clock = clock
+        self._responses = {}   # (endpoint, 参数) -> ([ts, ...], [data, ...])
+        for record in records:
+            times, values = self._responses.setdefault((record.endpoint, _params_key(record.params)), ([], []))
+            times.append(record.ts)
+            values.append(record.data)
+        self.recorded_orders = [(r.ts, r.params, r.data) for r in records if r.endpoint == ORDER_ENDPOINT]
+        self.sent_orders = []
+
+    def _post_request(self, endpoint, params, retries=0):
+        if endpoint == ORDER_ENDPOINT:
+            self.sent_orders.append((self.clock.now(), params))
+            # 与当时发出的委托参数相同则返回当时的回报，否则生成模拟回报
+            for _, recorded_params, ack in self.recorded_orders:
+                if ack and _order_summary(recorded_params) == _order_summary(params):
+                    return ack
+            return {"entrustId": f"replay-{len(self.sent_orders)}"}
+
+        series = self._responses.get((endpoint, _params_key(params)))
+        if series is None:
+            return None
+        idx = bisect.bisect_right(series[0], self.clock.now()) - 1
+        return series[1][idx] if idx >= 0 else None
+
+
+def split_passes(records, gap_sec=5.0):
+    """
+    按时间间隔把记录划分为轮次（一次主循环中的请求在几秒内完成，两轮之间间隔较长）
+    Returns:
+        每个包含行情查询的轮次的结束时间
+    """
+    passes = []
+    cluster_end, has_quote = None, False
+    for record in records:
+        if cluster_end is not None and record.ts - cluster_end > gap_sec:
+            if has_quote:
+                passes.append(cluster_end)
+            has_quote = False
+        cluster_end = record.ts if cluster_end is None else max(cluster_end, record.ts)
+        has_quote = has_quote or record.endpoint == QUOTE_ENDPOINT
+    if cluster_end is not None and has_quote:
+        passes.append(cluster_end)
+    return passes
+
+
+def _seed_ledgers(source_dir, target_dir, before_ts, tz):
+    """复制交易记录，只保留日志开始之前的行，使买入间隔等判断与当时一致"""
+    cutoff = datetime.fromtimestamp(before_ts, tz).isoformat()
+    for path in glob.glob(os.path.join(source_dir, "*_trading.csv")):
+        with open(path, 'r', encoding='utf-8', newline='') as f:
+            reader = csv.DictReader(f)
+            rows = [row for row in reader if (row.get('timestamp') or "") < cutoff]
+            fieldnames = reader.fieldnames
+        if not fieldnames:
+            continue
+        with open(os.path.join(target_dir, os.path.basename(path)), 'w', encoding='utf-8', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=fieldnames)
+            writer.writeheader()
+            writer.writerows(rows)
+
+
+def replay(journal_path, strategy_file="stock_strategy.json", speed=100.0, seed_ledger_dir=None,
+           output_dir=None, symbols=None):
+    """
+    回放一个日志文件
+    Args:
+        journal_path: 日志文件
+        strategy_file: 策略文件
+        speed: 相对真实时间的倍速，0 表示不等待
+        seed_ledger_dir: 从该目录复制日志开始前的交易记录
+        output_dir: 回放产生的交易记录目录，默认临时目录
+        symbols: 回放的股票，默认策略文件中的全部
+    Returns:
+        回放摘要字典
+    """
+    records = sorted(read_journal(journal_path), key=lambda r: r.ts)
+    if not records:
+        raise ValueError(f"{journal_path} 中没有记录")
+    passes = split_passes(records)
+
+    clock = SimulatedClock(records[0].ts)
+    api = ReplayGateway(records, clock)
+    strategy = TradingStrategy(api, strategy_file)
+    strategy.now = lambda: datetime.fromtimestamp(clock.now(), strategy.et_tz)
+
+    cleanup = output_dir is None
+    output_dir = output_dir or tempfile.mkdtemp(prefix="qtrade_replay_")
+    os.makedirs(output_dir, exist_ok=True)
+    strategy.ledger_dir = output_dir
+    if seed_ledger_dir:
+        _seed_ledgers(seed_ledger_dir, output_dir, records[0].ts, strategy.et_tz)
+    symbols = list(symbols or strategy.stock_strategies.keys())
+
+    wall_start = time.perf_counter()
+    try:
+        for pass_ts in passes:
+            if speed:
+                # 按倍速对齐到该轮在日志中的时刻
+                wait = (pass_ts - records[0].ts) / speed - (time.perf_counter() - wall_start)
+                if wait > 0:
+                    time.sleep(wait)
+            clock.set(pass_ts)
+            strategy.sample_indicators(symbols)
+            if strategy.should_prearm():
+                strategy.prearm(symbols)
+            for symbol in symbols:
+                strategy.execute_strategy(symbol)
+    finally:
+        if cleanup:
+            shutil.rmtree(output_dir, ignore_errors=True)
+    wall = time.perf_counter() - wall_start
+
+    recorded = [_order_summary(params) for _, params, _ in api.recorded_orders]
+    sent = [_order_summary(params) for _, params in api.sent_orders]
+    simulated = records[-1].ts - records[0].ts
+    return {
+        "records": len(records),
+        "passes": len(passes),
+        "simulated_sec": simulated,
+        "wall_sec": wall,
+        "effective_speed": simulated / wall if wall > 0 else float("inf"),
+        "recorded_orders": recorded,
+        "replayed_orders": sent,
+        "orders_match": recorded == sent,
+    }
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING, format='%(asctime)s [%(levelname)s] %(message)s')
+    parser = argparse.ArgumentParser(description="回放网关请求日志")
+    parser.add_argument("journal", help="tick_journal 日志文件")
+    parser.add_argument("--strategy-file", default="stock_strategy.json")
+    parser.add_argument("--speed", type=float, default=100.0, help="回放倍速，0 表示不等待")
+    parser.add_argument("--seed-ledger-dir", default=None, help="复制该目录中日志开始前的交易记录")
+    parser.add_argument("--output-dir", default=None, help="保留回放产生的交易记录")
+    args = parser.parse_args()
+
+    summary = replay(args.journal, args.strategy_file, args.speed, args.seed_ledger_dir, args.output_dir)
+    print(f"记录 {summary['records']} 条, {summary['passes']} 轮, "
+          f"模拟 {summary['simulated_sec']:.0f}s 用时 {summary['wall_sec']:.2f}s "
+          f"({summary['effective_speed']:.0f}x)")
+    print(f"当时下单: {summary['recorded_orders']}")
+    print(f"回放下单: {summary['replayed_orders']}")
+    print("下单一致" if summary["orders_match"] else "下单不一致")
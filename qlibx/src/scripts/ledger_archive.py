@@ -0,0 +1,346 @@
+"""
+交易记录归档
+{symbol}_trading.csv 只保留当月记录，已结束月份的记录压缩进按 股票 / 月份 分区的 Parquet 文件：
+    ledger_archive/symbol=TQQQ/month=2024-01.parquet
+- 列为强类型（时间戳、整数、浮点），不再是字符串
+- 读取时先按股票和月份裁剪分区，再按日期过滤行
+用法: python ledger_archive.py [--base-dir .]   （建议在非交易时段运行）
+pyarrow 只在读写归档分区时才导入，没有归档时读取不依赖它
+"""
+
+import argparse
+import csv
+import glob
+import io
+import logging
+import os
+from contextlib import contextmanager
+from datetime import datetime
+
+try:
+    import fcntl
+except ImportError:   # Windows：没有 flock，不加锁
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+LEDGER_COLUMNS = ['timestamp', 'symbol', 'action', 'quantity', 'price', 'volume', 'order_result']
+ARCHIVE_DIR_NAME = "ledger_archive"
+LEDGER_SUFFIX = "_trading.csv"
+
+
+def ledger_path(symbol, base_dir="."):
+    return os.path.join(base_dir, f"{symbol.lower()}{LEDGER_SUFFIX}")
+
+
+@contextmanager
+def ledger_lock(path):
+    """
+    交易记录的进程间建议锁（flock），追加写入和归档改写热文件时持有
+    锁在单独的 .lock 文件上：热文件被 os.replace 后 inode 改变，锁文件不变
+    """
+    if fcntl is None:
+        yield
+        return
+    lock_path = os.path.join(os.path.dirname(path), f".{os.path.basename(path)}.lock")
+    with open(lock_path, 'a') as lock_file:
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+
+def archive_dir(base_dir="."):
+    return os.path.join(base_dir, ARCHIVE_DIR_NAME)
+
+
+def partition_path(symbol, month, base_dir="."):
+    return os.path.join(archive_dir(base_dir), f"symbol={symbol.upper()}", f"month={month}.parquet")
+
+
+def _schema():
+    import pyarrow as pa
+    return pa.schema([
+        ('timestamp', pa.timestamp('us', tz='America/New_York')),
+        ('symbol', pa.string()),
+        ('action', pa.string()),
+        ('quantity', pa.int64()),
+        ('price', pa.float64()),
+        ('volume', pa.int64()),
+        ('order_result', pa.string()),
+    ])
+
+
+def _to_int(value):
+    return int(float(value)) if value not in (None, "") else None
+
+
+def _to_float(value):
+    return float(value) if value not in (None, "") else None
+
+
+def _rows_to_table(rows):
+    """csv.DictReader 的字符串行 -> 强类型 Arrow 表"""
+    import pyarrow as pa
+    columns = {
+        'timestamp': [datetime.fromisoformat(r['timestamp']) for r in rows],
+        'symbol': [r.get('symbol') for r in rows],
+        'action': [r.get('action') for r in rows],
+        'quantity': [_to_int(r.get('quantity')) for r in rows],
+        'price': [_to_float(r.get('price')) for r in rows],
+        'volume': [_to_int(r.get('volume')) for r in rows],
+        'order_result': [r.get('order_result') for r in rows],
+    }
+    return pa.Table.from_pydict(columns, schema=_schema())
+
+
+def _table_to_rows(table):
+    """Arrow 表 -> 与 csv.DictReader 一致的字符串行，兼容现有接口"""
+    rows = []
+    for record in table.to_pylist():
+        rows.append({
+            'timestamp': record['timestamp'].isoformat(),
+            'symbol': record['symbol'] or "",
+            'action': record['action'] or "",
+            'quantity': "" if record['quantity'] is None else str(record['quantity']),
+            'price': "" if record['price'] is None else str(record['price']),
+            'volume': "" if record['volume'] is None else str(record['volume']),
+            'order_result': record['order_result'] or "",
+        })
+    return rows
+
+
+def _write_partition(symbol, month, rows, base_dir):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    path = partition_path(symbol, month, base_dir)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    table = _rows_to_table(rows)
+    if os.path.exists(path):
+        # 重复运行或上次压缩中途退出时，合并并去重
+        merged = {}
+        for record in pq.read_table(path).to_pylist() + table.to_pylist():
+            key = (record['timestamp'], record['action'], record['quantity'], record['price'], record['order_result'])
+            merged[key] = record
+        records = sorted(merged.values(), key=lambda r: r['timestamp'])
+        table = pa.Table.from_pylist(records, schema=_schema())
+    tmp_path = path + ".tmp"
+    pq.write_table(table, tmp_path, compression='zstd')
+    os.replace(tmp_path, path)
+    return table.num_rows
+
+
+def compact_ledger(symbol, base_dir=".", keep_month=None):
+    """
+    把已结束月份的记录移入归档，热文件只保留 keep_month 及之后的记录
+    Args:
+        symbol: 股票代码
+        base_dir: 交易记录所在目录
+        keep_month: 保留在热文件中的起始月份 "YYYY-MM"，默认当月
+    Returns:
+        归档的行数
+    """
+    path = ledger_path(symbol, base_dir)
+    if not os.path.exists(path):
+        return 0
+    keep_month = keep_month or datetime.now().strftime('%Y-%m')
+
+    # 只处理当前已有的内容；写入 Parquet 较慢，不持锁，交易程序可以继续追加
+    # 持锁取大小，保证不落在 record_trade 写到一半的行中间
+    with ledger_lock(path):
+        size_before = os.path.getsize(path)
+    with open(path, 'rb') as f:
+        text = f.read(size_before).decode('utf-8')
+    rows = [row for row in csv.DictReader(io.StringIO(text, newline='')) if row.get('timestamp')]
+
+    closed, hot = {}, []
+    for row in rows:
+        month = row['timestamp'][:7]
+        if month < keep_month:
+            closed.setdefault(month, []).append(row)
+        else:
+            hot.append(row)
+    if not closed:
+        return 0
+
+    for month, month_rows in sorted(closed.items()):
+        _write_partition(symbol, month, month_rows, base_dir)
+
+    # 改写热文件时持锁（record_trade 同样持锁追加）：期间追加的记录原样接在保留的记录之后，不会丢失
+    tmp_path = path + ".tmp"
+    with ledger_lock(path):
+        with open(path, 'rb') as f:
+            f.seek(size_before)
+            appended = f.read()
+        with open(tmp_path, 'w', encoding='utf-8', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=LEDGER_COLUMNS, extrasaction='ignore')
+            writer.writeheader()
+            writer.writerows(hot)
+        if appended:
+            with open(tmp_path, 'ab') as f:
+                f.write(appended)
+        os.replace(tmp_path, path)
+    if appended:
+        logger.info("%s 在归档过程中追加了 %s 字节，已保留", path, len(appended))
+
+    archived = sum(len(v) for v in closed.values())
+    logger.info("%s: 归档 %s 行（%s 个月），热文件保留 %s 行", symbol, archived, len(closed), len(hot))
+    return archived
+
+
+def list_symbols(base_dir="."):
+    """热文件和归档中出现过的所有股票"""
+    symbols = {os.path.basename(p)[:-len(LEDGER_SUFFIX)].upper()
+               for p in glob.glob(os.path.join(base_dir, f"*{LEDGER_SUFFIX}"))}
+    root = archive_dir(base_dir)
+    if os.path.isdir(root):
+        symbols.update(name[len("symbol="):] for name in os.listdir(root) if name.startswith("symbol="))
+    return sorted(symbols)
+
+
+def list_partitions(symbol, base_dir=".", start=None, end=None):
+    """
+    按月份裁剪后的归档分区
+    Args:
+        start, end: 日期 "YYYY-MM-DD"（含），为空表示不限
+    Returns:
+        [(month, path), ...]，按月份升序
+    """
+    directory = os.path.join(archive_dir(base_dir), f"symbol={symbol.upper()}")
+    if not os.path.isdir(directory):
+        return []
+    partitions = []
+    for name in os.listdir(directory):
+        if not (name.startswith("month=") and name.endswith(".parquet")):
+            continue
+        month = name[len("month="):-len(".parquet")]
+        if start and month < start[:7]:
+            continue
+        if end and month > end[:7]:
+            continue
+        partitions.append((month, os.path.join(directory, name)))
+    return sorted(partitions)
+
+
+def _in_range(timestamp, start, end):
+    day = timestamp[:10]
+    return (not start or day >= start[:10]) and (not end or day <= end[:10])
+
+
+def _read_hot_rows(symbol, base_dir, start, end):
+    path = ledger_path(symbol, base_dir)
+    if not os.path.exists(path):
+        return []
+    with open(path, 'r', encoding='utf-8') as f:
+        return [row for row in csv.DictReader(f) if _in_range(row.get('timestamp') or "", start, end)]
+
+
+def read_ledger_rows(symbol, start=None, end=None, base_dir="."):
+    """
+    读取交易记录（归档 + 热文件），返回与 csv.DictReader 相同格式的字符串行
+    Args:
+        symbol: 股票代码
+        start, end: 日期 "YYYY-MM-DD"（含），为空表示不限
+        base_dir: 交易记录所在目录
+    """
+    rows = read_archived_rows(symbol, start, end, base_dir)
+    rows.extend(_read_hot_rows(symbol, base_dir, start, end))
+    return rows
+
+
+def read_archived_rows(symbol, start=None, end=None, base_dir="."):
+    """只读取归档分区中的记录（不含热文件），格式同 read_ledger_rows；没有归档时不导入 pyarrow"""
+    if not list_partitions(symbol, base_dir, start, end):
+        return []
+    return _table_to_rows(read_ledger_table(symbol, start, end, base_dir, include_hot=False))
+
+
+def read_ledger_table(symbol, start=None, end=None, base_dir=".", include_hot=True):
+    """
+    读取交易记录为强类型的 Arrow 表
+    Args:
+        symbol: 股票代码
+        start, end: 日期 "YYYY-MM-DD"（含），为空表示不限
+        base_dir: 交易记录所在目录
+        include_hot: 是否包含热文件中的当月记录
+    """
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.parquet as pq
+
+    tables = [pq.read_table(path) for _, path in list_partitions(symbol, base_dir, start, end)]
+    if include_hot:
+        hot_rows = _read_hot_rows(symbol, base_dir, start, end)
+        if hot_rows:
+            tables.append(_rows_to_table(hot_rows))
+    if not tables:
+        return _schema().empty_table()
+    table = pa.concat_tables(tables)
+
+    # 分区只按月裁剪，月内再按本地日期过滤
+    if start or end:
+        days = pc.strftime(table['timestamp'], format='%Y-%m-%d')
+        keep = None
+        if start:
+            keep = pc.greater_equal(days, start[:10])
+        if end:
+            upper = pc.less_equal(days, end[:10])
+            keep = upper if keep is None else pc.and_(keep, upper)
+        table = table.filter(keep)
+    return table
+
+
+def ledger_version(symbol, start=None, end=None, base_dir="."):
+    """
+    交易记录的版本标识，只依赖文件元数据（不读取内容）
+    热文件或 start ~ end 覆盖到的任一归档分区变化时，版本随之变化
+    Returns:
+        ((文件名, 大小, mtime_ns), ...) 元组
+    """
+    paths = [path for _, path in list_partitions(symbol, base_dir, start, end)]
+    paths.append(ledger_path(symbol, base_dir))
+    version = []
+    for path in paths:
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            continue
+        version.append((os.path.basename(path), st.st_size, st.st_mtime_ns))
+    return tuple(version)
+
+
+def last_archived_buy(symbol, base_dir="."):
+    """
+    归档中最近一次买入
+    Returns:
+        (datetime, price)，没有买入记录返回 None
+    """
+    partitions = list_partitions(symbol, base_dir)
+    if not partitions:
+        return None
+    import pyarrow.parquet as pq
+    for _, path in reversed(partitions):
+        buys = [r for r in pq.read_table(path, columns=['timestamp', 'action', 'price']).to_pylist()
+                if r['action'] == "buy"]
+        if buys:
+            last = max(buys, key=lambda r: r['timestamp'])
+            return last['timestamp'], last['price']
+    return None
+
+
+def compact_all(base_dir=".", keep_month=None):
+    """归档目录下所有股票的交易记录"""
+    return {symbol: compact_ledger(symbol, base_dir, keep_month) for symbol in list_symbols(base_dir)
+            if os.path.exists(ledger_path(symbol, base_dir))}
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s [%(levelname)s] %(message)s')
+    parser = argparse.ArgumentParser(description="把已结束月份的交易记录归档为分区 Parquet")
+    parser.add_argument("--base-dir", default=".", help="交易记录所在目录")
+    parser.add_argument("--keep-month", default=None, help="热文件保留的起始月份 YYYY-MM，默认当月")
+    args = parser.parse_args()
+    result = compact_all(args.base_dir, args.keep_month)
+    print(f"归档完成: {sum(result.values())} 行, {len(result)} 只股票")
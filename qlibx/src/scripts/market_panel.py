@@ -0,0 +1,178 @@
+"""
+紧凑的行情面板
+用 (字段 × 股票 × 交易日) 的 float32 数组代替 (instrument, datetime) MultiIndex 的 DataFrame：
+- 股票用整数编码，名称只存一份
+- 所有字段共用一个交易日历
+- 有效性用按位压缩的掩码保存（每个 股票×交易日 1 bit）
+- 与 qlib 的 D.features 结果互相转换；单字段按 instrument 优先的顺序存放，转回 DataFrame 时保持 float32，
+  只复制有效的行（见 to_frame）
+qlib_backtest_simple.run_backtest 用 load_panel 分段加载因子和价格
+十年日频 OHLCV、约 5000 只股票：5 × 5000 × 2500 × 4B ≈ 250MB
+"""
+
+import numpy as np
+import pandas as pd
+
+
+class MarketPanel:
+    """字段 × 股票 × 交易日 的 float32 面板"""
+
+    def __init__(self, values, fields, instruments, calendar, valid_bits=None):
+        """
+        Args:
+            values: float32 数组，形状 (n_fields, n_instruments, n_dates)
+            fields: 字段名列表
+            instruments: 股票代码列表，下标即整数编码
+            calendar: 交易日历 DatetimeIndex
+            valid_bits: np.packbits 压缩后的有效性掩码，形状 (n_instruments, ceil(n_dates / 8))；
+                        为空时按“任一字段非 NaN”计算
+        """
+        self.values = values
+        self.fields = list(fields)
+        self.instruments = np.asarray(instruments)
+        self.calendar = pd.DatetimeIndex(calendar)
+        self.field_index = {name: i for i, name in enumerate(self.fields)}
+        self.inst_index = {name: i for i, name in enumerate(self.instruments.tolist())}
+        if valid_bits is None:
+            valid_bits = np.packbits(~np.isnan(values).all(axis=0), axis=-1)
+        self.valid_bits = valid_bits
+
+    @property
+    def shape(self):
+        return self.values.shape
+
+    @property
+    def nbytes(self):
+        return self.values.nbytes + self.valid_bits.nbytes
+
+    @property
+    def valid(self):
+        """解压后的布尔掩码 (n_instruments, n_dates)"""
+        return np.unpackbits(self.valid_bits, axis=-1, count=len(self.calendar)).astype(bool)
+
+    def field(self, name):
+        """单个字段的 (n_instruments, n_dates) 视图"""
+        return self.values[self.field_index[name]]
+
+    def cross_section(self, name, date):
+        """某交易日所有股票的字段值，返回以股票代码为索引的 Series"""
+        col = self.calendar.get_loc(pd.Timestamp(date))
+        return pd.Series(self.field(name)[:, col], index=self.instruments, name=name)
+
+    @classmethod
+    def empty(cls, fields, instruments, calendar):
+        values = np.full((len(fields), len(instruments), len(calendar)), np.nan, dtype=np.float32)
+        return cls(values, fields, instruments, calendar,
+                   valid_bits=np.zeros((len(instruments), (len(calendar) + 7) // 8), dtype=np.uint8))
+
+    def fill_from_frame(self, df, fields=None, update_valid=True):
+        """
+        把 D.features 风格的 DataFrame 写入面板中对应位置（面板日历/股票之外的行忽略）
+        Args:
+            df: (instrument, datetime) MultiIndex 的 DataFrame
+            fields: df 各列对应的字段名，默认使用 df.columns
+            update_valid: 是否重新计算有效性掩码；分段填充时可在最后统一计算
+        """
+        fields = list(fields or df.columns)
+        inst_level = df.index.get_level_values('instrument')
+        date_level = df.index.get_level_values('datetime')
+        # 通过 MultiIndex 的整数编码映射，避免逐行处理 Python 对象
+        inst_pos = pd.Index(self.instruments).get_indexer(inst_level)
+        date_pos = self.calendar.get_indexer(date_level)
+        keep = (inst_pos >= 0) & (date_pos >= 0)
+        inst_pos, date_pos = inst_pos[keep], date_pos[keep]
+        block = df.to_numpy(dtype=np.float32)[keep]
+        for j, name in enumerate(fields):
+            self.values[self.field_index[name], inst_pos, date_pos] = block[:, j]
+        if update_valid:
+            self.update_valid()
+        return self
+
+    def update_valid(self):
+        """按“任一字段非 NaN”重新计算有效性掩码"""
+        self.valid_bits = np.packbits(~np.isnan(self.values).all(axis=0), axis=-1)
+
+    @classmethod
+    def from_frame(cls, df, fields=None, calendar=None, instruments=None):
+        """
+        由 D.features 结果构造面板
+        Args:
+            df: (instrument, datetime) MultiIndex 的 DataFrame
+            fields: 字段名，默认使用 df.columns
+            calendar: 共享的交易日历，默认使用 df 中出现的日期
+            instruments: 股票列表，默认使用 df 中出现的股票
+        """
+        fields = list(fields or df.columns)
+        if instruments is None:
+            instruments = df.index.get_level_values('instrument').unique().sort_values()
+        if calendar is None:
+            calendar = df.index.get_level_values('datetime').unique().sort_values()
+        return cls.empty(fields, instruments, calendar).fill_from_frame(df, fields)
+
+    def to_frame(self, fields=None, dropna=True):
+        """
+        转回 qlib 的 (instrument, datetime) MultiIndex DataFrame
+        返回的是新的 DataFrame，各列保持 float32：
+        - dropna 时按有效性掩码取出有效的 (股票, 交易日)，每个字段复制一次，MultiIndex 也只包含这些行
+        - 不 dropna 时列为面板的 reshape 视图；只取一个字段时不复制，多个字段时 pandas 合并列会复制一次
+        Args:
+            fields: 需要的字段，默认全部
+            dropna: 是否去掉无效的 (股票, 交易日)
+        """
+        fields = list(fields or self.fields)
+        if dropna:
+            # 按行优先取非零位置，得到的就是 instrument 优先、交易日升序的行顺序
+            inst_codes, date_codes = np.nonzero(self.valid)
+            columns = {name: self.field(name)[inst_codes, date_codes] for name in fields}
+        else:
+            n_inst, n_dates = len(self.instruments), len(self.calendar)
+            inst_codes = np.repeat(np.arange(n_inst), n_dates)
+            date_codes = np.tile(np.arange(n_dates), n_inst)
+            columns = {name: self.field(name).reshape(-1) for name in fields}
+        index = pd.MultiIndex(
+            levels=[pd.Index(self.instruments, name='instrument'), self.calendar.rename('datetime')],
+            codes=[inst_codes, date_codes],
+            names=['instrument', 'datetime'],
+        )
+        return pd.DataFrame(columns, index=index, copy=False)
+
+    def save(self, path):
+        """保存为未压缩的 .npz"""
+        np.savez(path, values=self.values, fields=np.asarray(self.fields),
+                 instruments=self.instruments.astype(str),
+                 calendar=self.calendar.values.astype('datetime64[ns]'), valid_bits=self.valid_bits)
+
+    @classmethod
+    def load(cls, path):
+        data = np.load(path, allow_pickle=False)
+        return cls(data["values"], data["fields"].tolist(), data["instruments"],
+                   pd.DatetimeIndex(data["calendar"]), valid_bits=data["valid_bits"])
+
+
+def load_panel(instruments, fields, start_time, end_time, chunk_days=250, names=None):
+    """
+    分段调用 D.features 直接填充面板，避免整段 DataFrame 同时驻留内存（调用前需已 qlib.init）
+    Args:
+        instruments: 股票列表
+        fields: qlib 表达式列表
+        start_time, end_time: 时间区间
+        chunk_days: 每次加载的交易日数
+        names: 字段名，默认与表达式相同
+    Returns:
+        MarketPanel
+    """
+    from qlib.data import D
+
+    names = list(names or fields)
+    calendar = pd.DatetimeIndex(D.calendar(start_time=start_time, end_time=end_time))
+    panel = MarketPanel.empty(names, sorted(instruments), calendar)
+    for begin in range(0, len(calendar), chunk_days):
+        end = min(begin + chunk_days, len(calendar)) - 1
+        df = D.features(instruments=list(instruments), fields=list(fields),
+                        start_time=calendar[begin], end_time=calendar[end])
+        if df is None or df.empty:
+            continue
+        df.columns = names
+        panel.fill_from_frame(df, names, update_valid=False)
+    panel.update_valid()
+    return panel
@@ -0,0 +1,181 @@
+"""
+多策略回测
+多个策略声明各自需要的因子，运行器把所有因子组成依赖图，每个因子只加载 / 计算一次，各策略在共享的面板上选股和模拟：
+- 表达式因子（qlib 表达式）去重后合并为一次 D.features 调用
+- 派生因子由其他因子的面板计算（如 均值回归的偏离度 = (收盘价 - 20日均线) / 20日标准差），按拓扑顺序计算
+- 每个策略只执行自己的打分、选股（universe.top_k_by_date）和组合模拟（backtest_kernels）
+增加一个策略的开销只有它自己的逻辑，以及它独有的因子
+用法: python multi_strategy.py --start 2024-01-01 --end 2024-12-31 --strategies momentum,mean_reversion
+"""
+
+import argparse
+from collections import namedtuple
+
+import pandas as pd
+
+from backtest_kernels import simulate_portfolio_fast
+from profiling import profile_run, span
+from qlib_backtest_simple import compute_metrics
+from universe import top_k_by_date
+
+PROVIDER_URI = "/Users/Zeyu/Documents/q_trade/qlibx/data/qlib_data/cn_data"
+
+STOCK_POOL = [
+    "SH600000", "SH600036", "SH601318", "SH600519",
+    "SH600030", "SH601166", "SH601288", "SH600887",
+    "SH601398", "SH601939", "SH600016", "SH601328"
+]
+
+# 因子：expr 为 qlib 表达式；或 func + deps，由依赖因子的面板（交易日 × 股票 的 DataFrame）计算
+Factor = namedtuple("Factor", ["name", "expr", "func", "deps"])
+# 策略：按 factor 列选股，ascending 为 True 时选因子值最小的 top_k 只
+Strategy = namedtuple("Strategy", ["name", "factor", "top_k", "rebalance_freq", "ascending"])
+
+
+def expr_factor(name, expr):
+    return Factor(name, expr, None, ())
+
+
+def derived_factor(name, func, deps):
+    return Factor(name, None, func, tuple(deps))
+
+
+# 收盘价始终加载，用于组合模拟
+CLOSE = "close"
+
+FACTORS = {f.name: f for f in [
+    expr_factor(CLOSE, "$close"),
+    expr_factor("return_20d", "$close / Ref($close, 20) - 1"),
+    expr_factor("ma20", "Mean($close, 20)"),
+    expr_factor("std20", "Std($close, 20)"),
+    derived_factor("deviation", lambda p: (p[CLOSE] - p["ma20"]) / p["std20"], [CLOSE, "ma20", "std20"]),
+]}
+
+STRATEGIES = {s.name: s for s in [
+    # 动量：20 日收益率最高的股票（教程 4.1、run_backtest）
+    Strategy("momentum", "return_20d", top_k=3, rebalance_freq=5, ascending=False),
+    # 均值回归：相对 20 日均线偏离最负（最超卖）的股票（教程 4.2）
+    Strategy("mean_reversion", "deviation", top_k=3, rebalance_freq=5, ascending=True),
+]}
+
+
+def resolve_factors(names, factors=FACTORS):
+    """
+    按依赖关系展开并排序
+    Args:
+        names: 需要的因子名
+        factors: {因子名: Factor}
+    Returns:
+        拓扑顺序的因子列表（依赖在前），每个因子只出现一次
+    """
+    order, state = [], {}   # state: 1 = 访问中, 2 = 已完成
+
+    def visit(name, path):
+        if state.get(name) == 2:
+            return
+        if state.get(name) == 1:
+            raise ValueError(f"因子依赖存在环: {' -> '.join(path + [name])}")
+        if name not in factors:
+            raise KeyError(f"未定义的因子: {name}")
+        state[name] = 1
+        for dep in factors[name].deps:
+            visit(dep, path + [name])
+        state[name] = 2
+        order.append(factors[name])
+
+    for name in names:
+        visit(name, [])
+    return order
+
+
+def load_panels(factor_list, instruments, start_time, end_time):
+    """
+    一次 D.features 加载全部表达式因子，再按顺序计算派生因子（调用前需已 qlib.init）
+    Args:
+        factor_list: resolve_factors 的结果
+    Returns:
+        (panels, frame)
+        panels: {因子名: 交易日 × 股票 的 DataFrame}
+        frame: D.features 的原始结果（(instrument, datetime) 索引，列为表达式）
+    """
+    from qlib.data import D
+
+    # 相同表达式只加载一次，多个名字共用
+    exprs = list(dict.fromkeys(f.expr for f in factor_list if f.expr is not None))
+    with span("D.features"):
+        frame = D.features(instruments=instruments, fields=exprs, start_time=start_time, end_time=end_time)
+    frame.columns = exprs
+    wide = frame.unstack(level='instrument')
+
+    panels = {}
+    for factor in factor_list:
+        if factor.expr is not None:
+            panels[factor.name] = wide[factor.expr]
+        else:
+            with span(f"factor:{factor.name}"):
+                panels[factor.name] = factor.func({dep: panels[dep] for dep in factor.deps})
+    return panels, frame
+
+
+def _to_long(panel, name):
+    long = panel.stack().dropna().swaplevel().sort_index().to_frame(name)
+    long.index.names = ['instrument', 'datetime']
+    return long
+
+
+def run_strategies(strategies, instruments=STOCK_POOL, start_time="2024-01-01", end_time="2024-12-31",
+                   init_cash=1000000, factors=FACTORS):
+    """
+    在共享的因子面板上回测多个策略（调用前需已 qlib.init）
+    Args:
+        strategies: Strategy 列表
+        instruments: 股票池
+        start_time, end_time: 回测区间
+        init_cash: 每个策略的初始资金
+        factors: 因子定义
+    Returns:
+        {策略名: (result_df, metrics)}，result_df 以日期为索引、含 portfolio_value 列
+    """
+    needed = [CLOSE] + [s.factor for s in strategies]
+    panels, frame = load_panels(resolve_factors(needed, factors), instruments, start_time, end_time)
+
+    price_data = frame[[factors[CLOSE].expr]]
+    price_data.columns = [CLOSE]
+    trade_dates = frame.index.get_level_values('datetime').unique().sort_values()
+
+    results = {}
+    for strategy in strategies:
+        with span(f"strategy:{strategy.name}"):
+            scores = _to_long(panels[strategy.factor], "score")
+            selections = top_k_by_date(scores, strategy.top_k, dates=trade_dates, ascending=strategy.ascending)
+            state = {"cash": init_cash, "holdings": {}, "day_index": 0}
+            dates, values = simulate_portfolio_fast(scores, price_data, trade_dates, state, strategy.top_k,
+                                                    strategy.rebalance_freq, selections=selections)
+        result_df = pd.DataFrame({'portfolio_value': values}, index=pd.DatetimeIndex(dates, name='date'))
+        results[strategy.name] = (result_df, compute_metrics(result_df, init_cash))
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="多策略回测（共享数据加载和因子计算）")
+    parser.add_argument("--start", default="2024-01-01")
+    parser.add_argument("--end", default="2024-12-31")
+    parser.add_argument("--strategies", default=",".join(STRATEGIES), help="逗号分隔的策略名")
+    parser.add_argument("--market", default=None, help="使用 qlib 市场作为股票池，如 csi300；默认固定股票池")
+    parser.add_argument("--provider-uri", default=PROVIDER_URI)
+    parser.add_argument("--profile", nargs="?", const="profiles", default=None, metavar="DIR",
+                        help="开启剖析并把结果写入 DIR（也可设置环境变量 QTRADE_PROFILE）")
+    args = parser.parse_args()
+
+    import qlib
+    from qlib.config import REG_CN
+    from qlib.data import D
+
+    selected = [STRATEGIES[name] for name in args.strategies.split(",")]
+    with profile_run("multi_strategy", args.profile):
+        qlib.init(provider_uri=args.provider_uri, region=REG_CN)
+        pool = D.instruments(args.market) if args.market else STOCK_POOL
+        results = run_strategies(selected, pool, args.start, args.end)
+    for name, (_, metrics) in results.items():
+        print(f"{name}: 总收益 {metrics['total_return']:.2%}, 年化 {metrics['annualized_return']:.2%}, "
+              f"夏普 {metrics['sharpe_ratio']:.2f}, 最大回撤 {metrics['max_drawdown']:.2%}")
@@ -0,0 +1,457 @@
+"""
+订单管理
+- 线程池并发下单，令牌桶限速
+- 客户端幂等键：同一笔意图的订单重试不会重复成交
+- 内存中跟踪订单状态，一次查询当日委托批量刷新所有未完成订单
+- 成交（含部分成交）通过 on_fill 回调通知，用于记录真实成交
+- 订单结束（全部成交、撤单、废单、提交失败）通过 on_close 回调通知，用于释放风控中的未完成订单
+"""
+
+import hashlib
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+# 订单状态
+STATUS_PENDING = "pending"        # 已创建，尚未得到网关确认
+STATUS_SUBMITTED = "submitted"    # 已报
+STATUS_PARTIAL = "partial"        # 部分成交
+STATUS_FILLED = "filled"          # 全部成交
+STATUS_CANCELLED = "cancelled"    # 已撤 / 部撤
+STATUS_REJECTED = "rejected"      # 废单或多次提交失败
+
+FINAL_STATUSES = (STATUS_FILLED, STATUS_CANCELLED, STATUS_REJECTED)
+
+# 未对应到委托的订单超过该时间（秒）仍未在当日委托中出现时，视为未落地并结束跟踪
+UNMATCHED_TIMEOUT_SEC = 120
+
+# 网关委托状态 entrustStatus -> 本地状态
+GATEWAY_STATUS_MAP = {
+    "0": STATUS_SUBMITTED,  # 未报
+    "1": STATUS_SUBMITTED,  # 待报
+    "2": STATUS_SUBMITTED,  # 已报
+    "3": STATUS_SUBMITTED,  # 已报待撤
+    "4": STATUS_PARTIAL,    # 部成待撤
+    "5": STATUS_CANCELLED,  # 部撤
+    "6": STATUS_CANCELLED,  # 已撤
+    "7": STATUS_PARTIAL,    # 部成
+    "8": STATUS_FILLED,     # 已成
+    "9": STATUS_REJECTED,   # 废单
+}
+
+
+def make_idempotency_key(trade_date, symbol, side, quantity, price):
+    """
+    生成客户端幂等键：同一交易日、同一标的、同方向、同数量和价格的下单意图视为同一笔订单
+    Args:
+        trade_date: 交易日（date 或字符串）
+        symbol: 股票代码
+        side: "1" 买入 / "2" 卖出
+        quantity: 委托数量
+        price: 委托价格
+    Returns:
+        16 位十六进制字符串
+    """
+    raw = f"{trade_date}|{symbol}|{side}|{quantity}|{price}"
+    return hashlib.sha1(raw.encode('utf-8')).hexdigest()[:16]
+
+
+class RateLimiter:
+    """令牌桶限速器，线程安全"""
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.capacity = float(burst if burst is not None else max(1, rate))
+        self._tokens = self.capacity
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """阻塞直到拿到一个令牌"""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+                self._last = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+class ManagedOrder:
+    """本地跟踪的一笔订单"""
+
+    def __init__(self, key, symbol, side, quantity, price, entrust_type, context=None):
+        self.key = key
+        self.symbol = symbol
+        self.side = side
+        self.quantity = quantity
+        self.price = price
+        self.entrust_type = entrust_type
+        self.context = context or {}  # 调用方附带的信息，如下单时的成交量
+        self.status = STATUS_PENDING
+        self.entrust_id = None
+        self.ack = None
+        self.filled_quantity = 0
+        self.avg_fill_price = 0.0
+        self.attempts = 0
+        self.created_at = time.time()
+        self.updated_at = self.created_at
+
+    @property
+    def is_open(self):
+        return self.status not in FINAL_STATUSES
+
+    def to_dict(self):
+        return {
+            "key": self.key,
+            "symbol": self.symbol,
+            "side": self.side,
+            "quantity": self.quantity,
+            "price": self.price,
+            "status": self.status,
+            "entrust_id": self.entrust_id,
+            "filled_quantity": self.filled_quantity,
+            "avg_fill_price": self.avg_fill_price,
+        }
+
+
+def _extract_entrust_id(data):
+    if isinstance(data, dict):
+        for field in ("entrustId", "entrustNo", "orderId"):
+            if data.get(field):
+                return str(data[field])
+    return None
+
+
+class OrderManager:
+    """并发下单与订单状态跟踪"""
+
+    def __init__(self, api, exchange_type="P", max_workers=4, max_orders_per_sec=5.0,
+                 max_submit_attempts=2, on_fill=None, on_ack=None, on_close=None):
+        """
+        Args:
+            api: HuashengGatewayAPI 实例
+            exchange_type: 交易所类型
+            max_workers: 并发下单线程数
+            max_orders_per_sec: 下单速率上限
+            max_submit_attempts: 单笔订单最多提交次数（含首次）
+            on_fill: 成交回调 on_fill(order, fill_quantity, fill_price)
+            on_ack: 订单与网关委托对应上（得到 entrust_id）时的回调 on_ack(order)，如保存状态快照
+            on_close: 订单进入终态（成交、撤单、废单、提交失败）时的回调 on_close(order)，每笔订单只调用一次
+        """
+        self.api = api
+        self.exchange_type = exchange_type
+        self.max_submit_attempts = max_submit_attempts
+        self.on_fill = on_fill
+        self.on_ack = on_ack
+        self.on_close = on_close
+        self.rate_limiter = RateLimiter(max_orders_per_sec)
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="order")
+        self._orders = {}          # key -> ManagedOrder
+        self._by_entrust_id = {}   # entrust_id -> ManagedOrder
+        self._lock = threading.RLock()
+
+    def submit(self, symbol, side, quantity, price, entrust_type="3", key=None, trade_date=None, context=None):
+        """
+        异步提交订单；相同幂等键的订单只会提交一次，之前的订单没有任何成交就结束时可以重新提交
+        Args:
+            symbol: 股票代码
+            side: "1" 买入 / "2" 卖出
+            quantity: 委托数量
+            price: 委托价格
+            entrust_type: 委托类型
+            key: 幂等键，默认由交易日、标的、方向、数量、价格生成
+            trade_date: 交易日，用于生成默认幂等键
+            context: 附加信息，成交回调时原样带回
+        Returns:
+            (ManagedOrder, Future 或 None)，重复提交时 Future 为 None
+        """
+        if key is None:
+            key = make_idempotency_key(trade_date or time.strftime('%Y-%m-%d'), symbol, side, quantity, price)
+
+        with self._lock:
+            existing = self._orders.get(key)
+            # 没有任何成交就结束（废单、撤单、提交失败）的订单可以用同一个键重新提交
+            if existing is not None and (existing.is_open or existing.filled_quantity > 0):
+                logger.info("重复下单已忽略: %s key=%s status=%s", symbol, key, existing.status)
+                return existing, None
+            order = ManagedOrder(key, symbol, side, quantity, price, entrust_type, context)
+            self._orders[key] = order
+
+        return order, self._executor.submit(self._submit, order)
+
+    def _submit(self, order):
+        while order.attempts < self.max_submit_attempts:
+            if order.attempts > 0:
+                # 上一次提交结果未知（超时等），先查当日委托确认是否已经落地，避免重复成交
+                if self._recover_from_gateway(order):
+                    return order
+            order.attempts += 1
+            self.rate_limiter.acquire()
+            result = self.api.place_order(
+                exchangeType=self.exchange_type,
+                stock_code=order.symbol,
+                entrustAmount=order.quantity,
+                entrustPrice=order.price,
+                entrustBs=order.side,
+                entrustType=order.entrust_type,
+            )
+            if result:
+                self._mark_submitted(order, result, _extract_entrust_id(result))
+                return order
+
+        with self._lock:
+            order.status = STATUS_REJECTED
+            order.updated_at = time.time()
+        logger.error("下单失败: %s key=%s, 已尝试 %s 次", order.symbol, order.key, order.attempts)
+        self._notify_close(order)
+        return order
+
+    def _mark_submitted(self, order, ack, entrust_id):
+        with self._lock:
+            order.ack = ack
+            order.entrust_id = entrust_id
+            if order.status == STATUS_PENDING:
+                order.status = STATUS_SUBMITTED
+            order.updated_at = time.time()
+            if entrust_id:
+                self._by_entrust_id[entrust_id] = order
+        if not entrust_id:
+            # 已报但回报中没有委托号：按 股票、方向、数量、价格 在当日委托中查找，
+            # 找不到时保持为未对应的订单，由 poll_open_orders 继续查找
+            logger.warning("下单回报中没有委托号: %s key=%s, 从当日委托中查找", order.symbol, order.key)
+            self._recover_from_gateway(order)
+            return
+        self._notify_ack(order)
+
+    def _notify_ack(self, order):
+        if self.on_ack:
+            try:
+                self.on_ack(order)
+            except Exception as e:
+                logger.error("委托确认回调异常: %s, %s", order.symbol, e)
+
+    def _notify_close(self, order):
+        if self.on_close:
+            try:
+                self.on_close(order)
+            except Exception as e:
+                logger.error("订单结束回调异常: %s, %s", order.symbol, e)
+
+    @staticmethod
+    def _matches(order, entrust):
+        try:
+            return (entrust.get("stockCode") == order.symbol
+                    and str(entrust.get("entrustBs")) == order.side
+                    and int(float(entrust.get("entrustAmount", 0))) == int(order.quantity)
+                    and abs(float(entrust.get("entrustPrice", 0)) - float(order.price)) < 1e-6)
+        except (TypeError, ValueError):
+            return False
+
+    def _unmatched_orders(self):
+        """已报（或从快照恢复）但还没有对应到网关委托的未完成订单；PENDING 的订单仍在提交中，不在其中"""
+        return [o for o in self._orders.values()
+                if o.is_open and o.entrust_id is None and o.status != STATUS_PENDING]
+
+    def _attach_unmatched(self, entrusts):
+        """
+        把未对应的订单按属性对应到当日委托；已成交数量保持本地值（通常为 0），之后的轮询按增量记录成交
+        调用方需持有 self._lock
+        Returns:
+            (本次对应上的订单, 超时视为未落地的订单)
+        """
+        attached, expired = [], []
+        unmatched = self._unmatched_orders()
+        if not unmatched:
+            return attached, expired
+        for entrust in entrusts:
+            entrust_id = _extract_entrust_id(entrust)
+            if not entrust_id or entrust_id in self._by_entrust_id:
+                continue
+            for order in unmatched:
+                if order.entrust_id is None and self._matches(order, entrust):
+                    logger.info("未对应的订单找到委托: %s key=%s entrust_id=%s", order.symbol, order.key, entrust_id)
+                    order.entrust_id = entrust_id
+                    order.ack = order.ack or entrust
+                    order.updated_at = time.time()
+                    self._by_entrust_id[entrust_id] = order
+                    attached.append(order)
+                    break
+        now = time.time()
+        for order in unmatched:
+            if order.entrust_id is None and now - order.updated_at > UNMATCHED_TIMEOUT_SEC:
+                logger.warning("订单 %s key=%s 在 %ss 内未出现在当日委托中，视为未落地",
+                               order.symbol, order.key, UNMATCHED_TIMEOUT_SEC)
+                order.status = STATUS_REJECTED
+                order.updated_at = now
+                expired.append(order)
+        return attached, expired
+
+    def _recover_from_gateway(self, order):
+        entrusts = self.api.get_today_entrusts(self.exchange_type)
+        if not entrusts:
+            return False
+        with self._lock:
+            known_ids = set(self._by_entrust_id)
+        for entrust in entrusts.get("entrustList", []):
+            entrust_id = _extract_entrust_id(entrust)
+            if not entrust_id or entrust_id in known_ids:
+                continue
+            if self._matches(order, entrust):
+                logger.info("在当日委托中找到已提交订单: %s key=%s entrust_id=%s", order.symbol, order.key, entrust_id)
+                self._mark_submitted(order, entrust, entrust_id)
+                return True
+        return False
+
+    def adopt_today_entrusts(self, symbols=None, trade_date=None):
+        """
+        从当日委托恢复订单跟踪，用于进程重启：
+        已在网关的委托不会被再次提交，已成交部分也不会被重复记录
+        Args:
+            symbols: 只接管这些股票的委托，None 表示全部
+            trade_date: 交易日，用于生成幂等键
+        Returns:
+            接管的委托数
+        """
+        entrusts = self.api.get_today_entrusts(self.exchange_type)
+        if not entrusts:
+            return 0
+        trade_date = trade_date or time.strftime('%Y-%m-%d')
+        adopted = 0
+        with self._lock:
+            # 快照中提交结果未知的订单先对应到委托，已成交数量从 0 开始，由下一次轮询记录成交
+            attached, expired = self._attach_unmatched(entrusts.get("entrustList", []))
+            for entrust in entrusts.get("entrustList", []):
+                entrust_id = _extract_entrust_id(entrust)
+                symbol = entrust.get("stockCode")
+                if not entrust_id or entrust_id in self._by_entrust_id:
+                    continue
+                if symbols is not None and symbol not in symbols:
+                    continue
+                side = str(entrust.get("entrustBs"))
+                quantity = int(float(entrust.get("entrustAmount", 0)))
+                price = entrust.get("entrustPrice")
+                key = make_idempotency_key(trade_date, symbol, side, quantity, price)
+                order = ManagedOrder(key, symbol, side, quantity, price, entrust.get("entrustType", "3"),
+                                     {"action": "buy" if side == "1" else "sell", "adopted": True})
+                order.entrust_id = entrust_id
+                order.ack = entrust
+                order.status = GATEWAY_STATUS_MAP.get(str(entrust.get("entrustStatus")), STATUS_SUBMITTED)
+                order.filled_quantity = int(float(entrust.get("businessAmount", 0) or 0))
+                order.avg_fill_price = float(entrust.get("businessPrice", 0) or 0)
+                self._orders[key] = order
+                self._by_entrust_id[entrust_id] = order
+                adopted += 1
+        for order in attached:
+            self._notify_ack(order)
+        for order in expired:
+            self._notify_close(order)
+        if adopted:
+            logger.info("已从当日委托恢复 %s 笔订单", adopted)
+        return adopted + len(attached)
+
+    def restore(self, orders):
+        """
+        从状态快照恢复未完成订单（见 strategy_state.py），不访问网关；
+        之后由 poll_open_orders 按当日委托校正状态，已成交部分不会被重复记录
+        Args:
+            orders: [ManagedOrder.to_dict() + entrust_type、context, ...]
+        Returns:
+            恢复的订单数；没有 entrust_id 的订单（提交结果未知）作为未对应的订单恢复，已成交数量为 0，
+            由 adopt_today_entrusts 或 poll_open_orders 按 股票、方向、数量、价格 对应到委托后记录全部成交
+        """
+        restored = 0
+        with self._lock:
+            for data in orders:
+                entrust_id = data.get("entrust_id")
+                if data["key"] in self._orders or (entrust_id and entrust_id in self._by_entrust_id):
+                    continue
+                order = ManagedOrder(data["key"], data["symbol"], data["side"], data["quantity"], data["price"],
+                                     data.get("entrust_type", "3"), data.get("context"))
+                order.entrust_id = entrust_id or None
+                if entrust_id:
+                    order.status = data.get("status", STATUS_SUBMITTED)
+                    order.filled_quantity = int(data.get("filled_quantity", 0))
+                    order.avg_fill_price = float(data.get("avg_fill_price", 0.0))
+                    self._by_entrust_id[entrust_id] = order
+                else:
+                    # 提交线程已随进程退出，不再是 PENDING
+                    order.status = STATUS_SUBMITTED
+                self._orders[order.key] = order
+                restored += 1
+        if restored:
+            logger.info("已从状态快照恢复 %s 笔订单", restored)
+        return restored
+
+    def poll_open_orders(self):
+        """
+        一次查询当日委托，批量刷新所有未完成订单的状态，并对新增成交触发 on_fill
+        Returns:
+            本次产生新成交的订单数
+        """
+        with self._lock:
+            has_open = any(o.is_open for o in self._by_entrust_id.values()) or bool(self._unmatched_orders())
+        if not has_open:
+            return 0
+
+        entrusts = self.api.get_today_entrusts(self.exchange_type)
+        if not entrusts:
+            return 0
+
+        fills = []
+        with self._lock:
+            entrust_list = entrusts.get("entrustList", [])
+            attached, closed = self._attach_unmatched(entrust_list)
+            open_orders = {eid: o for eid, o in self._by_entrust_id.items() if o.is_open}
+            for entrust in entrust_list:
+                order = open_orders.get(_extract_entrust_id(entrust))
+                if order is None:
+                    continue
+                filled = int(float(entrust.get("businessAmount", 0) or 0))
+                fill_price = float(entrust.get("businessPrice", 0) or 0)
+                status = GATEWAY_STATUS_MAP.get(str(entrust.get("entrustStatus")), order.status)
+
+                if filled > order.filled_quantity:
+                    new_qty = filled - order.filled_quantity
+                    # businessPrice 为成交均价，由此推算本次增量的成交价
+                    prev_notional = order.filled_quantity * order.avg_fill_price
+                    new_price = (filled * fill_price - prev_notional) / new_qty if fill_price else order.price
+                    order.filled_quantity = filled
+                    order.avg_fill_price = fill_price or order.avg_fill_price
+                    fills.append((order, new_qty, float(new_price)))
+                order.status = status
+                order.updated_at = time.time()
+                if not order.is_open:
+                    closed.append(order)
+
+        for order in attached:
+            self._notify_ack(order)
+        for order, qty, price in fills:
+            logger.info("订单成交: %s key=%s 数量=%s 价格=%.4f 状态=%s", order.symbol, order.key, qty, price, order.status)
+            if self.on_fill:
+                try:
+                    self.on_fill(order, qty, price)
+                except Exception as e:
+                    logger.error("成交回调异常: %s, %s", order.symbol, e)
+        # 成交回调之后再通知结束，最后一笔成交已记录
+        for order in closed:
+            self._notify_close(order)
+        return len(fills)
+
+    def has_open_order(self, symbol, side=None):
+        with self._lock:
+            return any(o.is_open and o.symbol == symbol and (side is None or o.side == side)
+                       for o in self._orders.values())
+
+    def open_orders(self):
+        with self._lock:
+            return [o for o in self._orders.values() if o.is_open]
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait)
@@ -0,0 +1,302 @@
+"""
+可选的运行剖析
+默认关闭；通过环境变量 QTRADE_PROFILE=<输出目录>（或 1，输出到 profiles/）或各脚本的 --profile 参数开启：
+- span(name): 记录某个阶段的耗时（如 qlib 初始化、D.features、调仓循环、网关请求、CSV 写入），可嵌套
+- phase(name): 顺序阶段，开始下一阶段时自动结束上一阶段，适合教程这类线性脚本
+- 后台线程定时采样各线程的调用栈，只采样处于某个 span 中的线程（交易程序空闲等待时不计入）
+- 结束时写出:
+    <name>-<时间>.folded        采样调用栈，折叠格式（flamegraph.pl / speedscope 可直接读取）
+    <name>-<时间>.spans.folded  各阶段的独占耗时（微秒），折叠格式
+    <name>-<时间>.spans.json    各阶段的次数、总耗时、最大耗时
+关闭时 span() 直接返回共享的空上下文，开销只有一次全局变量判断
+"""
+
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from datetime import datetime
+from functools import wraps
+
+PROFILE_ENV = "QTRADE_PROFILE"
+DEFAULT_OUTPUT_DIR = "profiles"
+# 采样间隔（秒）
+DEFAULT_INTERVAL = 0.005
+
+_NULL_SPAN = nullcontext()
+_profiler = None
+
+
+class _Span:
+    __slots__ = ("profiler", "name", "start")
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.profiler._push(self.name)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.profiler._pop(time.perf_counter() - self.start)
+        return False
+
+
+class Profiler:
+    """span 耗时统计 + 调用栈采样"""
+
+    def __init__(self, name, output_dir=DEFAULT_OUTPUT_DIR, interval=DEFAULT_INTERVAL, sample=True):
+        """
+        Args:
+            name: 本次运行的名称，用作输出文件名前缀
+            output_dir: 输出目录
+            interval: 采样间隔（秒）
+            sample: 是否采样调用栈；为 False 时只统计 span
+        """
+        self.name = name
+        self.output_dir = output_dir
+        self.interval = interval
+        self.started_at = datetime.now()
+        self._stats = {}      # span 路径 (外层, ..., 内层) -> [次数, 总耗时, 最大耗时]
+        self._active = {}     # 线程 id -> 当前 span 路径列表
+        self._phases = {}     # 线程 id -> 当前 phase 的 _Span
+        self._stacks = {}     # 折叠后的调用栈 -> 采样次数
+        self.samples = 0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._sampler = None
+        if sample:
+            self._sampler = threading.Thread(target=self._sample_loop, name="profiler-sampler", daemon=True)
+            self._sampler.start()
+
+    # -- span --
+
+    def _push(self, name):
+        ident = threading.get_ident()
+        with self._lock:
+            self._active.setdefault(ident, []).append(name)
+
+    def _pop(self, elapsed):
+        ident = threading.get_ident()
+        with self._lock:
+            path = self._active.get(ident)
+            if not path:
+                return
+            key = tuple(path)
+            path.pop()
+            if not path:
+                del self._active[ident]
+            stat = self._stats.get(key)
+            if stat is None:
+                self._stats[key] = [1, elapsed, elapsed]
+            else:
+                stat[0] += 1
+                stat[1] += elapsed
+                stat[2] = max(stat[2], elapsed)
+
+    def span(self, name):
+        return _Span(self, name)
+
+    def phase(self, name):
+        """结束当前线程的上一个 phase 并开始新的 phase；name 为 None 时只结束"""
+        ident = threading.get_ident()
+        current = self._phases.pop(ident, None)
+        if current is not None:
+            current.__exit__(None, None, None)
+        if name is not None:
+            current = self._phases[ident] = _Span(self, name)
+            current.__enter__()
+
+    # -- 采样 --
+
+    def _sample_loop(self):
+        own = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            frames = sys._current_frames()
+            names = {t.ident: t.name for t in threading.enumerate()}
+            with self._lock:
+                active = {ident: list(path) for ident, path in self._active.items() if ident != own}
+            for ident, path in active.items():
+                frame = frames.get(ident)
+                if frame is None:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                    frame = frame.f_back
+                stack.reverse()
+                key = ";".join([names.get(ident, str(ident))] + [f"[{p}]" for p in path] + stack)
+                self._stacks[key] = self._stacks.get(key, 0) + 1
+                self.samples += 1
+
+    # -- 输出 --
+
+    def stop(self):
+        """结束未关闭的 phase 并停止采样"""
+        for ident in list(self._phases):
+            current = self._phases.pop(ident)
+            if ident == threading.get_ident():
+                current.__exit__(None, None, None)
+        self._stop.set()
+        if self._sampler is not None:
+            self._sampler.join()
+
+    def span_stats(self):
+        """
+        Returns:
+            [{"path", "count", "total_sec", "self_sec", "max_sec"}, ...]，按路径排序
+        """
+        with self._lock:
+            stats = {path: list(stat) for path, stat in self._stats.items()}
+        children = {}
+        for path, (_, total, _) in stats.items():
+            if len(path) > 1:
+                children[path[:-1]] = children.get(path[:-1], 0.0) + total
+        return [{"path": ";".join(path), "count": count, "total_sec": total,
+                 "self_sec": max(0.0, total - children.get(path, 0.0)), "max_sec": longest}
+                for path, (count, total, longest) in sorted(stats.items())]
+
+    def summary(self, limit=20):
+        """按总耗时排序的文本摘要"""
+        rows = sorted(self.span_stats(), key=lambda r: r["total_sec"], reverse=True)[:limit]
+        lines = [f"{'span':<48} {'次数':>8} {'总耗时(s)':>10} {'独占(s)':>10} {'最大(s)':>10}"]
+        for r in rows:
+            lines.append(f"{r['path']:<48} {r['count']:>8} {r['total_sec']:>10.3f} "
+                         f"{r['self_sec']:>10.3f} {r['max_sec']:>10.3f}")
+        return "\n".join(lines)
+
+    def dump(self):
+        """
+        写出采样调用栈和 span 统计
+        Returns:
+            写出的文件路径列表
+        """
+        os.makedirs(self.output_dir, exist_ok=True)
+        prefix = os.path.join(self.output_dir, f"{self.name}-{self.started_at.strftime('%Y%m%d-%H%M%S')}")
+        stats = self.span_stats()
+        paths = []
+
+        if self._sampler is not None:
+            path = prefix + ".folded"
+            with open(path, 'w', encoding='utf-8') as f:
+                for stack, count in sorted(self._stacks.items()):
+                    f.write(f"{stack} {count}\n")
+            paths.append(path)
+
+        path = prefix + ".spans.folded"
+        with open(path, 'w', encoding='utf-8') as f:
+            for r in stats:
+                micros = int(r["self_sec"] * 1e6)
+                if micros > 0:
+                    f.write(f"{r['path']} {micros}\n")
+        paths.append(path)
+
+        path = prefix + ".spans.json"
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump({"name": self.name, "started_at": self.started_at.isoformat(),
+                       "sample_interval": self.interval, "samples": self.samples, "spans": stats},
+                      f, ensure_ascii=False, indent=2)
+        paths.append(path)
+        return paths
+
+
+def requested_dir(output_dir=None):
+    """命令行参数优先，其次环境变量；未开启时返回 None"""
+    if output_dir:
+        return output_dir
+    value = os.environ.get(PROFILE_ENV, "").strip()
+    if not value or value.lower() in ("0", "false", "no", "off"):
+        return None
+    return DEFAULT_OUTPUT_DIR if value.lower() in ("1", "true", "yes", "on") else value
+
+
+def enable(name, output_dir=None, interval=DEFAULT_INTERVAL, sample=True):
+    """开启全局剖析；output_dir 为空且未设置环境变量时不开启，返回 None"""
+    global _profiler
+    output_dir = requested_dir(output_dir)
+    if output_dir is None:
+        return None
+    _profiler = Profiler(name, output_dir, interval, sample)
+    return _profiler
+
+
+def disable():
+    """
+    关闭全局剖析并写出结果
+    Returns:
+        写出的文件路径列表，未开启时为空
+    """
+    global _profiler
+    profiler, _profiler = _profiler, None
+    if profiler is None:
+        return []
+    profiler.stop()
+    return profiler.dump()
+
+
+def active():
+    return _profiler
+
+
+def span(name):
+    """阶段耗时；未开启剖析时返回空上下文"""
+    if _profiler is None:
+        return _NULL_SPAN
+    return _profiler.span(name)
+
+
+def phase(name):
+    """顺序阶段；未开启剖析时不做任何事"""
+    if _profiler is not None:
+        _profiler.phase(name)
+
+
+def wrap(obj, attr, name=None):
+    """
+    把 obj.attr 替换为带 span 的版本（如 D.features），只在已开启剖析时替换
+    Returns:
+        是否替换
+    """
+    if _profiler is None:
+        return False
+    func = getattr(obj, attr)
+    if getattr(func, "_profiled", False):
+        return False
+    name = name or attr
+
+    @wraps(func)
+    def traced(*args, **kwargs):
+        with span(name):
+            return func(*args, **kwargs)
+
+    traced._profiled = True
+    setattr(obj, attr, traced)
+    return True
+
+
+@contextmanager
+def profile_run(name, output_dir=None, interval=DEFAULT_INTERVAL):
+    """
+    以 name 为根 span 剖析一次运行，结束时写出结果并打印摘要
+    未开启剖析时只执行 with 块
+    """
+    profiler = enable(name, output_dir, interval)
+    if profiler is None:
+        yield None
+        return
+    try:
+        with profiler.span(name):
+            try:
+                yield profiler
+            finally:
+                profiler.phase(None)
+    finally:
+        paths = disable()
+        print(profiler.summary())
+        for path in paths:
+            print(f"剖析结果: {path}")
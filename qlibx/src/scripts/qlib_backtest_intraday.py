@@ -0,0 +1,262 @@
+"""
+Qlib 分钟级回测 - 收盘前决策
+用 1 分钟数据回测交易程序（tqqq_trading_bot.py）的规则：每个交易日在收盘前 offset 分钟按当时价格决策
+- 买入: 价格 <= buy_point，且满足 buy_day_interval / buy_price_interval；限价单 last_price - 1（或 buy_limit_price）
+- 卖出: 价格 >= sell_point 且可卖数量足够；限价单 last_price + 1（或 sell_limit_price）
+- 限价单在决策之后到收盘前的分钟线触及限价时按限价成交，否则当日撤单
+- max_position 按 持仓市值 / 账户权益 检查（与 risk.py 一致）
+
+数据分两步处理：
+1. 按 股票块 × 交易日块 流式加载分钟数据，每块只提取每日的决策价、决策时累计成交量、决策后最高/最低价和收盘价，
+   分钟数据用完即释放；各块相互独立，可在多个进程中并行
+2. 逐日的仓位状态只依赖每日一行的决策数据，各股票独立顺序模拟
+"""
+
+import argparse
+import json
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+import warnings
+warnings.filterwarnings('ignore')
+
+from qlib_backtest_simple import compute_metrics
+from backtest_kernels import simulate_symbol_fast
+
+PROVIDER_URI = "/Users/Zeyu/Documents/q_trade/qlibx/data/qlib_data/us_data_1min"
+
+MINUTE_FIELDS = ["$close", "$volume", "$low", "$high"]
+
+
+def decision_bars(df, offset_minutes=10, close_time="16:00"):
+    """
+    把分钟数据压缩为每日一行的决策数据
+    Args:
+        df: (instrument, datetime) 索引、含 close/volume/low/high 列的分钟数据（时间为美东时间）
+        offset_minutes: 收盘前多少分钟决策
+        close_time: 收盘时间 "HH:MM"
+    Returns:
+        (instrument, date) 索引的 DataFrame，列:
+        decision_price, decision_volume（决策时当日累计成交量）, post_low, post_high（决策之后到收盘）, close
+    """
+    hour, minute = (int(x) for x in close_time.split(":"))
+    cutoff = hour * 60 + minute - offset_minutes
+
+    dt = df.index.get_level_values('datetime')
+    tod = dt.hour * 60 + dt.minute
+    frame = df.copy()
+    frame['instrument'] = df.index.get_level_values('instrument')
+    frame['date'] = dt.normalize()
+    frame['pre'] = tod <= cutoff
+
+    keys = ['instrument', 'date']
+    pre = frame[frame['pre']].groupby(keys, sort=True)
+    post = frame[~frame['pre']].groupby(keys, sort=True)
+    result = pd.DataFrame({
+        'decision_price': pre['close'].last(),
+        'decision_volume': pre['volume'].sum(),
+    })
+    result = result.join(pd.DataFrame({'post_low': post['low'].min(), 'post_high': post['high'].max()}), how='left')
+    result['close'] = frame.groupby(keys, sort=True)['close'].last()
+    return result.dropna(subset=['decision_price'])
+
+
+def iter_chunks(instruments, days, inst_chunk=50, day_chunk=20):
+    """
+    Yields:
+        (股票列表, 起始日, 结束日)
+    """
+    instruments = list(instruments)
+    for i in range(0, len(instruments), inst_chunk):
+        for j in range(0, len(days), day_chunk):
+            block = days[j:j + day_chunk]
+            yield instruments[i:i + inst_chunk], block[0], block[-1]
+
+
+_qlib_ready = False
+
+
+def _init_qlib(provider_uri):
+    global _qlib_ready
+    if not _qlib_ready:
+        import qlib
+        from qlib.config import REG_US
+        qlib.init(provider_uri=provider_uri, region=REG_US)
+        _qlib_ready = True
+
+
+def _extract_chunk(task):
+    """工作进程入口：加载一块分钟数据并压缩为决策数据"""
+    instruments, start, end, offset_minutes, close_time, provider_uri = task
+    _init_qlib(provider_uri)
+    from qlib.data import D
+
+    # 结束日取到当天最后一分钟
+    end_time = pd.Timestamp(end) + pd.Timedelta(days=1) - pd.Timedelta(minutes=1)
+    df = D.features(instruments=instruments, fields=MINUTE_FIELDS, start_time=pd.Timestamp(start),
+                    end_time=end_time, freq="1min")
+    if df is None or df.empty:
+        return None
+    df.columns = ['close', 'volume', 'low', 'high']
+    return decision_bars(df, offset_minutes, close_time)
+
+
+def load_decisions(instruments, start_time, end_time, offset_minutes=10, close_time="16:00",
+                   inst_chunk=50, day_chunk=20, n_jobs=1, provider_uri=PROVIDER_URI):
+    """
+    流式加载分钟数据并提取每日决策数据
+    Args:
+        instruments: 股票列表
+        start_time, end_time: 回测区间
+        offset_minutes: 收盘前多少分钟决策
+        close_time: 收盘时间
+        inst_chunk, day_chunk: 每块的股票数和交易日数，决定单块内存
+        n_jobs: 并行进程数
+        provider_uri: 1 分钟 qlib 数据目录
+    Returns:
+        (instrument, date) 索引的决策数据
+    """
+    _init_qlib(provider_uri)
+    from qlib.data import D
+
+    days = [pd.Timestamp(d) for d in D.calendar(start_time=start_time, end_time=end_time, freq="day")]
+    tasks = [(insts, start, end, offset_minutes, close_time, provider_uri)
+             for insts, start, end in iter_chunks(instruments, days, inst_chunk, day_chunk)]
+    if n_jobs > 1:
+        with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+            parts = list(pool.map(_extract_chunk, tasks))
+    else:
+        parts = [_extract_chunk(task) for task in tasks]
+    parts = [p for p in parts if p is not None and not p.empty]
+    if not parts:
+        return pd.DataFrame(columns=['decision_price', 'decision_volume', 'post_low', 'post_high', 'close'])
+    return pd.concat(parts).sort_index()
+
+
+def _limit(strategy_price, decision_price, step):
+    return strategy_price if strategy_price > 0 else decision_price + step
+
+
+def simulate_symbol(decisions, strategy, init_cash):
+    """
+    按交易程序的规则逐日模拟单只股票
+    Args:
+        decisions: 以日期为索引的决策数据（decision_bars 的单只股票部分）
+        strategy: stock_strategy.json 中该股票的参数
+        init_cash: 分配给该股票的初始资金
+    Returns:
+        (trades, values)
+        trades: [{"date", "action", "quantity", "price"}, ...]
+        values: 以日期为索引的每日收盘市值 Series
+    """
+    cash = float(init_cash)
+    position = 0
+    last_buy_date = None
+    last_buy_price = None
+    trades = []
+    values = []
+
+    for date, row in decisions.iterrows():
+        price = float(row['decision_price'])
+        if price > 0:
+            quantity = int(strategy['buy_total'] / price)
+            if price <= strategy['buy_point']:
+                allowed = quantity > 0
+                day_interval = strategy.get('buy_day_interval', 0)
+                if allowed and day_interval > 0 and last_buy_date is not None:
+                    allowed = (date - last_buy_date).days >= day_interval
+                price_interval = strategy.get('buy_price_interval', 0)
+                if allowed and last_buy_price and price_interval > 0:
+                    allowed = abs((price - last_buy_price) / last_buy_price * 100) >= price_interval
+                limit = _limit(strategy.get('buy_limit_price', 0), price, -1)
+                if allowed:
+                    # 仓位上限：持仓 + 本单 的市值不超过权益的 max_position%
+                    max_position = strategy.get('max_position', 100)
+                    equity = cash + position * price
+                    if max_position < 100 and (position + quantity) * limit > equity * max_position / 100:
+                        allowed = False
+                if allowed and quantity * limit <= cash and row['post_low'] <= limit:
+                    cash -= quantity * limit
+                    position += quantity
+                    # 与交易程序的 on_order_fill 一致，记录成交价（限价）而不是触发价
+                    last_buy_date, last_buy_price = date, limit
+                    trades.append({"date": date, "action": "buy", "quantity": quantity, "price": limit})
+            elif price >= strategy['sell_point'] and 0 < quantity <= position:
+                limit = _limit(strategy.get('sell_limit_price', 0), price, 1)
+                if row['post_high'] >= limit:
+                    cash += quantity * limit
+                    position -= quantity
+                    trades.append({"date": date, "action": "sell", "quantity": quantity, "price": limit})
+        values.append(cash + position * float(row['close']))
+
+    return trades, pd.Series(values, index=decisions.index, name='portfolio_value')
+
+
+def run_intraday_backtest(strategies, start_time, end_time, offset_minutes=10, init_cash=100000,
+                          close_time="16:00", inst_chunk=50, day_chunk=20, n_jobs=1, provider_uri=PROVIDER_URI,
+                          engine="kernel"):
+    """
+    分钟级收盘前决策回测
+    Args:
+        strategies: {股票代码: 策略参数}，格式同 stock_strategy.json
+        start_time, end_time: 回测区间
+        offset_minutes: 收盘前多少分钟决策（交易程序为 10）
+        init_cash: 每只股票分配的初始资金
+        engine: "kernel" 使用 backtest_kernels 的编译内核，"reference" 使用 simulate_symbol（结果相同）
+        其余参数见 load_decisions
+    Returns:
+        (result_df, trades, metrics)
+        result_df: 以日期为索引、含 portfolio_value 列的组合市值
+        trades: {股票代码: 成交列表}
+    """
+    decisions = load_decisions(list(strategies), start_time, end_time, offset_minutes, close_time,
+                               inst_chunk, day_chunk, n_jobs, provider_uri)
+    simulate = simulate_symbol_fast if engine == "kernel" else simulate_symbol
+    all_trades, series = {}, []
+    for symbol, strategy in strategies.items():
+        if symbol not in decisions.index.get_level_values('instrument'):
+            continue
+        trades, values = simulate(decisions.xs(symbol, level='instrument'), strategy, init_cash)
+        all_trades[symbol] = trades
+        series.append(values.rename(symbol))
+
+    if not series:
+        return pd.DataFrame(columns=['portfolio_value']), all_trades, compute_metrics(pd.DataFrame(), init_cash)
+    # 未开始交易或停牌的日期沿用前值，开始前按初始资金计
+    values = pd.concat(series, axis=1).sort_index().ffill().fillna(init_cash)
+    result_df = pd.DataFrame({'portfolio_value': values.sum(axis=1)})
+    result_df.index.name = 'date'
+    metrics = compute_metrics(result_df, init_cash * len(series))
+    return result_df, all_trades, metrics
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Qlib 分钟级回测 - 收盘前决策")
+    parser.add_argument("--start", default="2024-01-01")
+    parser.add_argument("--end", default="2024-12-31")
+    parser.add_argument("--strategy-file", default="stock_strategy.json")
+    parser.add_argument("--offset-minutes", type=int, default=10, help="收盘前多少分钟决策")
+    parser.add_argument("--init-cash", type=float, default=100000, help="每只股票的初始资金")
+    parser.add_argument("--inst-chunk", type=int, default=50, help="每块加载的股票数")
+    parser.add_argument("--day-chunk", type=int, default=20, help="每块加载的交易日数")
+    parser.add_argument("--jobs", type=int, default=1, help="并行加载的进程数")
+    parser.add_argument("--provider-uri", default=PROVIDER_URI, help="1 分钟 qlib 数据目录")
+    parser.add_argument("--engine", choices=["kernel", "reference"], default="kernel", help="逐日模拟的实现")
+    args = parser.parse_args()
+
+    with open(args.strategy_file, 'r', encoding='utf-8') as f:
+        strategies = json.load(f)
+
+    result_df, trades, metrics = run_intraday_backtest(
+        strategies, args.start, args.end, offset_minutes=args.offset_minutes, init_cash=args.init_cash,
+        inst_chunk=args.inst_chunk, day_chunk=args.day_chunk, n_jobs=args.jobs, provider_uri=args.provider_uri,
+        engine=args.engine
+    )
+    for symbol, symbol_trades in trades.items():
+        buys = sum(1 for t in symbol_trades if t["action"] == "buy")
+        print(f"{symbol}: 买入 {buys} 次, 卖出 {len(symbol_trades) - buys} 次")
+    print(f"总收益率: {metrics['total_return']:.2%}")
+    print(f"年化收益率: {metrics['annualized_return']:.2%}")
+    print(f"夏普比率: {metrics['sharpe_ratio']:.2f}")
+    print(f"最大回撤: {metrics['max_drawdown']:.2%}")
+    print(f"交易日数: {metrics['n_days']} 天")
@@ -5,7 +5,6 @@ Qlib 简单回测示例
 
 import qlib
 from qlib.config import REG_CN
-from qlib.data import D
 # from qlib.backtest import backtest, executor # Not used in manual backtest
 # from qlib.contrib.strategy import TopkDropoutStrategy # Not used in manual backtest
 # from qlib.contrib.evaluate import risk_analysis # Not used in manual backtest
@@ -14,9 +13,158 @@ import pandas as pd
 import warnings
 warnings.filterwarnings('ignore')
 import sys
+import argparse
+
+from market_panel import load_panel
+from universe import apply_membership, build_membership_mask, top_k_by_date
+from profiling import profile_run, span
+
+def simulate_portfolio(momentum_data, price_data, trade_dates, state, top_k, rebalance_freq, verbose=False,
+                       selections=None):
+    """
+    逐日模拟等权 TOP_K 动量组合
+    Args:
+        momentum_data: (instrument, datetime) 索引、含 score 列的因子数据
+        price_data: (instrument, datetime) 索引、含 close 列的价格数据
+        trade_dates: 需要模拟的交易日
+        state: 组合状态 {"cash", "holdings", "day_index"}，原地更新，可跨多段数据连续调用
+        top_k: 持仓数量
+        rebalance_freq: 调仓间隔（交易日）
+        verbose: 是否打印初始建仓
+        selections: 预先计算的每日选股 {交易日: [股票, ...]}（见 universe.top_k_by_date），
+                    为空时在调仓日按 score 排序选股
+    Returns:
+        (dates, portfolio_value) 两个列表
+    """
+    cash = state["cash"]
+    holdings = state["holdings"]
+    portfolio_value = []
+    dates = []
+
+    for date in trade_dates:
+        i = state["day_index"]
+        state["day_index"] += 1
+
+        # 计算当前持仓市值
+        holding_value = 0
+        for stock, shares in holdings.items():
+            try:
+                current_price = price_data.loc[(stock, date), 'close']
+                holding_value += shares * current_price
+            except KeyError: # Use KeyError for missing index
+                pass
+
+        total_value = cash + holding_value
+        portfolio_value.append(total_value)
+        dates.append(date)
+
+        # 调仓逻辑（每5天或第一天）
+        if i % rebalance_freq == 0 or i == 0:
+            # 清空所有持仓
+            for stock, shares in holdings.items():
+                try:
+                    sell_price = price_data.loc[(stock, date), 'close']
+                    cash += shares * sell_price
+                except KeyError:
+                    pass
+            holdings = {}
+
+            # 选择动量最高的 TOP_K 只股票
+            try:
+                if selections is not None:
+                    selected_stocks = selections.get(date, [])
+                else:
+                    day_scores = momentum_data.xs(date, level='datetime').dropna()
+                    day_scores = day_scores.sort_values('score', ascending=False)
+                    selected_stocks = day_scores.head(top_k).index.tolist()
+
+                # 等权分配资金
+                if selected_stocks: # Avoid division by zero if no stocks are selected
+                    position_size = cash / len(selected_stocks)
+                else:
+                    position_size = 0 # No stocks to buy
+
+                # 买入
+                for stock in selected_stocks:
+                    try:
+                        buy_price = price_data.loc[(stock, date), 'close']
+                        if buy_price > 0: # Avoid division by zero
+                            shares = int(position_size / buy_price / 100) * 100  # 买100股的整数倍
+                            if shares > 0:
+                                cost = shares * buy_price
+                                holdings[stock] = shares
+                                cash -= cost
+                    except KeyError:
+                        pass
+
+                if i == 0 and verbose:
+                    print(f"\n初始建仓 ({date.date()}):")
+                    if selected_stocks:
+                        for stock in selected_stocks:
+                            if stock in holdings:
+                                print(f"  {stock}: {holdings[stock]} 股")
+                    else:
+                        print("  无股票可建仓。")
+
+            except Exception as e:
+                # print(f"Error during rebalancing on {date.date()}: {e}") # Optional: for debugging
+                pass
+
+    state["cash"] = cash
+    state["holdings"] = holdings
+    return dates, portfolio_value
+
+
+def compute_metrics(result_df, init_cash):
+    """
+    计算组合表现指标
+    Args:
+        result_df: 以日期为索引、含 portfolio_value 列的 DataFrame
+        init_cash: 初始资金
+    Returns:
+        指标字典；数据不足时各项为 0 且 sufficient 为 False
+    """
+    if not result_df.empty and len(result_df) > 1:
+        returns = result_df['portfolio_value'].pct_change()
+        total_return = (result_df['portfolio_value'].iloc[-1] / init_cash - 1)
+        n_days = len(result_df)
+        annualized_return = (1 + total_return) ** (252 / n_days) - 1
+        volatility = returns.std() * (252 ** 0.5)
+        sharpe_ratio = (annualized_return - 0.03) / volatility if volatility > 0 else 0
+
+        # 最大回撤
+        cumulative = (1 + returns).cumprod()
+        running_max = cumulative.expanding().max()
+        drawdown = (cumulative - running_max) / running_max
+        max_drawdown = drawdown.min()
+        sufficient = True
+    else:
+        total_return = 0
+        annualized_return = 0
+        volatility = 0
+        sharpe_ratio = 0
+        max_drawdown = 0
+        n_days = 0
+        sufficient = False
+
+    return {
+        "total_return": total_return,
+        "annualized_return": annualized_return,
+        "volatility": volatility,
+        "sharpe_ratio": sharpe_ratio,
+        "max_drawdown": max_drawdown,
+        "n_days": n_days,
+        "sufficient": sufficient,
+    }
+
 
 # Wrap the main execution logic in a function
-def run_backtest():
+def run_backtest(market=None):
+    """
+    Args:
+        market: qlib 市场名（如 "csi300"、"csi500"）；指定后使用区间内的动态成分股，
+                否则使用固定的 STOCK_POOL
+    """
     # ============================================================================
     # 第一步：初始化
     # ============================================================================
@@ -33,10 +181,11 @@ def run_backtest():
     # provider_uri = os.path.join(os.getcwd(), "qlib_data", "cn_data") # If your qlib_data is in the current directory
     provider_uri = "/Users/Zeyu/Documents/q_trade/qlibx/data/qlib_data/cn_data" # Your original path
 
-    qlib.init(
-        provider_uri=provider_uri,
-        region=REG_CN
-    )
+    with span("qlib_init"):
+        qlib.init(
+            provider_uri=provider_uri,
+            region=REG_CN
+        )
     print("✓ Qlib 初始化完成\n")
 
     # ============================================================================
@@ -58,7 +207,15 @@ def run_backtest():
     INIT_CASH = 1000000  # 初始资金100万
     TOP_K = 3  # 持有前3只股票
 
-    print(f"股票池: {len(STOCK_POOL)} 只股票")
+    if market:
+        # 成分股进出区间展开为 (交易日 × 股票) 掩码，结果缓存在磁盘上
+        with span("membership_mask"):
+            member_calendar, STOCK_POOL, member_mask = build_membership_mask(
+                market, START_TIME, END_TIME, provider_uri=provider_uri
+            )
+        print(f"股票池: {market} 动态成分股，区间内共 {len(STOCK_POOL)} 只")
+    else:
+        print(f"股票池: {len(STOCK_POOL)} 只股票")
     print(f"回测时间: {START_TIME} 至 {END_TIME}")
     print(f"初始资金: {INIT_CASH:,.0f} 元")
     print(f"持仓数量: 前 {TOP_K} 只")
@@ -70,20 +227,17 @@ def run_backtest():
     print("\n【步骤2】计算动量因子并生成信号")
     print("-" * 70)
 
-    # 计算20日动量
-    # Ensure correct qlib version compatibility for D.features.
-    # The 'inst_processors' error could hint at an older or specific qlib version expecting different parameters,
-    # or an internal issue where it's being passed implicitly.
-    # For common usage, this call should be fine.
-    # If the TypeError persists, it might indicate a bug in your qlib installation or a very old version.
-    momentum_data = D.features(
-        instruments=STOCK_POOL,
-        fields=["$close / Ref($close, 20) - 1"],  # 20日收益率
-        start_time=START_TIME,
-        end_time=END_TIME
-    )
-
-    momentum_data.columns = ["score"]
+    # 20日动量和收盘价分段加载到同一个 float32 面板（见 market_panel.py），不再同时驻留两次整段 D.features
+    # 的结果；选股和模拟仍使用 DataFrame，按字段转换，只包含有效的 (股票, 交易日)
+    with span("load_panel"):
+        panel = load_panel(STOCK_POOL, ["$close / Ref($close, 20) - 1", "$close"], START_TIME, END_TIME,
+                           names=["score", "close"])
+    print(f"✓ 行情面板加载完成: {len(panel.instruments)} 只股票 × {len(panel.calendar)} 个交易日, "
+          f"{panel.nbytes / 2**20:.1f} MB")
+    momentum_data = panel.to_frame(["score"])
+    if market:
+        # 非成分股当日不参与排名
+        momentum_data = apply_membership(momentum_data, member_calendar, STOCK_POOL, member_mask)
     print(f"✓ 动量因子计算完成，数据形状: {momentum_data.shape}")
 
     # 查看最后一天的信号
@@ -105,87 +259,26 @@ def run_backtest():
     trade_dates = momentum_data.index.get_level_values('datetime').unique().sort_values()
 
     # 初始化回测状态
-    cash = INIT_CASH
-    holdings = {}  # {stock: shares}
-    portfolio_value = []
-    dates = []
+    state = {"cash": INIT_CASH, "holdings": {}, "day_index": 0}
 
     print(f"交易日数量: {len(trade_dates)}")
 
-    # 获取价格数据
-    price_data = D.features(
-        instruments=STOCK_POOL,
-        fields=["$close"],
-        start_time=START_TIME,
-        end_time=END_TIME
-    )
-    price_data.columns = ["close"]
+    # 价格数据来自同一个面板
+    price_data = panel.to_frame(["close"])
+    del panel
 
     # 每5天调仓一次
     rebalance_freq = 5
 
-    for i, date in enumerate(trade_dates):
-        # 计算当前持仓市值
-        holding_value = 0
-        for stock, shares in holdings.items():
-            try:
-                current_price = price_data.loc[(stock, date), 'close']
-                holding_value += shares * current_price
-            except KeyError: # Use KeyError for missing index
-                pass
-        
-        total_value = cash + holding_value
-        portfolio_value.append(total_value)
-        dates.append(date)
-        
-        # 调仓逻辑（每5天或第一天）
-        if i % rebalance_freq == 0 or i == 0:
-            # 清空所有持仓
-            for stock, shares in holdings.items():
-                try:
-                    sell_price = price_data.loc[(stock, date), 'close']
-                    cash += shares * sell_price
-                except KeyError:
-                    pass
-            holdings = {}
-            
-            # 选择动量最高的 TOP_K 只股票
-            try:
-                day_scores = momentum_data.xs(date, level='datetime').dropna()
-                day_scores = day_scores.sort_values('score', ascending=False)
-                selected_stocks = day_scores.head(TOP_K).index.tolist()
-                
-                # 等权分配资金
-                if selected_stocks: # Avoid division by zero if no stocks are selected
-                    position_size = cash / len(selected_stocks)
-                else:
-                    position_size = 0 # No stocks to buy
+    # 向量化地一次算出每日 TOP_K 选股
+    with span("selections"):
+        selections = top_k_by_date(momentum_data, TOP_K, dates=trade_dates)
 
-                # 买入
-                for stock in selected_stocks:
-                    try:
-                        buy_price = price_data.loc[(stock, date), 'close']
-                        if buy_price > 0: # Avoid division by zero
-                            shares = int(position_size / buy_price / 100) * 100  # 买100股的整数倍
-                            if shares > 0:
-                                cost = shares * buy_price
-                                holdings[stock] = shares
-                                cash -= cost
-                    except KeyError:
-                        pass
-                
-                if i == 0:
-                    print(f"\n初始建仓 ({date.date()}):")
-                    if selected_stocks:
-                        for stock in selected_stocks:
-                            if stock in holdings:
-                                print(f"  {stock}: {holdings[stock]} 股")
-                    else:
-                        print("  无股票可建仓。")
-                            
-            except Exception as e:
-                # print(f"Error during rebalancing on {date.date()}: {e}") # Optional: for debugging
-                pass
+    with span("rebalance_loop"):
+        dates, portfolio_value = simulate_portfolio(
+            momentum_data, price_data, trade_dates, state, TOP_K, rebalance_freq, verbose=True,
+            selections=selections
+        )
 
     # ============================================================================
     # 第五步：回测结果分析
@@ -210,25 +303,15 @@ def run_backtest():
     print(result_df.tail(10))
 
     # 计算关键指标
-    if not result_df.empty and len(result_df) > 1:
-        total_return = (result_df['portfolio_value'].iloc[-1] / INIT_CASH - 1)
-        n_days = len(result_df)
-        annualized_return = (1 + total_return) ** (252 / n_days) - 1
-        volatility = result_df['return'].std() * (252 ** 0.5)
-        sharpe_ratio = (annualized_return - 0.03) / volatility if volatility > 0 else 0
-
-        # 最大回撤
-        cumulative = (1 + result_df['return']).cumprod()
-        running_max = cumulative.expanding().max()
-        drawdown = (cumulative - running_max) / running_max
-        max_drawdown = drawdown.min()
-    else:
-        total_return = 0
-        annualized_return = 0
-        volatility = 0
-        sharpe_ratio = 0
-        max_drawdown = 0
-        n_days = 0
+    with span("metrics"):
+        metrics = compute_metrics(result_df, INIT_CASH)
+    total_return = metrics["total_return"]
+    annualized_return = metrics["annualized_return"]
+    volatility = metrics["volatility"]
+    sharpe_ratio = metrics["sharpe_ratio"]
+    max_drawdown = metrics["max_drawdown"]
+    n_days = metrics["n_days"]
+    if not metrics["sufficient"]:
         print("回测结果数据不足，无法计算详细指标。")
 
 
@@ -301,5 +384,13 @@ if __name__ == '__main__':
     # from multiprocessing import freeze_support
     # freeze_support()
 
+    parser = argparse.ArgumentParser(description="Qlib 回测示例 - 动量策略")
+    parser.add_argument("--market", default=None,
+                        help="使用 qlib 市场的动态成分股作为股票池，如 csi300、csi500")
+    parser.add_argument("--profile", nargs="?", const="profiles", default=None, metavar="DIR",
+                        help="开启剖析并把结果写入 DIR（也可设置环境变量 QTRADE_PROFILE）")
+    args = parser.parse_args()
+
     # The actual backtest logic is called here
-    run_backtest()
\ No newline at end of file
+    with profile_run("run_backtest", args.profile):
+        run_backtest(market=args.market)
\ No newline at end of file
@@ -0,0 +1,187 @@
+"""
+Qlib 分段回测（walk-forward）
+长区间回测时按时间分段流式加载数据，而不是一次性 D.features 整个区间：
+- 每段额外加载 lookback 个交易日，保证 Ref($close, 20) 等滚动表达式在段首也有值
+- 组合状态（现金、持仓、调仓计数）跨段延续，结果与整段回测一致
+- 可把区间切成若干独立 fold，在多个进程中并行回测
+内存峰值只与单段长度有关，与回测总时长无关
+"""
+
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+import qlib
+from qlib.config import REG_CN
+from qlib.data import D
+import pandas as pd
+import warnings
+warnings.filterwarnings('ignore')
+
+from qlib_backtest_simple import simulate_portfolio, compute_metrics
+from backtest_kernels import simulate_portfolio_fast
+
+PROVIDER_URI = "/Users/Zeyu/Documents/q_trade/qlibx/data/qlib_data/cn_data"
+
+STOCK_POOL = [
+    "SH600000", "SH600036", "SH601318", "SH600519",
+    "SH600030", "SH601166", "SH601288", "SH600887",
+    "SH601398", "SH601939", "SH600016", "SH601328"
+]
+
+MOMENTUM_FIELD = "$close / Ref($close, 20) - 1"  # 20日收益率
+MOMENTUM_LOOKBACK = 20  # 动量表达式需要的历史交易日数
+
+
+def iter_time_chunks(calendar, start_time, end_time, chunk_days, lookback_days):
+    """
+    按交易日切分时间段
+    Args:
+        calendar: 完整交易日历（需覆盖 start_time 之前 lookback_days 个交易日）
+        start_time, end_time: 回测区间
+        chunk_days: 每段交易日数
+        lookback_days: 每段向前多加载的交易日数
+    Yields:
+        (load_start, chunk_start, chunk_end)
+    """
+    calendar = pd.DatetimeIndex(calendar)
+    first = calendar.searchsorted(pd.Timestamp(start_time))
+    last = calendar.searchsorted(pd.Timestamp(end_time), side='right') - 1
+    for begin in range(first, last + 1, chunk_days):
+        end = min(begin + chunk_days - 1, last)
+        yield calendar[max(0, begin - lookback_days)], calendar[begin], calendar[end]
+
+
+def load_chunk(instruments, load_start, chunk_start, chunk_end):
+    """
+    加载一段数据并裁掉向前多取的部分
+    Returns:
+        (momentum_data, price_data)，与 simulate_portfolio 的输入格式一致
+    """
+    df = D.features(
+        instruments=instruments,
+        fields=[MOMENTUM_FIELD, "$close"],
+        start_time=load_start,
+        end_time=chunk_end
+    )
+    df.columns = ["score", "close"]
+    df = df[df.index.get_level_values('datetime') >= chunk_start]
+    return df[["score"]], df[["close"]]
+
+
+def run_walkforward(instruments=STOCK_POOL, start_time="2015-01-01", end_time="2024-12-31",
+                    init_cash=1000000, top_k=3, rebalance_freq=5,
+                    chunk_days=120, lookback_days=MOMENTUM_LOOKBACK + 5, state=None, verbose=True,
+                    progress=None, engine="kernel"):
+    """
+    分段回测一个区间（调用前需已 qlib.init）
+    Args:
+        instruments: 股票池
+        start_time, end_time: 回测区间
+        init_cash: 初始资金（state 为空时使用）
+        top_k: 持仓数量
+        rebalance_freq: 调仓间隔（交易日）
+        chunk_days: 每段交易日数，决定内存峰值
+        lookback_days: 每段向前多加载的交易日数，需不少于因子表达式的窗口
+        state: 上一区间结束时的组合状态，用于继续回测
+        verbose: 是否打印每段进度
+        progress: 每段完成后的回调 progress(已完成段数, 总段数, 段尾日期, 组合市值)
+        engine: "kernel" 使用 backtest_kernels 的编译内核，"reference" 使用 simulate_portfolio 逐日循环（结果相同）
+    Returns:
+        (result_df, state)，result_df 以日期为索引、含 portfolio_value 列
+    """
+    if state is None:
+        state = {"cash": init_cash, "holdings": {}, "day_index": 0}
+
+    simulate = simulate_portfolio_fast if engine == "kernel" else simulate_portfolio
+    calendar = D.calendar(end_time=end_time)
+    dates, values = [], []
+    chunks = list(iter_time_chunks(calendar, start_time, end_time, chunk_days, lookback_days))
+    for n_done, (load_start, chunk_start, chunk_end) in enumerate(chunks, start=1):
+        momentum_data, price_data = load_chunk(instruments, load_start, chunk_start, chunk_end)
+        trade_dates = momentum_data.index.get_level_values('datetime').unique().sort_values()
+        chunk_dates, chunk_values = simulate(
+            momentum_data, price_data, trade_dates, state, top_k, rebalance_freq
+        )
+        dates.extend(chunk_dates)
+        values.extend(chunk_values)
+        if verbose:
+            print(f"  {chunk_start.date()} ~ {chunk_end.date()}: {len(trade_dates)} 个交易日, "
+                  f"组合市值 {chunk_values[-1] if chunk_values else state['cash']:,.0f}")
+        if progress is not None:
+            progress(n_done, len(chunks), chunk_end, values[-1] if values else state["cash"])
+        # 释放本段数据后再加载下一段
+        del momentum_data, price_data
+
+    result_df = pd.DataFrame({'portfolio_value': values}, index=pd.DatetimeIndex(dates, name='date'))
+    return result_df, state
+
+
+def _run_fold(fold):
+    """子进程入口：独立初始化 qlib 并回测一个 fold"""
+    start_time, end_time, kwargs = fold
+    qlib.init(provider_uri=kwargs.pop("provider_uri"), region=REG_CN)
+    result_df, _ = run_walkforward(start_time=start_time, end_time=end_time, verbose=False, **kwargs)
+    return start_time, end_time, result_df
+
+
+def run_folds(folds, n_jobs=1, provider_uri=PROVIDER_URI, **kwargs):
+    """
+    并行回测多个相互独立的 fold，每个 fold 从初始资金开始
+    Args:
+        folds: [(start_time, end_time), ...]
+        n_jobs: 并行进程数
+        provider_uri: qlib 数据目录
+        kwargs: 透传给 run_walkforward 的参数
+    Returns:
+        [(start_time, end_time, result_df, metrics), ...]
+    """
+    tasks = [(start, end, dict(kwargs, provider_uri=provider_uri)) for start, end in folds]
+    if n_jobs > 1:
+        with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+            outputs = list(pool.map(_run_fold, tasks))
+    else:
+        outputs = [_run_fold(task) for task in tasks]
+
+    init_cash = kwargs.get("init_cash", 1000000)
+    return [(start, end, df, compute_metrics(df, init_cash)) for start, end, df in outputs]
+
+
+def split_folds(start_time, end_time, n_folds):
+    """把区间按自然日等分成 n_folds 段"""
+    edges = pd.date_range(pd.Timestamp(start_time), pd.Timestamp(end_time), periods=n_folds + 1).normalize()
+    folds = []
+    for i in range(n_folds):
+        # 除最后一段外，段尾取下一段起点的前一天，避免相邻 fold 重叠
+        end = edges[i + 1] if i == n_folds - 1 else edges[i + 1] - pd.Timedelta(days=1)
+        folds.append((edges[i].strftime('%Y-%m-%d'), end.strftime('%Y-%m-%d')))
+    return folds
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Qlib 分段回测 - 动量策略")
+    parser.add_argument("--start", default="2015-01-01")
+    parser.add_argument("--end", default="2024-12-31")
+    parser.add_argument("--chunk-days", type=int, default=120, help="每段交易日数")
+    parser.add_argument("--lookback-days", type=int, default=MOMENTUM_LOOKBACK + 5, help="每段向前多加载的交易日数")
+    parser.add_argument("--folds", type=int, default=1, help="切分为多少个独立 fold")
+    parser.add_argument("--jobs", type=int, default=1, help="并行回测的进程数")
+    parser.add_argument("--engine", choices=["kernel", "reference"], default="kernel", help="逐日模拟的实现")
+    args = parser.parse_args()
+
+    if args.folds > 1:
+        results = run_folds(split_folds(args.start, args.end, args.folds), n_jobs=args.jobs,
+                            chunk_days=args.chunk_days, lookback_days=args.lookback_days, engine=args.engine)
+        for start, end, _, metrics in results:
+            print(f"{start} ~ {end}: 总收益 {metrics['total_return']:.2%}, "
+                  f"夏普 {metrics['sharpe_ratio']:.2f}, 最大回撤 {metrics['max_drawdown']:.2%}")
+    else:
+        qlib.init(provider_uri=PROVIDER_URI, region=REG_CN)
+        result_df, state = run_walkforward(start_time=args.start, end_time=args.end,
+                                           chunk_days=args.chunk_days, lookback_days=args.lookback_days,
+                                           engine=args.engine)
+        metrics = compute_metrics(result_df, 1000000)
+        print(f"总收益率: {metrics['total_return']:.2%}")
+        print(f"年化收益率: {metrics['annualized_return']:.2%}")
+        print(f"夏普比率: {metrics['sharpe_ratio']:.2f}")
+        print(f"最大回撤: {metrics['max_drawdown']:.2%}")
+        print(f"交易日数: {metrics['n_days']} 天")
@@ -3,6 +3,8 @@ Qlib 量化交易完整入门教程
 从数据获取到策略回测的完整流程
 """
 
+import argparse
+
 import qlib
 from qlib.config import REG_CN
 from qlib.data import D
@@ -11,19 +13,26 @@ from qlib.data.dataset.handler import DataHandlerLP
 import pandas as pd
 import numpy as np
 
+from factor_eval import load_and_evaluate
+from profiling import phase, profile_run, span, wrap
+
 # ============================================================================
 # 第一部分：初始化和基础数据获取
 # ============================================================================
 def tutorial():
+    phase("part1_basics")
     print("=" * 70)
     print("第一部分：Qlib 初始化和基础数据获取")
     print("=" * 70)
 
     # 初始化 Qlib
-    qlib.init(
-        provider_uri="/Users/Zeyu/Documents/q_trade/qlibx/data/qlib_data/cn_data",
-        region=REG_CN
-    )
+    with span("qlib_init"):
+        qlib.init(
+            provider_uri="/Users/Zeyu/Documents/q_trade/qlibx/data/qlib_data/cn_data",
+            region=REG_CN
+        )
+    # 开启剖析时每次 D.features 调用单独计时（D 需在 qlib.init 之后才可访问）
+    wrap(D, "features", "D.features")
     print("✓ Qlib 初始化完成\n")
 
     # 1.1 获取单只股票的基础数据
@@ -93,6 +102,7 @@ def tutorial():
     # ============================================================================
     # 第二部分：多股票数据处理和因子计算
     # ============================================================================
+    phase("part2_factors")
 
     print("\n\n" + "=" * 70)
     print("第二部分：多股票数据处理和因子计算")
@@ -178,9 +188,23 @@ def tutorial():
             ret = df_cross_section.loc[stock, 'return_20d']
             print(f"  {stock_names[i]:8s}: {ret:7.2%}")
 
+    # 2.4 因子评估：IC、Rank IC、分位收益
+    print("\n【2.4】因子评估")
+    print("-" * 70)
+
+    # 评估 2.2 中的因子（去掉收盘价本身）；股票只有 4 只，仅作演示，分 2 组
+    eval_factors = {name: expr for name, expr in alpha_factors.items() if name != "close"}
+    with span("factor_eval"):
+        evaluation = load_and_evaluate(eval_factors, stocks, "2023-01-01", "2024-01-31",
+                                       horizons=(1, 5), quantiles=2, min_obs=3)
+    print(evaluation["summary"][["ic_mean", "icir", "rank_ic_mean", "rank_icir", "turnover", "long_short"]].round(4))
+    print("\nIC 衰减（Rank IC 均值）:")
+    print(evaluation["decay"].round(4))
+
     # ============================================================================
     # 第三部分：使用 Alpha158 因子库
     # ============================================================================
+    phase("part3_alpha158")
 
     print("\n\n" + "=" * 70)
     print("第三部分：使用 Alpha158 因子库")
@@ -225,7 +249,8 @@ def tutorial():
     print("正在加载 Alpha158 因子...")
     try:
         # 注意：Alpha158 会计算大量因子，可能需要一些时间
-        df_alpha158 = alpha158.fetch()
+        with span("Alpha158.fetch"):
+            df_alpha158 = alpha158.fetch()
         
         print(f"✓ Alpha158 因子加载完成")
         print(f"  数据形状: {df_alpha158.shape}")
@@ -242,6 +267,7 @@ def tutorial():
     # ============================================================================
     # 第四部分：简单的选股策略示例
     # ============================================================================
+    phase("part4_selection")
 
     print("\n\n" + "=" * 70)
     print("第四部分：简单的选股策略")
@@ -320,6 +346,7 @@ def tutorial():
     # ============================================================================
     # 第五部分：实用工具函数
     # ============================================================================
+    phase("part5_utils")
 
     print("\n\n" + "=" * 70)
     print("第五部分：实用工具函数")
@@ -352,6 +379,7 @@ def tutorial():
     # ============================================================================
     # 总结和下一步
     # ============================================================================
+    phase("summary")
 
     print("\n\n" + "=" * 70)
     print("教程完成！下一步学习方向")
@@ -381,6 +409,13 @@ def tutorial():
     """)
 
     print("\n" + "=" * 70)
+    phase(None)
 
 if __name__ == "__main__":
-    tutorial()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Qlib 量化交易完整入门教程")
+    parser.add_argument("--profile", nargs="?", const="profiles", default=None, metavar="DIR",
+                        help="开启剖析并把结果写入 DIR（也可设置环境变量 QTRADE_PROFILE）")
+    args = parser.parse_args()
+
+    with profile_run("tutorial", args.profile):
+        tutorial()
\ No newline at end of file
@@ -0,0 +1,175 @@
+"""
+下单前风控
+在内存中维护账户权益、持仓和未完成订单，下单前只做字典查询和少量算术，不访问网关：
+- 单票仓位上限：持仓 + 未成交买单 + 本单 的市值不超过账户权益的 max_position%
+- 名义金额上限：单笔、单票、全部持仓
+- 重复下单保护：同一股票同一方向已有未完成订单，或在保护时间内刚下过单
+- 卖出不超过 可卖持仓 - 未成交卖单
+状态由成交回调和订单状态增量更新，并定期与网关查询结果对账
+"""
+
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class RiskEngine:
+
+    def __init__(self, max_order_notional=0.0, max_symbol_notional=0.0, max_gross_notional=0.0,
+                 duplicate_window_sec=60.0):
+        """
+        Args:
+            max_order_notional: 单笔委托金额上限，0 表示不限制
+            max_symbol_notional: 单票持仓（含未成交买单）金额上限，0 表示不限制
+            max_gross_notional: 全部持仓（含未成交买单）金额上限，0 表示不限制
+            duplicate_window_sec: 同一股票同一方向两次下单的最短间隔
+        """
+        self.max_order_notional = max_order_notional
+        self.max_symbol_notional = max_symbol_notional
+        self.max_gross_notional = max_gross_notional
+        self.duplicate_window_sec = duplicate_window_sec
+
+        self.equity = None        # 账户总资产，未知时为 None
+        self.positions = {}       # symbol -> 可卖数量
+        self.prices = {}          # symbol -> 最新价
+        self.open_orders = {}     # key -> {"symbol", "side", "quantity", "remaining", "price"}
+        self._last_submit = {}    # (symbol, side) -> time.monotonic()
+        self.reconciled_at = None
+        self._lock = threading.Lock()
+
+    # -- 状态更新 --
+
+    def update_price(self, symbol, price):
+        if price:
+            self.prices[symbol] = float(price)
+
+    def reconcile(self, positions, equity=None, open_keys=None):
+        """
+        用网关查询结果覆盖内存状态
+        Args:
+            positions: {symbol: 可卖数量}
+            equity: 账户总资产，None 表示沿用上次的值
+            open_keys: 仍未完成的订单键，给出时丢弃其余订单
+        """
+        with self._lock:
+            changed = {s for s in set(positions) | set(self.positions)
+                       if positions.get(s, 0) != self.positions.get(s, 0)}
+            if changed and self.reconciled_at is not None:
+                logger.warning("风控对账：持仓与内存状态不一致 %s", sorted(changed))
+            self.positions = dict(positions)
+            if equity is not None:
+                self.equity = float(equity)
+            if open_keys is not None:
+                self.open_orders = {k: v for k, v in self.open_orders.items() if k in open_keys}
+            self.reconciled_at = time.time()
+
+    def restore(self, positions, equity=None, open_orders=None):
+        """
+        从状态快照恢复，使重启后无需先查询网关即可检查；不视为对账，reconciled_at 保持为空
+        Args:
+            positions: {symbol: 可卖数量}
+            equity: 账户总资产
+            open_orders: [{"key", "symbol", "side", "quantity", "filled_quantity", "price"}, ...]
+        """
+        with self._lock:
+            self.positions = dict(positions)
+            if equity is not None:
+                self.equity = float(equity)
+            for order in open_orders or ():
+                quantity = int(order["quantity"])
+                self.open_orders[order["key"]] = {
+                    "symbol": order["symbol"], "side": order["side"], "quantity": quantity,
+                    "remaining": max(0, quantity - int(order.get("filled_quantity", 0))),
+                    "price": float(order["price"]),
+                }
+
+    def snapshot_positions(self):
+        """
+        复制当前持仓和账户权益，可在下单线程等其他线程中调用（如保存状态快照）
+        Returns:
+            ({symbol: 可卖数量}, 账户总资产)
+        """
+        with self._lock:
+            return dict(self.positions), self.equity
+
+    def on_order_submitted(self, key, symbol, side, quantity, price):
+        with self._lock:
+            self._last_submit[(symbol, side)] = time.monotonic()
+            if key is not None:
+                self.open_orders[key] = {"symbol": symbol, "side": side, "quantity": int(quantity),
+                                         "remaining": int(quantity), "price": float(price)}
+
+    def on_order_update(self, key, filled_quantity, is_open):
+        """订单状态变化：按累计成交数量更新剩余数量，已结束的订单移出"""
+        with self._lock:
+            order = self.open_orders.get(key)
+            if order is None:
+                return
+            if not is_open:
+                del self.open_orders[key]
+            else:
+                order["remaining"] = max(0, order["quantity"] - int(filled_quantity))
+
+    def on_fill(self, symbol, side, quantity, price):
+        with self._lock:
+            held = self.positions.get(symbol, 0)
+            self.positions[symbol] = held + int(quantity) if side == "1" else max(0, held - int(quantity))
+            self.prices[symbol] = float(price)
+
+    # -- 检查 --
+
+    def _open_quantity(self, symbol, side):
+        return sum(o["remaining"] for o in self.open_orders.values()
+                   if o["symbol"] == symbol and o["side"] == side)
+
+    def _gross_notional(self):
+        held = sum(qty * self.prices.get(symbol, 0.0) for symbol, qty in self.positions.items())
+        pending = sum(o["remaining"] * o["price"] for o in self.open_orders.values() if o["side"] == "1")
+        return held + pending
+
+    def check(self, symbol, side, quantity, price, max_position=None):
+        """
+        下单前检查
+        Args:
+            symbol: 股票代码
+            side: "1" 买入 / "2" 卖出
+            quantity: 委托数量
+            price: 委托价格
+            max_position: 该股票持仓市值占账户权益的上限（%），None 或 >= 100 表示不限制
+        Returns:
+            (是否通过, 拒绝原因)
+        """
+        quantity, price = int(quantity), float(price)
+        if quantity <= 0 or price <= 0:
+            return False, f"数量或价格无效: {quantity} @ {price}"
+        notional = quantity * price
+
+        with self._lock:
+            last = self._last_submit.get((symbol, side))
+            if last is not None and time.monotonic() - last < self.duplicate_window_sec:
+                return False, f"{self.duplicate_window_sec:.0f} 秒内已下过同方向订单"
+            if self._open_quantity(symbol, side) > 0:
+                return False, "已有同方向的未完成订单"
+            if self.max_order_notional and notional > self.max_order_notional:
+                return False, f"单笔金额 {notional:,.2f} 超过上限 {self.max_order_notional:,.2f}"
+
+            held = self.positions.get(symbol, 0)
+            if side == "2":
+                if quantity > held - self._open_quantity(symbol, "2"):
+                    return False, f"可卖数量不足: 持仓 {held}"
+                return True, None
+
+            projected = (held + self._open_quantity(symbol, "1") + quantity) * price
+            if self.max_symbol_notional and projected > self.max_symbol_notional:
+                return False, f"单票金额 {projected:,.2f} 超过上限 {self.max_symbol_notional:,.2f}"
+            if max_position is not None and max_position < 100:
+                if not self.equity:
+                    return False, "账户权益未知，无法检查仓位上限"
+                limit = self.equity * max_position / 100
+                if projected > limit:
+                    return False, f"仓位 {projected:,.2f} 超过权益的 {max_position}%（{limit:,.2f}）"
+            if self.max_gross_notional and self._gross_notional() + notional > self.max_gross_notional:
+                return False, f"总持仓金额将超过上限 {self.max_gross_notional:,.2f}"
+        return True, None
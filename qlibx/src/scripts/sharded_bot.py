@@ -0,0 +1,375 @@
+"""
+分片多进程交易程序
+- 监督进程按一致性哈希把 stock_strategies 分配给多个工作进程
+- 监督进程批量拉取行情和持仓，写入共享内存快照；工作进程只读快照，不再各自查询
+- 每个工作进程有独立的网关会话和订单管理器，只写自己负责股票的交易记录
+- 工作进程异常退出后自动重启，重启时修复交易记录尾部并从当日委托恢复订单
+用法: python sharded_bot.py --workers 8 [--gateway-url http://127.0.0.1:11111]
+本地压测可配合 stub_gateway.py 使用
+"""
+
+import argparse
+import bisect
+import glob
+import hashlib
+import logging
+import multiprocessing as mp
+import os
+import struct
+import time
+from multiprocessing import shared_memory
+
+logger = logging.getLogger(__name__)
+
+# 共享内存布局：头部 + 每只股票一个定长槽位
+_HEADER = struct.Struct('<QdI4x')   # seq（seqlock 计数，奇数表示正在写）, 更新时间, 股票数
+_SLOT = struct.Struct('<dddd')      # lastPrice, volume, 可卖持仓, 报价时间
+
+# 每个工作进程的状态快照（见 strategy_state.py）
+WORKER_STATE_FILE = "strategy_state.worker{worker_id}.json"
+
+
+class HashRing:
+    """带虚拟节点的一致性哈希环，增减工作进程时只迁移少量股票"""
+
+    def __init__(self, nodes, vnodes=64):
+        self._ring = []
+        for node in nodes:
+            for i in range(vnodes):
+                self._ring.append((self._hash(f"{node}#{i}"), node))
+        self._ring.sort()
+        self._keys = [h for h, _ in self._ring]
+
+    @staticmethod
+    def _hash(value):
+        return int.from_bytes(hashlib.md5(value.encode('utf-8')).digest()[:8], 'big')
+
+    def node_for(self, key):
+        idx = bisect.bisect(self._keys, self._hash(key)) % len(self._ring)
+        return self._ring[idx][1]
+
+
+def partition_symbols(symbols, n_workers, vnodes=64):
+    """
+    按一致性哈希划分股票
+    Returns:
+        [worker0 的股票列表, worker1 的股票列表, ...]
+    """
+    ring = HashRing(range(n_workers), vnodes)
+    shards = [[] for _ in range(n_workers)]
+    for symbol in symbols:
+        shards[ring.node_for(symbol)].append(symbol)
+    return shards
+
+
+class SharedSnapshot:
+    """
+    行情与持仓的共享内存快照
+    单写多读，使用 seqlock 保证读者拿到一致的数据
+    """
+
+    def __init__(self, shm, symbols, owner):
+        self.shm = shm
+        self.symbols = list(symbols)
+        self.index = {symbol: i for i, symbol in enumerate(self.symbols)}
+        self._owner = owner
+
+    @classmethod
+    def create(cls, symbols):
+        size = _HEADER.size + _SLOT.size * max(1, len(symbols))
+        shm = shared_memory.SharedMemory(create=True, size=size)
+        _HEADER.pack_into(shm.buf, 0, 0, 0.0, len(symbols))
+        return cls(shm, symbols, owner=True)
+
+    @classmethod
+    def attach(cls, name, symbols):
+        return cls(shared_memory.SharedMemory(name=name), symbols, owner=False)
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    def write(self, quotes, positions):
+        """
+        写入一次完整快照
+        Args:
+            quotes: {股票代码: 报价字典}
+            positions: {股票代码: 可卖数量}
+        """
+        buf = self.shm.buf
+        seq = _HEADER.unpack_from(buf, 0)[0]
+        now = time.time()
+        _HEADER.pack_into(buf, 0, seq + 1, now, len(self.symbols))
+        for symbol, i in self.index.items():
+            offset = _HEADER.size + i * _SLOT.size
+            quote = quotes.get(symbol)
+            if quote:
+                price, volume, quote_ts = float(quote.get("lastPrice", 0)), float(quote.get("volume", 0)), now
+            else:
+                # 本轮未取到报价，保留上一次的价格但不刷新时间戳
+                price, volume, _, quote_ts = _SLOT.unpack_from(buf, offset)
+            _SLOT.pack_into(buf, offset, price, volume, float(positions.get(symbol, 0)), quote_ts)
+        _HEADER.pack_into(buf, 0, seq + 2, now, len(self.symbols))
+
+    def read(self, symbol):
+        """
+        读取单只股票的快照
+        Returns:
+            (lastPrice, volume, 可卖持仓, 报价时间, 快照时间)，股票不在快照中返回 None
+        """
+        i = self.index.get(symbol)
+        if i is None:
+            return None
+        buf = self.shm.buf
+        offset = _HEADER.size + i * _SLOT.size
+        while True:
+            seq1, updated_at, _ = _HEADER.unpack_from(buf, 0)
+            if seq1 % 2:
+                continue
+            slot = _SLOT.unpack_from(buf, offset)
+            if _HEADER.unpack_from(buf, 0)[0] == seq1:
+                return slot + (updated_at,)
+
+    def generation(self):
+        """快照版本号，每写入一次加一"""
+        return _HEADER.unpack_from(self.shm.buf, 0)[0] // 2
+
+    def close(self):
+        self.shm.close()
+        if self._owner:
+            self.shm.unlink()
+
+
+class SnapshotGateway:
+    """
+    以共享快照代替行情和持仓查询的网关代理，其余接口透传给真实网关
+    快照过期或缺失时回退到直接查询
+    """
+
+    def __init__(self, api, snapshot, max_age=30.0):
+        self.api = api
+        self.snapshot = snapshot
+        self.max_age = max_age
+
+    def __getattr__(self, name):
+        return getattr(self.api, name)
+
+    def _fresh_slot(self, symbol):
+        slot = self.snapshot.read(symbol)
+        if slot is None or time.time() - slot[3] > self.max_age:
+            return None
+        return slot
+
+    def get_realtime_quote(self, stock_code, data_type=2):
+        slot = self._fresh_slot(stock_code)
+        if slot is None:
+            return self.api.get_realtime_quote(stock_code, data_type)
+        return {"code": stock_code, "lastPrice": slot[0], "volume": int(slot[1])}
+
+    def get_realtime_quotes(self, stock_codes, data_type=2, batch_size=50):
+        quotes, missing = {}, []
+        for code in stock_codes:
+            slot = self._fresh_slot(code)
+            if slot is None:
+                missing.append(code)
+            else:
+                quotes[code] = {"code": code, "lastPrice": slot[0], "volume": int(slot[1])}
+        if missing:
+            quotes.update(self.api.get_realtime_quotes(missing, data_type, batch_size))
+        return quotes
+
+    def get_stock_position_qty(self, stock_code, exchange_type="N"):
+        slot = self._fresh_slot(stock_code)
+        if slot is None:
+            return self.api.get_stock_position_qty(stock_code, exchange_type)
+        return int(slot[2])
+
+
+def repair_ledger_tail(path):
+    """
+    进程在写交易记录时崩溃可能留下半行，截断到最后一个完整行
+    Returns:
+        是否做了修复
+    """
+    if not os.path.exists(path):
+        return False
+    with open(path, 'rb+') as f:
+        f.seek(0, os.SEEK_END)
+        size = f.tell()
+        if size == 0:
+            return False
+        f.seek(size - 1)
+        if f.read(1) == b'\n':
+            return False
+        # 从尾部回溯找到最后一个换行
+        pos = size - 1
+        while pos > 0:
+            step = min(4096, pos)
+            f.seek(pos - step)
+            chunk = f.read(step)
+            idx = chunk.rfind(b'\n')
+            if idx >= 0:
+                f.truncate(pos - step + idx + 1)
+                return True
+            pos -= step
+        f.truncate(0)
+        return True
+
+
+def _worker_main(worker_id, symbols, all_symbols, shm_name, gateway_url, strategy_file, risk_limits=None):
+    """工作进程入口"""
+    from bot_logging import setup_logging
+    from ledger_archive import ledger_path
+    from order_manager import OrderManager
+    from risk import RiskEngine
+    from tqqq_trading_bot import HuashengGatewayAPI, TradingStrategy
+
+    setup_logging(log_file=f"trading.worker{worker_id}.log")
+    log = logging.getLogger(f"worker{worker_id}")
+
+    snapshot = SharedSnapshot.attach(shm_name, all_symbols)
+    # 每个工作进程独立的会话缓存，重启时跳过登录
+    api = HuashengGatewayAPI(gateway_url, session_file=f".gateway_session.worker{worker_id}.json")
+    order_manager = OrderManager(api)
+    strategy = TradingStrategy(SnapshotGateway(api, snapshot), strategy_file, order_manager=order_manager,
+                               risk=RiskEngine(**(risk_limits or {})),
+                               state_file=WORKER_STATE_FILE.format(worker_id=worker_id))
+    # 工作进程数变化后股票可能换了进程：从其他工作进程的快照合并这些股票的执行记录，每日只执行一次仍然成立
+    others = glob.glob(WORKER_STATE_FILE.format(worker_id="*"))
+    if strategy.state.import_symbols(others, symbols):
+        strategy.save_state()
+    order_manager.on_fill = strategy.on_order_fill
+    order_manager.on_ack = strategy.on_order_ack
+    order_manager.on_close = strategy.on_order_close
+    order_manager.exchange_type = strategy.exchange_type
+
+    # 崩溃恢复：修复交易记录尾部，接管当日已存在的委托
+    for symbol in symbols:
+        if repair_ledger_tail(ledger_path(symbol, strategy.ledger_dir)):
+            log.warning("已修复 %s 交易记录中不完整的最后一行", symbol)
+    order_manager.adopt_today_entrusts(set(symbols))
+
+    log.info("工作进程 %s 启动，负责 %s 只股票", worker_id, len(symbols))
+    last_generation = snapshot.generation()
+    try:
+        while True:
+            generation = snapshot.generation()
+            if generation == last_generation:
+                time.sleep(0.05)
+                continue
+            last_generation = generation
+            # 与单进程版本相同：盘中采样指标，收盘窗口前预热并对账风控，下单路径上不再查询持仓和资金
+            strategy.sample_indicators(symbols)
+            if strategy.should_prearm():
+                strategy.prearm(symbols)
+            for symbol in symbols:
+                strategy.execute_strategy(symbol)
+            order_manager.poll_open_orders()
+            if strategy.should_reconcile_risk():
+                strategy.reconcile_risk()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        order_manager.shutdown(wait=True)
+        snapshot.close()
+
+
+class Supervisor:
+    """监督进程：维护快照、启动并看护工作进程"""
+
+    def __init__(self, n_workers, gateway_url="http://127.0.0.1:11111",
+                 strategy_file="stock_strategy.json", check_interval=60, restart_backoff=5.0, risk_limits=None):
+        from tqqq_trading_bot import HuashengGatewayAPI, TradingStrategy
+
+        self.n_workers = n_workers
+        self.gateway_url = gateway_url
+        self.strategy_file = strategy_file
+        self.check_interval = check_interval
+        self.restart_backoff = restart_backoff
+        # 每个工作进程的风控使用相同的金额上限；总持仓上限按账户持仓 + 本进程的未成交买单检查
+        self.risk_limits = dict(risk_limits or {})
+
+        self.api = HuashengGatewayAPI(gateway_url)
+        self.strategy = TradingStrategy(self.api, strategy_file)
+        self.symbols = sorted(self.strategy.stock_strategies.keys())
+        self.shards = partition_symbols(self.symbols, n_workers)
+        self.snapshot = SharedSnapshot.create(self.symbols)
+
+        # spawn 避免把监督进程的日志线程等状态 fork 到子进程
+        self._ctx = mp.get_context("spawn")
+        self._procs = [None] * n_workers
+        self._last_start = [0.0] * n_workers
+
+    def _start_worker(self, worker_id):
+        proc = self._ctx.Process(
+            target=_worker_main,
+            args=(worker_id, self.shards[worker_id], self.symbols, self.snapshot.name,
+                  self.gateway_url, self.strategy_file, self.risk_limits),
+            name=f"qtrade-worker{worker_id}",
+            daemon=True,
+        )
+        proc.start()
+        self._procs[worker_id] = proc
+        self._last_start[worker_id] = time.time()
+        logger.info("启动工作进程 %s (pid=%s)，股票数 %s", worker_id, proc.pid, len(self.shards[worker_id]))
+
+    def _check_workers(self):
+        for worker_id, proc in enumerate(self._procs):
+            if not self.shards[worker_id] or proc.is_alive():
+                continue
+            if time.time() - self._last_start[worker_id] < self.restart_backoff:
+                continue
+            logger.error("工作进程 %s 退出 (exitcode=%s)，正在重启", worker_id, proc.exitcode)
+            self._start_worker(worker_id)
+
+    def refresh_snapshot(self):
+        """批量拉取行情和持仓并发布新快照"""
+        quotes = self.api.get_realtime_quotes(self.symbols, self.strategy.data_type)
+        positions = {}
+        data = self.api.get_position(self.strategy.exchange_type)
+        if data and "positionList" in data:
+            for pos in data["positionList"]:
+                positions[pos.get("stockCode")] = int(pos.get("canSellAmount", 0))
+        self.snapshot.write(quotes, positions)
+        return len(quotes)
+
+    def run(self):
+        for worker_id, shard in enumerate(self.shards):
+            if shard:
+                self._start_worker(worker_id)
+
+        try:
+            while True:
+                self._check_workers()
+                # 盘中每个检查间隔刷新快照：窗口外工作进程只用它采样指标，收盘窗口内用它判断和下单
+                if self.strategy.is_trading_time():
+                    start = time.perf_counter()
+                    n_quotes = self.refresh_snapshot()
+                    logger.info("快照已发布: %s/%s 只股票有报价，耗时 %.3fs",
+                                n_quotes, len(self.symbols), time.perf_counter() - start)
+                time.sleep(self.check_interval)
+        except KeyboardInterrupt:
+            logger.info("监督进程已停止")
+        finally:
+            for proc in self._procs:
+                if proc is not None and proc.is_alive():
+                    proc.terminate()
+                    proc.join(timeout=5)
+            self.snapshot.close()
+
+
+if __name__ == "__main__":
+    from bot_logging import setup_logging
+    from tqqq_trading_bot import add_risk_arguments, risk_limits_from_args
+
+    parser = argparse.ArgumentParser(description="分片多进程交易程序")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--gateway-url", default="http://127.0.0.1:11111")
+    parser.add_argument("--strategy-file", default="stock_strategy.json")
+    parser.add_argument("--check-interval", type=int, default=60)
+    add_risk_arguments(parser)
+    args = parser.parse_args()
+
+    setup_logging(log_file='trading.supervisor.log')
+    Supervisor(args.workers, args.gateway_url, args.strategy_file, args.check_interval,
+               risk_limits=risk_limits_from_args(args)).run()
@@ -0,0 +1,88 @@
+"""
+请求合并（single-flight）
+相同键的请求同时只执行一次，其余调用方等待并共享结果；结果在 ttl 秒内继续复用
+用于网关的行情和持仓查询：同一轮中多个代码路径（或多个线程）查询相同的数据时只发一次请求
+"""
+
+import threading
+import time
+
+
+class _Call:
+    __slots__ = ("done", "result", "error")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """线程安全；结果为共享对象，调用方不应修改"""
+
+    def __init__(self):
+        self._calls = {}      # key -> 正在执行的 _Call
+        self._results = {}    # key -> (过期时间, 结果)
+        self._lock = threading.Lock()
+        self._generation = 0  # forget 时递增；执行期间被 forget 的结果不缓存
+        self.executed = 0     # 实际执行次数
+        self.shared = 0       # 等待正在执行的请求而得到结果的次数
+        self.cached = 0       # 直接使用未过期结果的次数
+
+    def do(self, key, func, ttl=0.0):
+        """
+        Args:
+            key: 请求键，需可哈希
+            func: 无参函数，执行实际请求
+            ttl: 结果的复用时间（秒），0 表示只合并同时进行的请求；结果为 None（请求失败）时不复用
+        Returns:
+            (结果, 来源)，来源为 "executed" / "shared" / "cached"
+        """
+        with self._lock:
+            if ttl > 0:
+                entry = self._results.get(key)
+                if entry is not None and entry[0] > time.monotonic():
+                    self.cached += 1
+                    return entry[1], "cached"
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+                generation = self._generation
+
+        if not leader:
+            call.done.wait()
+            with self._lock:
+                self.shared += 1
+            if call.error is not None:
+                raise call.error
+            return call.result, "shared"
+
+        try:
+            call.result = func()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                self.executed += 1
+                del self._calls[key]
+                if (ttl > 0 and call.error is None and call.result is not None
+                        and generation == self._generation):
+                    self._results[key] = (time.monotonic() + ttl, call.result)
+            call.done.set()
+        return call.result, "executed"
+
+    def forget(self, match=None):
+        """
+        丢弃已缓存的结果（不影响正在执行的请求）
+        Args:
+            match: 判断键是否需要丢弃的函数，None 表示全部丢弃
+        """
+        with self._lock:
+            self._generation += 1
+            if match is None:
+                self._results.clear()
+            else:
+                for key in [k for k in self._results if match(k)]:
+                    del self._results[key]
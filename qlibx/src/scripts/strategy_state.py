@@ -0,0 +1,187 @@
+"""
+交易程序状态快照
+进程重启（包括在收盘窗口内崩溃重启）后不重复下单、不重新扫描交易记录：
+- 每只股票的最近执行日期：当日已下过单的股票不再执行
+- 最近一次买入的日期和价格，附带交易记录文件的 (大小, 修改时间)；文件未变化时直接使用，变化后重新扫描
+- 最近看到的持仓、账户权益和未完成订单，启动时恢复到风控和订单管理器，之后由正常的对账和委托轮询校正
+每次状态变化后整体写入：先写临时文件并 fsync，再 os.replace 原子替换，崩溃时文件要么是旧版本要么是新版本
+"""
+
+import json
+import logging
+import os
+import threading
+from datetime import date, datetime
+
+logger = logging.getLogger(__name__)
+
+STATE_VERSION = 1
+
+
+def _date_str(value):
+    return value.isoformat() if value else None
+
+
+def _parse_date(value):
+    return date.fromisoformat(value) if value else None
+
+
+class StrategyState:
+
+    def __init__(self, path=None):
+        """
+        Args:
+            path: 快照文件路径，None 表示只在内存中保存（如回放）
+        """
+        self.path = path
+        self.trade_date = None    # 写入快照时的交易日，未完成订单只在同一交易日内恢复
+        self.symbols = {}         # symbol -> {"last_execution_date", "last_buy_date", "last_buy_price", "ledger"}
+        self.positions = {}       # symbol -> 可卖数量
+        self.equity = None
+        self.open_orders = []     # ManagedOrder.to_dict() + entrust_type、context
+        self.saved_at = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def load(cls, path):
+        """
+        读取快照；文件不存在或损坏时返回空状态
+        """
+        state = cls(path)
+        if not path or not os.path.exists(path):
+            return state
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            if data.get("version") != STATE_VERSION:
+                logger.warning("状态快照版本 %s 不匹配，忽略 %s", data.get("version"), path)
+                return state
+            state.trade_date = _parse_date(data.get("trade_date"))
+            for symbol, entry in data.get("symbols", {}).items():
+                state.symbols[symbol] = {
+                    "last_execution_date": _parse_date(entry.get("last_execution_date")),
+                    "last_buy_date": _parse_date(entry.get("last_buy_date")),
+                    "last_buy_price": entry.get("last_buy_price"),
+                    "ledger": tuple(entry["ledger"]) if entry.get("ledger") else None,
+                }
+            state.positions = {s: int(q) for s, q in data.get("positions", {}).items()}
+            state.equity = data.get("equity")
+            state.open_orders = list(data.get("open_orders", []))
+            state.saved_at = data.get("saved_at")
+        except Exception as e:
+            logger.error("读取状态快照失败 %s: %s", path, e)
+            return cls(path)
+        return state
+
+    def save(self):
+        """原子写入快照；未指定路径时不写"""
+        if not self.path:
+            return
+        with self._lock:
+            self.saved_at = datetime.now().isoformat()
+            data = {
+                "version": STATE_VERSION,
+                "saved_at": self.saved_at,
+                "trade_date": _date_str(self.trade_date),
+                "symbols": {
+                    symbol: {
+                        "last_execution_date": _date_str(entry.get("last_execution_date")),
+                        "last_buy_date": _date_str(entry.get("last_buy_date")),
+                        "last_buy_price": entry.get("last_buy_price"),
+                        "ledger": list(entry["ledger"]) if entry.get("ledger") else None,
+                    }
+                    for symbol, entry in self.symbols.items()
+                },
+                "positions": self.positions,
+                "equity": self.equity,
+                "open_orders": self.open_orders,
+            }
+            tmp = self.path + ".tmp"
+            try:
+                with open(tmp, 'w', encoding='utf-8') as f:
+                    json.dump(data, f, ensure_ascii=False, separators=(",", ":"), default=str)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmp, self.path)
+            except Exception as e:
+                logger.error("写入状态快照失败 %s: %s", self.path, e)
+
+    def import_symbols(self, paths, symbols):
+        """
+        从其他快照文件合并指定股票的记录（分片数变化后股票换了工作进程时使用）
+        每只股票取最近执行日期最新的记录，保证每日只执行一次的判断不因换进程而丢失
+        Args:
+            paths: 其他快照文件
+            symbols: 需要合并的股票
+        Returns:
+            合并的记录数
+        """
+        merged = 0
+        for path in paths:
+            if path == self.path:
+                continue
+            other = StrategyState.load(path)
+            for symbol in symbols:
+                entry = other.symbols.get(symbol)
+                if entry is None:
+                    continue
+                current = self.symbols.get(symbol)
+                theirs = entry["last_execution_date"] or date.min
+                if current is None or theirs > (current["last_execution_date"] or date.min):
+                    # 交易记录签名随记录一起带入，文件已变化时 last_buy 会重新扫描
+                    self.symbols[symbol] = dict(entry)
+                    merged += 1
+        return merged
+
+    def _entry(self, symbol):
+        return self.symbols.setdefault(symbol, {"last_execution_date": None, "last_buy_date": None,
+                                                "last_buy_price": None, "ledger": None})
+
+    # -- 执行日期 --
+
+    def executed_on(self, symbol, day):
+        entry = self.symbols.get(symbol)
+        return entry is not None and entry["last_execution_date"] == day
+
+    def mark_executed(self, symbol, day):
+        self._entry(symbol)["last_execution_date"] = day
+
+    def clear_executed(self, symbol, day):
+        """撤销 day 的执行记录（当日订单没有任何成交就结束）；Returns: 是否撤销"""
+        if not self.executed_on(symbol, day):
+            return False
+        self.symbols[symbol]["last_execution_date"] = None
+        return True
+
+    # -- 最近买入 --
+
+    def last_buy(self, symbol, ledger):
+        """
+        Args:
+            ledger: 交易记录文件当前的 (大小, 修改时间)，文件不存在时为 None
+        Returns:
+            (买入日期, 买入价格)；没有缓存或交易记录已变化时返回 None
+        """
+        entry = self.symbols.get(symbol)
+        if entry is None or entry["ledger"] is None or entry["ledger"] != ledger:
+            return None
+        return entry["last_buy_date"], entry["last_buy_price"]
+
+    def set_last_buy(self, symbol, day, price, ledger):
+        entry = self._entry(symbol)
+        entry["last_buy_date"] = day
+        entry["last_buy_price"] = float(price) if price is not None else None
+        entry["ledger"] = ledger
+
+    def on_ledger_write(self, symbol, action, day, price, before, after):
+        """
+        交易记录追加一行后更新缓存；卖出不改变最近买入，缓存在写入前有效时只更新文件签名
+        Args:
+            before, after: 写入前后交易记录文件的 (大小, 修改时间)
+        """
+        if action == "buy":
+            self.set_last_buy(symbol, day, price, after)
+            return
+        entry = self.symbols.get(symbol)
+        if entry is not None and entry["ledger"] is not None and entry["ledger"] == before:
+            entry["ledger"] = after
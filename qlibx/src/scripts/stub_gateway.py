@@ -0,0 +1,163 @@
+"""
+本地桩网关
+模拟华盛 OpenAPI Gateway 的常用接口，用于压测和联调，不连接真实券商：
+- trade/TradeLogin, hq/Subscribe
+- hq/BasicQot（支持一次查询多只股票）
+- trade/TradeEntrust（限价单立即全部成交）
+- trade/TradeQueryEntrustList, trade/TradeQueryPositionList, trade/TradeQueryFund
+用法: python stub_gateway.py --port 11111 --latency-ms 5
+"""
+
+import argparse
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class StubMarket:
+    """桩网关的行情与账户状态，线程安全"""
+
+    def __init__(self, base_price=80.0, seed=0, cash=1_000_000.0):
+        self.base_price = base_price
+        self.cash = cash
+        self._rng = random.Random(seed)
+        self._quotes = {}     # code -> {"lastPrice", "volume"}
+        self._positions = {}  # code -> shares
+        self._entrusts = []
+        self._next_id = 1
+        self._lock = threading.Lock()
+
+    def quote(self, code):
+        with self._lock:
+            q = self._quotes.get(code)
+            if q is None:
+                q = {"lastPrice": self.base_price, "volume": 0}
+                self._quotes[code] = q
+            # 随机游走，模拟盘中价格和累计成交量变化
+            q["lastPrice"] = round(max(0.01, q["lastPrice"] * (1 + self._rng.gauss(0, 0.002))), 2)
+            q["volume"] += self._rng.randint(10_000, 1_000_000)
+            return {"code": code, "lastPrice": q["lastPrice"], "volume": q["volume"], "turnover": 0}
+
+    def entrust(self, params):
+        code = params.get("stockCode")
+        amount = int(float(params.get("entrustAmount", 0)))
+        price = float(params.get("entrustPrice", 0))
+        side = str(params.get("entrustBs"))
+        with self._lock:
+            held = self._positions.get(code, 0)
+            if amount <= 0 or (side == "2" and held < amount):
+                return None
+            entrust_id = str(self._next_id)
+            self._next_id += 1
+            self._positions[code] = held + amount if side == "1" else held - amount
+            self.cash += -amount * price if side == "1" else amount * price
+            self._entrusts.append({
+                "entrustId": entrust_id,
+                "stockCode": code,
+                "entrustBs": side,
+                "entrustAmount": amount,
+                "entrustPrice": price,
+                "entrustStatus": "8",
+                "businessAmount": amount,
+                "businessPrice": price,
+            })
+            return {"entrustId": entrust_id}
+
+    def entrust_list(self, params=None):
+        with self._lock:
+            return {"entrustList": _page([dict(e) for e in self._entrusts], params)}
+
+    def funds(self):
+        with self._lock:
+            market_value = sum(qty * self._quotes.get(code, {}).get("lastPrice", self.base_price)
+                               for code, qty in self._positions.items())
+            return {"assetBalance": round(self.cash + market_value, 2), "enableBalance": round(self.cash, 2)}
+
+    def position_list(self, params=None):
+        with self._lock:
+            return {"positionList": _page([
+                {"stockCode": code, "currentAmount": qty, "canSellAmount": qty}
+                for code, qty in self._positions.items() if qty > 0
+            ], params)}
+
+
+def _page(items, params):
+    """按 queryCount / queryParamStr 分页，每条带 positionStr（下一页的 queryParamStr），与真实网关一致"""
+    params = params or {}
+    start = int(params.get("queryParamStr") or 0)
+    count = int(params.get("queryCount") or len(items) or 1)
+    page = items[start:start + count]
+    for i, item in enumerate(page, start=start + 1):
+        item["positionStr"] = str(i)
+    return page
+
+
+def make_handler(market, latency=0.0):
+
+    class StubHandler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            length = int(self.headers.get("Content-Length", 0))
+            body = json.loads(self.rfile.read(length) or b"{}")
+            params = body.get("params", {})
+            endpoint = self.path.strip("/")
+
+            if latency:
+                time.sleep(latency)
+
+            data = None
+            if endpoint in ("trade/TradeLogin", "hq/Subscribe"):
+                data = {}
+            elif endpoint == "hq/BasicQot":
+                data = {"basicQot": [market.quote(s["code"]) for s in params.get("security", [])]}
+            elif endpoint == "trade/TradeEntrust":
+                data = market.entrust(params)
+            elif endpoint == "trade/TradeQueryEntrustList":
+                data = market.entrust_list(params)
+            elif endpoint == "trade/TradeQueryPositionList":
+                data = market.position_list(params)
+            elif endpoint == "trade/TradeQueryFund":
+                data = market.funds()
+
+            if data is None:
+                payload = {"ok": False, "err": f"stub: unsupported or rejected {endpoint}"}
+            else:
+                payload = {"ok": True, "data": data}
+            raw = json.dumps(payload).encode('utf-8')
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(raw)))
+            self.end_headers()
+            self.wfile.write(raw)
+
+        def log_message(self, format, *args):
+            pass
+
+    return StubHandler
+
+
+def start_stub_gateway(port=11111, host="127.0.0.1", latency_ms=0.0, market=None):
+    """
+    在后台线程中启动桩网关
+    Returns:
+        (server, market)
+    """
+    market = market or StubMarket()
+    server = ThreadingHTTPServer((host, port), make_handler(market, latency_ms / 1000.0))
+    threading.Thread(target=server.serve_forever, name="stub-gateway", daemon=True).start()
+    return server, market
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="华盛 OpenAPI 本地桩网关")
+    parser.add_argument("--port", type=int, default=11111)
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="每个请求附加的模拟延迟")
+    args = parser.parse_args()
+    server, _ = start_stub_gateway(args.port, latency_ms=args.latency_ms)
+    print(f"Stub gateway listening on http://127.0.0.1:{args.port}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -0,0 +1,131 @@
+"""
+网关请求日志（二进制）
+按顺序追加交易程序与网关之间的每一次请求和响应（行情、持仓、委托回报等），用于事后复盘和回放（见 journal_replay.py）
+文件格式：
+    文件头 MAGIC
+    记录 = 定长头 _RECORD + 请求体 + 响应体
+        kind:     0 = 一次请求/响应，1 = 接口名定义（请求体为接口名，接口在文件中只写一次全名）
+        ts:       请求发出时的 Unix 时间
+        latency:  请求耗时（秒）
+        endpoint: 接口编号
+        请求体 / 响应体: 紧凑 JSON，响应失败时响应体为 null
+每条记录的固定开销 23 字节；写入经过缓冲，每隔 flush_interval 秒刷盘一次
+"""
+
+import json
+import os
+import struct
+import threading
+import time
+from collections import namedtuple
+
+MAGIC = b"QTJ1\n"
+_RECORD = struct.Struct('<BdfHII')  # kind, ts, latency, endpoint, 请求体长度, 响应体长度
+
+KIND_EXCHANGE = 0
+KIND_ENDPOINT = 1
+
+JournalRecord = namedtuple("JournalRecord", ["ts", "latency", "endpoint", "params", "data"])
+
+
+def _encode(obj):
+    return json.dumps(obj, separators=(",", ":"), ensure_ascii=False, default=str).encode('utf-8')
+
+
+class JournalWriter:
+    """线程安全的追加写入器"""
+
+    def __init__(self, path, flush_interval=1.0, exclude=("trade/TradeLogin",)):
+        """
+        Args:
+            path: 日志文件路径，已存在时追加
+            flush_interval: 刷盘间隔（秒），进程崩溃最多丢失这段时间内的记录
+            exclude: 不记录的接口（如登录请求中的密码）
+        """
+        self.path = path
+        self.flush_interval = flush_interval
+        self.exclude = set(exclude)
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        is_new = not os.path.exists(path) or os.path.getsize(path) == 0
+        self._file = open(path, 'ab', buffering=1 << 16)
+        if is_new:
+            self._file.write(MAGIC)
+        # 每个写入器重新定义接口编号；读取时后出现的定义覆盖先前的
+        self._endpoints = {}
+        self._last_flush = time.monotonic()
+        self._lock = threading.Lock()
+        self.records = 0
+
+    def _endpoint_id(self, endpoint):
+        endpoint_id = self._endpoints.get(endpoint)
+        if endpoint_id is None:
+            endpoint_id = self._endpoints[endpoint] = len(self._endpoints)
+            name = endpoint.encode('utf-8')
+            self._file.write(_RECORD.pack(KIND_ENDPOINT, 0.0, 0.0, endpoint_id, len(name), 0))
+            self._file.write(name)
+        return endpoint_id
+
+    def record(self, endpoint, params, data, ts=None, latency=0.0):
+        """
+        追加一次请求和响应
+        Args:
+            endpoint: 接口路径
+            params: 请求参数
+            data: 响应中的 data 字段，失败时为 None
+            ts: 请求发出时间，默认当前时间
+            latency: 请求耗时（秒）
+        """
+        if endpoint in self.exclude:
+            return
+        request_body = _encode(params)
+        response_body = _encode(data)
+        with self._lock:
+            if self._file.closed:
+                return
+            endpoint_id = self._endpoint_id(endpoint)
+            self._file.write(_RECORD.pack(KIND_EXCHANGE, ts if ts is not None else time.time(), latency,
+                                          endpoint_id, len(request_body), len(response_body)))
+            self._file.write(request_body)
+            self._file.write(response_body)
+            self.records += 1
+            now = time.monotonic()
+            if now - self._last_flush >= self.flush_interval:
+                self._file.flush()
+                self._last_flush = now
+
+    def flush(self):
+        with self._lock:
+            if not self._file.closed:
+                self._file.flush()
+
+    def close(self):
+        with self._lock:
+            if not self._file.closed:
+                self._file.close()
+
+
+def read_journal(path):
+    """
+    按写入顺序读取日志；文件尾部不完整的记录（写入时崩溃）被忽略
+    Yields:
+        JournalRecord(ts, latency, endpoint, params, data)
+    """
+    endpoints = {}
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{path} 不是网关请求日志")
+        while True:
+            head = f.read(_RECORD.size)
+            if len(head) < _RECORD.size:
+                return
+            kind, ts, latency, endpoint_id, request_len, response_len = _RECORD.unpack(head)
+            body = f.read(request_len + response_len)
+            if len(body) < request_len + response_len:
+                return
+            if kind == KIND_ENDPOINT:
+                endpoints[endpoint_id] = body[:request_len].decode('utf-8')
+                continue
+            yield JournalRecord(ts, latency, endpoints.get(endpoint_id, str(endpoint_id)),
+                                json.loads(body[:request_len]), json.loads(body[request_len:]))
@@ -5,42 +5,166 @@
 - 成交量 < 40M：市价卖出1股
 """
 
-import requests
 import time
+
+# 进程启动时间，用于统计启动耗时；requests / pytz / Crypto 较重，延迟到首次使用时导入
+_PROCESS_START = time.perf_counter()
+
 from datetime import datetime
-import pytz
 import logging
 import json
 import csv
 import os
 import base64
-from Crypto.Cipher import AES
-from Crypto.Util.Padding import pad
-
-# 配置日志
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s [%(levelname)s] %(message)s',
-    handlers=[
-        logging.FileHandler('trading.log'),
-        logging.StreamHandler()
-    ]
-)
+import argparse
+
+from bot_metrics import REGISTRY, start_metrics_server
+
+from bot_logging import setup_logging
+from order_manager import STATUS_CANCELLED, STATUS_REJECTED, OrderManager
+from ledger_archive import archive_dir, last_archived_buy, ledger_lock, ledger_path
+from indicators import IndicatorBook
+from risk import RiskEngine
+from tick_journal import JournalWriter
+from strategy_state import StrategyState
+from single_flight import SingleFlight
+from valuation import DEFAULT_INTERVAL_SEC as VALUATION_INTERVAL_SEC, QuoteCache, ValuationService
+import profiling
+from profiling import span
+
+# 日志在 main() 中通过 setup_logging 配置（默认队列模式 + 轮转压缩）
+# 热路径日志统一使用 %-风格参数，由后台线程延迟格式化
 logger = logging.getLogger(__name__)
 
+# 运行时指标
+GATEWAY_LATENCY = REGISTRY.histogram(
+    "qtrade_gateway_request_seconds", "Gateway request latency by endpoint", ("endpoint",))
+GATEWAY_ERRORS = REGISTRY.counter(
+    "qtrade_gateway_errors_total", "Gateway request failures by endpoint and kind", ("endpoint", "kind"))
+GATEWAY_RETRIES = REGISTRY.counter(
+    "qtrade_gateway_retries_total", "Gateway request retries by endpoint", ("endpoint",))
+TICK_LATENCY = REGISTRY.histogram(
+    "qtrade_tick_seconds", "Wall time of one pass over all configured symbols")
+SYMBOL_LATENCY = REGISTRY.histogram(
+    "qtrade_execute_strategy_seconds", "execute_strategy wall time by symbol", ("symbol",))
+LEDGER_WRITE_LATENCY = REGISTRY.histogram(
+    "qtrade_record_trade_seconds", "record_trade CSV append latency", ("symbol",))
+LEDGER_WRITE_ERRORS = REGISTRY.counter(
+    "qtrade_record_trade_errors_total", "record_trade CSV append failures", ("symbol",))
+GATEWAY_COALESCED = REGISTRY.counter(
+    "qtrade_gateway_coalesced_total", "Gateway queries served without a request, by endpoint and source",
+    ("endpoint", "source"))
+RISK_REJECTS = REGISTRY.counter(
+    "qtrade_risk_rejects_total", "Orders blocked by the pre-trade risk check", ("symbol", "side"))
+RISK_EQUITY_UNKNOWN = REGISTRY.gauge(
+    "qtrade_risk_equity_unknown", "1 when account equity is still unknown after the pre-close reconcile")
+STARTUP_SECONDS = REGISTRY.gauge(
+    "qtrade_startup_seconds", "Time from process start until the bot is ready to trade")
+
+# 崩溃重启后应在该时间内进入可交易状态
+STARTUP_BUDGET_SEC = 1.0
+# 网关会话缓存文件和默认有效期
+SESSION_FILE = ".gateway_session.json"
+SESSION_TTL_SEC = 6 * 3600
+# 网关请求日志目录
+JOURNAL_DIR = "journal"
+# 交易程序状态快照（见 strategy_state.py）
+STATE_FILE = "strategy_state.json"
+# 合并相同请求的查询接口及结果复用时间（秒）；同时进行的相同请求只发一次，结果在该时间内共享
+COALESCE_TTL_SEC = {
+    "hq/BasicQot": 0.5,
+    "trade/TradeQueryPositionList": 1.0,
+}
+POSITION_ENDPOINT = "trade/TradeQueryPositionList"
+ENTRUST_ENDPOINT = "trade/TradeQueryEntrustList"
+# 委托、持仓列表每页条数（queryCount），及翻页次数上限
+PAGE_SIZE = 100
+MAX_PAGES = 50
+
+
+def _is_auth_error(error_msg):
+    text = str(error_msg).lower()
+    return "login" in text or "登录" in text or "token" in text or "session" in text
+
 
 class HuashengGatewayAPI:
     """华盛 OpenAPI Gateway 接口封装"""
 
-    def __init__(self, gateway_url="http://127.0.0.1:11111"):
+    def __init__(self, gateway_url="http://127.0.0.1:11111", session_file=None, session_ttl=SESSION_TTL_SEC,
+                 journal=None, coalesce_ttl=None):
         """
         初始化 API 客户端
         Args:
             gateway_url: OpenAPI Gateway 地址，默认本地运行
+            session_file: 会话缓存文件；指定后若缓存未过期则跳过登录（快速启动）
+            session_ttl: 新会话的有效期（秒）
+            journal: 可选的 tick_journal.JournalWriter，记录每次请求和响应
+            coalesce_ttl: {接口: 结果复用秒数}，默认 COALESCE_TTL_SEC；不在其中的接口不合并
         """
         self.gateway_url = gateway_url
         self.timeout = 10
-        self._log_in()
+        self.session_file = session_file
+        self.session_ttl = session_ttl
+        self.journal = journal
+        self.coalesce_ttl = dict(COALESCE_TTL_SEC if coalesce_ttl is None else coalesce_ttl)
+        self._flight = SingleFlight()
+        self._http = None
+        self._session_restored = self._restore_session()
+        if not self._session_restored:
+            self._log_in()
+
+    @property
+    def http(self):
+        """复用连接的 requests.Session，首次使用时才导入 requests"""
+        if self._http is None:
+            import requests
+            self._http = requests.Session()
+        return self._http
+
+    def _restore_session(self):
+        """
+        从会话缓存恢复登录状态
+        Returns:
+            缓存有效返回 True
+        """
+        if not self.session_file or not os.path.exists(self.session_file):
+            return False
+        try:
+            with open(self.session_file, 'r', encoding='utf-8') as f:
+                session = json.load(f)
+        except Exception as e:
+            logger.warning("读取会话缓存失败: %s", e)
+            return False
+        if session.get("gateway_url") != self.gateway_url or session.get("expires_at", 0) <= time.time():
+            return False
+        logger.info("复用网关会话，有效期至 %s", datetime.fromtimestamp(session["expires_at"]).isoformat())
+        return True
+
+    def _save_session(self, login_result):
+        if not self.session_file:
+            return
+        session = {
+            "gateway_url": self.gateway_url,
+            "logged_in_at": time.time(),
+            "expires_at": time.time() + self.session_ttl,
+            "login_result": login_result if isinstance(login_result, dict) else None,
+        }
+        tmp_file = self.session_file + ".tmp"
+        try:
+            # 会话凭证只允许当前用户读写；残留的临时文件可能是其他权限创建的，先删除
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+            fd = os.open(tmp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump(session, f)
+            os.replace(tmp_file, self.session_file)
+        except Exception as e:
+            logger.warning("保存会话缓存失败: %s", e)
+
+    def invalidate_session(self):
+        """删除会话缓存，下次启动重新登录"""
+        if self.session_file and os.path.exists(self.session_file):
+            os.remove(self.session_file)
 
     def _encrypt_password(self, password):
         """
@@ -53,6 +177,8 @@ class HuashengGatewayAPI:
         aes_key = base64.b64decode(aes_key_base64)
 
         # 2. 创建AES加密器 (ECB模式)
+        from Crypto.Cipher import AES
+        from Crypto.Util.Padding import pad
         cipher = AES.new(aes_key, AES.MODE_ECB)
 
         # 3. 对密码进行PKCS7填充
@@ -73,31 +199,80 @@ class HuashengGatewayAPI:
             "password": self._encrypt_password("123456")
         }
         result = self._post_request("trade/TradeLogin", params)
-        if result:
+        if result is not None:
             logger.info("华盛 OpenAPI 登录成功")
-        else:
-            logger.error("华盛 OpenAPI 登录失败")
+            self._save_session(result)
+            return True
+        logger.error("华盛 OpenAPI 登录失败")
+        return False
 
-    def _post_request(self, endpoint, params):
-        """统一的POST请求方法"""
+    def _post_request(self, endpoint, params, retries=0):
+        """
+        统一的POST请求方法
+        Args:
+            endpoint: 接口路径，如 "hq/BasicQot"
+            params: 请求参数
+            retries: 网络异常时的重试次数，仅用于幂等的查询接口
+        """
         url = f"{self.gateway_url}/{endpoint}"
         data = {
             "timeout_sec": self.timeout,
             "params": params
         }
-        try:
-            response = requests.post(url, json=data, timeout=self.timeout)
-            result = response.json()
+        for attempt in range(retries + 1):
+            if attempt > 0:
+                GATEWAY_RETRIES.inc(endpoint=endpoint)
+                logger.warning("重试请求: %s, 第 %s 次", endpoint, attempt)
+            start = time.perf_counter()
+            sent_at = time.time()
+            response_data = None
+            try:
+                with span("gateway:" + endpoint):
+                    response = self.http.post(url, json=data, timeout=self.timeout)
+                    result = response.json()
+
+                if not result.get("ok", False):
+                    error_msg = result.get("err", "Unknown error")
+                    if self._session_restored and _is_auth_error(error_msg):
+                        # 缓存的会话已失效：重新登录后重发一次
+                        self._session_restored = False
+                        logger.warning("缓存的网关会话已失效，重新登录")
+                        self.invalidate_session()
+                        if self._log_in():
+                            return self._post_request(endpoint, params, retries)
+                    logger.error("API请求失败: %s, 错误: %s", endpoint, error_msg)
+                    GATEWAY_ERRORS.inc(endpoint=endpoint, kind="api")
+                    return None
+
+                response_data = result.get("data")
+                return response_data
+            except Exception as e:
+                logger.error("请求异常: %s, %s", endpoint, e)
+                GATEWAY_ERRORS.inc(endpoint=endpoint, kind="exception")
+            finally:
+                elapsed = time.perf_counter() - start
+                GATEWAY_LATENCY.observe(elapsed, endpoint=endpoint)
+                if self.journal is not None:
+                    self.journal.record(endpoint, params, response_data, sent_at, elapsed)
+        return None
 
-            if not result.get("ok", False):
-                error_msg = result.get("err", "Unknown error")
-                logger.error(f"API请求失败: {endpoint}, 错误: {error_msg}")
-                return None
+    def _query(self, endpoint, params, retries=0):
+        """
+        幂等查询：coalesce_ttl 中的接口按 (接口, 参数) 合并同时进行的相同请求，并在复用时间内共享结果；
+        返回的字典由多个调用方共享，不应修改
+        """
+        ttl = self.coalesce_ttl.get(endpoint)
+        if ttl is None:
+            return self._post_request(endpoint, params, retries)
+        key = (endpoint, json.dumps(params, sort_keys=True, separators=(",", ":")))
+        result, source = self._flight.do(key, lambda: self._post_request(endpoint, params, retries), ttl)
+        if source != "executed":
+            GATEWAY_COALESCED.inc(endpoint=endpoint, source=source)
+        return result
 
-            return result.get("data")
-        except Exception as e:
-            logger.error(f"请求异常: {endpoint}, {str(e)}")
-            return None
+    def invalidate(self, endpoint=None):
+        """丢弃某个接口（None 表示全部）已缓存的查询结果"""
+        self._flight.forget(None if endpoint is None else lambda key: key[0] == endpoint)
 
     def subscribe_stock(self, stock_code, data_type=2):
         """
@@ -133,15 +308,41 @@ class HuashengGatewayAPI:
             }],
             "mktTmType": 1  # 1=盘中
         }
-        data = self._post_request("hq/BasicQot", params)
+        data = self._query("hq/BasicQot", params, retries=1)
 
         if data and "basicQot" in data and len(data["basicQot"]) > 0:
             return data["basicQot"][0]
         return None
 
-    def place_order(self, exchangeType, stock_code, entrustAmount, entrustPrice, entrustBs, entrustType):
-
-        params = {
+    def get_realtime_quotes(self, stock_codes, data_type=2, batch_size=50):
+        """
+        批量获取实时报价，一次 hq/BasicQot 请求查询多只股票
+        Args:
+            stock_codes: 股票代码列表
+            data_type: 股票类型
+            batch_size: 单次请求的最大股票数
+        Returns:
+            {股票代码: 报价字典}，查询失败的股票不在结果中
+        """
+        quotes = {}
+        for i in range(0, len(stock_codes), batch_size):
+            batch = stock_codes[i:i + batch_size]
+            params = {
+                "security": [{"dataType": data_type, "code": code} for code in batch],
+                "mktTmType": 1  # 1=盘中
+            }
+            data = self._query("hq/BasicQot", params, retries=1)
+            if not data or "basicQot" not in data:
+                continue
+            for code, quote in zip(batch, data["basicQot"]):
+                # 优先使用返回中的代码字段，缺失时按请求顺序对应
+                quotes[quote.get("code", code)] = quote
+        return quotes
+
+    @staticmethod
+    def build_order_params(exchangeType, stock_code, entrustAmount, entrustPrice, entrustBs, entrustType):
+        """构造 TradeEntrust 请求参数，可提前生成后用 send_order 发送"""
+        return {
             "exchangeType": exchangeType,
             "stockCode": stock_code,
             "entrustAmount": entrustAmount,
@@ -149,27 +350,89 @@ class HuashengGatewayAPI:
             "entrustBs": entrustBs,
             "entrustType": entrustType
         }
+
+    def place_order(self, exchangeType, stock_code, entrustAmount, entrustPrice, entrustBs, entrustType):
+
+        params = self.build_order_params(exchangeType, stock_code, entrustAmount, entrustPrice, entrustBs, entrustType)
+        return self.send_order(params)
+
+    def send_order(self, params):
+        """发送已构造好的 TradeEntrust 请求"""
         result = self._post_request("trade/TradeEntrust", params)
+        # 下单后持仓可能变化，不再复用之前的持仓查询结果
+        self.invalidate(POSITION_ENDPOINT)
 
         if result:
-            logger.info(f"下单成功: {stock_code}, 方向: {'买入' if entrustBs == '1' else '卖出'}, 数量: {entrustAmount}")
+            logger.info("下单成功: %s, 方向: %s, 数量: %s", params["stockCode"],
+                        '买入' if params["entrustBs"] == '1' else '卖出', params["entrustAmount"])
 
         return result
 
+    def get_today_entrusts(self, exchange_type="N"):
+        """
+        查询当日委托（含成交数量、成交均价、委托状态）
+        Args:
+            exchange_type: 交易所类型
+        Returns:
+            包含 entrustList 的字典
+        """
+        return self._query_all(ENTRUST_ENDPOINT, "entrustList", exchange_type)
+
     def get_position(self, exchange_type="N"):
         """
         查询持仓
         Args:
             exchange_type: 交易所类型
         Returns:
-            持仓列表
+            包含 positionList 的字典（全部页）
         """
-        params = {
-            "exchangeType": exchange_type,
-            "queryCount": 100,
-            "queryParamStr": "0"
-        }
-        return self._post_request("trade/TradeQueryPositionList", params)
+        return self._query_all(POSITION_ENDPOINT, "positionList", exchange_type)
+
+    def _query_all(self, endpoint, list_key, exchange_type):
+        """
+        翻页查询列表接口：queryParamStr 首页为 "0"，之后为上一页最后一条的 positionStr，直到返回不足一页
+        Args:
+            endpoint: 接口
+            list_key: 返回中列表的字段名
+            exchange_type: 交易所类型
+        Returns:
+            第一页的字典，list_key 替换为全部页合并后的列表；任一页查询失败时返回 None，不返回不完整的列表
+        """
+        first, items, cursor = None, [], "0"
+        for _ in range(MAX_PAGES):
+            params = {"exchangeType": exchange_type, "queryCount": PAGE_SIZE, "queryParamStr": cursor}
+            data = self._query(endpoint, params, retries=1)
+            if not data:
+                if first is not None:
+                    logger.error("%s 翻页查询失败（已取得 %s 条），本次结果作废", endpoint, len(items))
+                return None
+            first = first or data
+            page = data.get(list_key) or []
+            items.extend(page)
+            if len(page) < PAGE_SIZE:
+                break
+            next_cursor = str(page[-1].get("positionStr") or "")
+            if not next_cursor or next_cursor == cursor:
+                logger.warning("%s 返回整页但没有新的 positionStr，无法继续翻页（已取得 %s 条）", endpoint, len(items))
+                break
+            cursor = next_cursor
+        else:
+            logger.warning("%s 翻页超过 %s 页，结果可能不完整", endpoint, MAX_PAGES)
+        # 第一页可能是多个调用方共享的缓存结果，不在原字典上修改
+        return dict(first, **{list_key: items})
+
+    def get_account_funds(self, exchange_type="N"):
+        """
+        查询账户资金
+        Args:
+            exchange_type: 交易所类型
+        Returns:
+            资金字典，重点字段：
+            - assetBalance: 总资产
+            - enableBalance: 可用资金
+        """
+        params = {"exchangeType": exchange_type}
+        return self._post_request("trade/TradeQueryFund", params, retries=1)
 
     def get_stock_position_qty(self, stock_code, exchange_type="N"):
         """
@@ -194,8 +457,13 @@ class HuashengGatewayAPI:
 
 class TradingStrategy:
 
-    def __init__(self, api, strategy_file="stock_strategy.json"):
+    def __init__(self, api, strategy_file="stock_strategy.json", order_manager=None, risk=None, state_file=None):
         self.api = api
+        # 可选的订单管理器：提供后下单异步提交，成交后才写入交易记录
+        self.order_manager = order_manager
+        # 下单前风控：内存中的持仓、权益和未完成订单，由成交事件更新并定期对账
+        self.risk = risk or RiskEngine()
+        self.risk_reconcile_interval = 300
         self.data_type = 20002  # 美股
         self.exchange_type = "P"  # 美股交易所
 
@@ -203,13 +471,45 @@ class TradingStrategy:
         self.volume_threshold_buy = 60_000_000   # 60M
         self.volume_threshold_sell = 40_000_000  # 40M
 
-        # 美东时区
-        self.et_tz = pytz.timezone('America/New_York')
+        # 美东时区（pytz 延迟导入，见 et_tz）
+        self._et_tz = None
 
         self.strategy_file = strategy_file  # 策略文件
+        self.ledger_dir = "."  # 交易记录目录
+        # 与持仓估值共享的行情缓存（见 valuation.py），取得的报价同时写入，估值时不必重复请求
+        self.quote_cache = None
         # Initialize strategy configuration
         self.stock_strategies = self.load_stock_strategies()
 
+        # 预热：收盘窗口前若干分钟提前准备持仓、交易记录和下单参数（见 prearm）
+        self.prearm_minutes = 15
+        self._armed = {}
+        self._armed_date = None
+
+        # 由报价增量更新的均线、波动率、量比等指标（见 indicators.py）
+        # 盘中每 indicator_interval 秒批量采样一次（见 sample_indicators），每个交易日重新开始
+        self.indicators = IndicatorBook()
+        self.indicator_interval = 60
+        self._indicator_date = None
+        self._indicator_sampled_at = None
+
+        # 状态快照：每只股票的执行日期、最近买入、持仓和未完成订单，重启时恢复；state_file 为空时只保存在内存中
+        self.state_file = state_file
+        self.state = StrategyState(state_file)
+        if state_file:
+            self.load_state()
+
+    def now(self):
+        """当前美东时间；回放时替换为模拟时钟（见 journal_replay.py）"""
+        return datetime.now(self.et_tz)
+
+    @property
+    def et_tz(self):
+        if self._et_tz is None:
+            import pytz
+            self._et_tz = pytz.timezone('America/New_York')
+        return self._et_tz
+
     def load_stock_strategies(self):
         """Load stock-specific strategy parameters from a JSON file"""
         default_strategies = {
@@ -223,7 +523,9 @@ class TradingStrategy:
                 "sell_limit_price": 0.0,  # 卖出限价 (0表示市价单)
                 "buy_day_interval": 1,  # 买入天数间隔
                 "buy_price_interval": 2.0,  # 买入价格间隔百分比
-                "max_position": 100.0  # 最大仓位百分比
+                "max_position": 100.0,  # 最大仓位百分比
+                "max_volatility": 0.0,  # 报价收益率滚动波动率上限（%），高于时不买入，0表示不限制
+                "min_volume_ratio": 0.0  # 量比下限，低于时不买入，0表示不限制
             }
         }
 
@@ -269,8 +571,9 @@ class TradingStrategy:
             volume: Market volume at time of trade
             order_result: Result from the order placement API call
         """
+        now = self.now()
         trade_record = [
-            datetime.now(self.et_tz).isoformat(),
+            now.isoformat(),
             symbol,
             action,
             quantity,
@@ -280,30 +583,39 @@ class TradingStrategy:
         ]
 
         # Define the CSV file path
-        trade_log_file = f"{symbol.lower()}_trading.csv"  # Use CSV format for easy loading
+        trade_log_file = ledger_path(symbol, self.ledger_dir)  # Use CSV format for easy loading
 
         # Check if file exists to determine if we need to write headers
         file_exists = os.path.isfile(trade_log_file)
+        ledger_before = self._ledger_signature(symbol)
 
         # Write the trade record to the CSV file
         try:
-            with open(trade_log_file, 'a', newline='', encoding='utf-8') as csvfile:
-                writer = csv.writer(csvfile)
-
-                # Write header if file is new
-                if not file_exists:
-                    writer.writerow(['timestamp', 'symbol', 'action', 'quantity', 'price', 'volume', 'order_result'])
-
-                # Write the trade record
-                writer.writerow(trade_record)
-
-            logger.info(f"Trade recorded: {action} {quantity} shares of {symbol} at ${price}")
+            # 与 ledger_archive.compact_ledger 互斥，归档改写热文件时不丢失新追加的记录
+            with LEDGER_WRITE_LATENCY.time(symbol=symbol), span("csv_write"), ledger_lock(trade_log_file):
+                with open(trade_log_file, 'a', newline='', encoding='utf-8') as csvfile:
+                    writer = csv.writer(csvfile)
+
+                    # Write header if file is new
+                    if not file_exists:
+                        writer.writerow(['timestamp', 'symbol', 'action', 'quantity', 'price', 'volume', 'order_result'])
+
+                    # Write the trade record
+                    writer.writerow(trade_record)
+
+            logger.info("Trade recorded: %s %s shares of %s at $%s", action, quantity, symbol, price)
+            self.risk.on_fill(symbol, "1" if action == "buy" else "2", quantity, price)
+            self._update_armed_after_trade(symbol, action, quantity, price)
+            self.state.on_ledger_write(symbol, action, now.date(), price, ledger_before,
+                                       self._ledger_signature(symbol))
+            self.save_state()
         except Exception as e:
-            logger.error(f"Failed to save trade log: {str(e)}")
+            LEDGER_WRITE_ERRORS.inc(symbol=symbol)
+            logger.error("Failed to save trade log: %s", e)
 
     def is_trading_time(self):
         """检查是否在交易时间"""
-        now_et = datetime.now(self.et_tz)
+        now_et = self.now()
 
         # 检查是否为工作日
         if now_et.weekday() >= 5:  # 周六日
@@ -317,34 +629,206 @@ class TradingStrategy:
 
     def is_near_close(self, minutes_before=10):
         """检查是否接近收盘"""
-        now_et = datetime.now(self.et_tz)
+        now_et = self.now()
         market_close = now_et.replace(hour=16, minute=0, second=0, microsecond=0)
 
         time_to_close = (market_close - now_et).total_seconds() / 60
 
         return 0 < time_to_close <= minutes_before
 
+    def seconds_until_close_window(self, minutes_before=10):
+        """距离收盘窗口打开还有多少秒，已在窗口内或已收盘返回 0"""
+        now_et = self.now()
+        market_close = now_et.replace(hour=16, minute=0, second=0, microsecond=0)
+        return max(0.0, (market_close - now_et).total_seconds() - minutes_before * 60)
+
+    def should_prearm(self):
+        """进入预热窗口（含收盘窗口本身）且今日尚未预热"""
+        if self.is_armed():
+            return False
+        return self.is_trading_time() and self.is_near_close(self.prearm_minutes)
+
+    def prearm(self, symbols):
+        """
+        预热：在收盘窗口前完成除最终价格判断和发送外的所有工作
+        - 批量拉取一次报价，同时建立到网关的长连接
+        - 一次查询全部持仓
+        - 读取各股票交易记录中的上次买入日期和价格
+        - 按当前价格预先计算下单数量、限价，并生成买卖两个方向的委托参数
+        Args:
+            symbols: 需要预热的股票列表
+        """
+        start = time.perf_counter()
+        self._armed = {}
+        self._armed_date = None
+
+        quotes = self.api.get_realtime_quotes(list(symbols), self.data_type)
+        if self.quote_cache is not None:
+            for symbol, quote in quotes.items():
+                self.quote_cache.observe(symbol, quote)
+
+        positions = self.query_positions()
+        self.reconcile_risk(positions)
+        if self.risk.equity is None:
+            # 账户资金查询失败时重试一次；仍未知时告警：有仓位上限的买单在收盘窗口内都会被风控拒绝
+            self.reconcile_risk(positions)
+        self._check_equity_known(symbols)
+
+        armed = {}
+        for symbol in symbols:
+            strategy = self.get_stock_strategy(symbol)
+            if not strategy:
+                continue
+            entry = {
+                "strategy": strategy,
+                "position": positions.get(symbol, 0),
+                "last_buy_date": self.get_last_buy_date(symbol),
+                "last_buy_price": self.get_last_buy_price(symbol),
+                "ref_price": None,
+                "orders": None,
+            }
+            quote = quotes.get(symbol) or {}
+            ref_price = quote.get("lastPrice", 0)
+            if ref_price:
+                entry["ref_price"] = ref_price
+                entry["orders"] = self._build_orders(symbol, strategy, ref_price)
+            armed[symbol] = entry
+
+        self._armed = armed
+        self._armed_date = self.now().date()
+        logger.info("预热完成: %s 只股票，%s 只有报价，持仓 %s 只，耗时 %.3fs",
+                    len(armed), len(quotes), len(positions), time.perf_counter() - start)
+
+    def _check_equity_known(self, symbols):
+        # 与 RiskEngine.check 相同：max_position 为 None 或 >= 100 表示不限制
+        limited = []
+        for symbol in symbols:
+            max_position = (self.get_stock_strategy(symbol) or {}).get("max_position")
+            if max_position is not None and float(max_position) < 100:
+                limited.append(symbol)
+        unknown = self.risk.equity is None
+        RISK_EQUITY_UNKNOWN.set(1 if unknown else 0)
+        if unknown and limited:
+            logger.error("账户权益未知（TradeQueryFund 无结果），以下股票的买单将被仓位上限检查拒绝: %s", limited)
+        return not unknown
+
+    def query_positions(self):
+        """一次查询全部持仓，返回 {股票代码: 可卖数量}"""
+        positions = {}
+        data = self.api.get_position(self.exchange_type)
+        if data and "positionList" in data:
+            for pos in data["positionList"]:
+                positions[pos.get("stockCode")] = int(pos.get("canSellAmount", 0))
+        return positions
+
+    def reconcile_risk(self, positions=None):
+        """
+        用网关的持仓、账户资金和订单管理器中的未完成订单校正风控状态
+        Args:
+            positions: 已查询到的持仓，为空时重新查询
+        """
+        if positions is None:
+            positions = self.query_positions()
+        funds = self.api.get_account_funds(self.exchange_type)
+        equity = float(funds["assetBalance"]) if funds and funds.get("assetBalance") else None
+        open_keys = {o.key for o in self.order_manager.open_orders()} if self.order_manager else None
+        self.risk.reconcile(positions, equity, open_keys)
+        self.save_state()
+
+    def should_reconcile_risk(self):
+        """盘中、收盘窗口外且距上次对账超过间隔（避免在关键路径上增加查询）"""
+        if not self.is_trading_time() or self.is_near_close():
+            return False
+        last = self.risk.reconciled_at
+        return last is None or time.time() - last >= self.risk_reconcile_interval
+
+    def is_armed(self):
+        """今日是否已完成预热"""
+        return self._armed_date is not None and self._armed_date == self.now().date()
+
+    def _armed_entry(self, symbol):
+        if not self.is_armed():
+            return None
+        return self._armed.get(symbol)
+
+    def _update_armed_after_trade(self, symbol, action, quantity, price):
+        """交易记录写入后同步更新预热缓存，保证后续判断与交易记录一致"""
+        entry = self._armed_entry(symbol)
+        if entry is None:
+            return
+        if action == "buy":
+            entry["last_buy_date"] = self.now().date()
+            entry["last_buy_price"] = float(price)
+            entry["position"] += int(quantity)
+        else:
+            entry["position"] = max(0, entry["position"] - int(quantity))
+
+    def _build_orders(self, symbol, strategy, last_price):
+        """
+        按给定价格计算数量、限价和买卖委托参数
+        Returns:
+            {"quantity", "buy_price", "sell_price", "buy_params", "sell_params"}
+        """
+        # Calculate quantity based on strategy
+        quantity = int(strategy['buy_total'] / last_price)
+        # Use limit price if specified in strategy, otherwise use market price
+        buy_price = strategy['buy_limit_price'] if strategy['buy_limit_price'] > 0 else str(last_price-1)
+        sell_price = strategy['sell_limit_price'] if strategy['sell_limit_price'] > 0 else str(last_price+1)
+        return {
+            "quantity": quantity,
+            "buy_price": buy_price,
+            "sell_price": sell_price,
+            "buy_params": HuashengGatewayAPI.build_order_params(
+                self.exchange_type, symbol, quantity, buy_price, "1", "3"),
+            "sell_params": HuashengGatewayAPI.build_order_params(
+                self.exchange_type, symbol, quantity, sell_price, "2", "3"),
+        }
+
     def load_state(self):
-        if os.path.exists(self.state_file):
-            try:
-                with open(self.state_file, 'r') as f:
-                    data = json.load(f)
-                    if data.get('last_execution_date'):
-                        return datetime.strptime(data['last_execution_date'], '%Y-%m-%d').date()
-            except Exception as e:
-                logger.error(f"Failed to load state: {str(e)}")
-        return None
+        """
+        读取状态快照并恢复到风控和订单管理器，不访问网关：
+        持仓和权益在下一次对账（预热、下单前或定期对账）时校正，恢复的订单由委托轮询校正
+        Returns:
+            是否读到了快照
+        """
+        start = time.perf_counter()
+        self.state = StrategyState.load(self.state_file)
+        if self.state.saved_at is None:
+            return False
+
+        # 未完成订单只在同一交易日内有效
+        open_orders = self.state.open_orders if self.state.trade_date == self.now().date() else []
+        self.risk.restore(self.state.positions, self.state.equity, open_orders)
+        if self.order_manager is not None and open_orders:
+            self.order_manager.restore(open_orders)
+            unknown = [o["symbol"] for o in open_orders if not o.get("entrust_id")]
+            if unknown:
+                # 崩溃前提交结果未知的订单：从当日委托接管，避免漏记成交
+                self.order_manager.adopt_today_entrusts(set(unknown), self.now().date())
+        logger.info("已读取状态快照 %s（写入于 %s）: %s 只股票, %s 笔未完成订单, 耗时 %.1fms",
+                    self.state_file, self.state.saved_at, len(self.state.symbols), len(open_orders),
+                    (time.perf_counter() - start) * 1000)
+        return True
 
     def save_state(self):
-        try:
-            with open(self.state_file, 'w') as f:
-                json.dump({'last_execution_date': self.last_execution_date.strftime('%Y-%m-%d') if self.last_execution_date else None}, f)
-            logger.debug("State saved successfully")
-        except Exception as e:
-            logger.error(f"Failed to save state: {str(e)}")
+        """把当前状态整体写入快照（原子替换）；在每次状态变化后调用"""
+        if not self.state_file:
+            return
+        state = self.state
+        state.trade_date = self.now().date()
+        # 委托确认回调在下单线程中调用，持仓由风控在自己的锁内复制
+        state.positions, state.equity = self.risk.snapshot_positions()
+        if self.order_manager is not None:
+            state.open_orders = [dict(o.to_dict(), entrust_type=o.entrust_type, context=o.context)
+                                 for o in self.order_manager.open_orders()]
+        state.save()
 
     def execute_strategy(self, symbol):
         """执行交易策略 for a specific stock"""
+        with SYMBOL_LATENCY.time(symbol=symbol):
+            self._execute_strategy(symbol)
+
+    def _execute_strategy(self, symbol):
         # 检查是否在交易时间
         if not self.is_trading_time():
             logger.debug("非交易时间，跳过")
@@ -352,106 +836,243 @@ class TradingStrategy:
 
         # 检查是否接近收盘
         if not self.is_near_close():
-            logger.debug(f"未到收盘前10分钟，跳过 {symbol}")
+            logger.debug("未到收盘前10分钟，跳过 %s", symbol)
+            return
+
+        # 每日最多执行一次（含重启前已执行的，见状态快照）
+        if self.state.executed_on(symbol, self.now().date()):
+            logger.debug("%s 今日已执行，跳过", symbol)
             return
 
         # 获取实时报价
         quote = self.api.get_realtime_quote(symbol, self.data_type)
 
         if not quote:
-            logger.error(f"无法获取 {symbol} 实时报价")
+            logger.error("无法获取 %s 实时报价", symbol)
             return
+        if self.quote_cache is not None:
+            self.quote_cache.observe(symbol, quote)
 
         # 获取当日累计成交量
         volume = quote.get("volume", 0)
         last_price = quote.get("lastPrice", 0)
 
-        logger.info(f"{symbol} 当前价格: ${last_price:.2f}, 当日成交量: {volume:,}")
+        logger.info("%s 当前价格: $%.2f, 当日成交量: %s", symbol, last_price, volume)
+        # 指标只由 sample_indicators 等间隔更新，这里的报价不作为样本
+        self.risk.update_price(symbol, last_price)
+
+        # 已预热时直接使用缓存的策略、持仓和委托参数
+        armed = self._armed_entry(symbol)
 
         # Get the strategy for this stock
-        strategy = self.get_stock_strategy(symbol)
+        strategy = armed["strategy"] if armed else self.get_stock_strategy(symbol)
         if not strategy:
-            logger.error(f"No strategy available for {symbol}, skipping trade")
+            logger.error("No strategy available for %s, skipping trade", symbol)
             return
 
-        # Calculate quantity based on strategy
-        quantity = int(strategy['buy_total'] / last_price)
+        # 价格与预热时一致则复用预生成的委托参数，否则按当前价格重新计算
+        if armed and armed["orders"] and armed["ref_price"] == last_price:
+            orders = armed["orders"]
+        else:
+            orders = self._build_orders(symbol, strategy, last_price)
+        quantity = orders["quantity"]
 
         # Check buy conditions based on strategy
         if last_price <= strategy['buy_point']:
             # Check date and price intervals before placing buy order
-            if self.check_buy_conditions(symbol, strategy, last_price):
-                logger.info(f"价格 ${last_price:.2f} <= 买入点 {strategy['buy_point']:.2f}，执行买入 {symbol}")
-
-                # Use limit price if specified in strategy, otherwise use market price
-                buy_price = strategy['buy_limit_price'] if strategy['buy_limit_price'] > 0 else str(last_price-1)
-
-                result = self.api.place_order(
-                    exchangeType=self.exchange_type,
-                    stock_code=symbol,
-                    entrustAmount=quantity,
-                    entrustPrice=buy_price,
-                    entrustBs="1",  # Buy
-                    entrustType="3",  # Limit order if price specified
-                )
+            if (self.check_buy_conditions(symbol, strategy, last_price)
+                    and self.check_indicator_conditions(symbol, strategy)):
+                logger.info("价格 $%.2f <= 买入点 %.2f，执行买入 %s", last_price, strategy['buy_point'], symbol)
 
-                if result:
-                    logger.info(f"{symbol} 买入订单已提交")
-
-                    # Record the trade
-                    self.record_trade(
-                        symbol=symbol,
-                        action="buy",
-                        quantity=quantity,
-                        price=last_price,
-                        volume=volume,
-                        order_result=result
-                    )
+                self.submit_order(symbol, "1", quantity, orders["buy_price"], last_price, volume,
+                                  params=orders["buy_params"], max_position=strategy.get('max_position'))
             else:
-                logger.info(f"{symbol} 未满足买入条件（日期或价格间隔）")
+                logger.info("%s 未满足买入条件（日期、价格间隔或指标过滤）", symbol)
 
         elif last_price >= strategy['sell_point']:
             # Check sell conditions based on strategy
-            logger.info(f"价格 ${last_price:.2f} >= 卖出点 {strategy['sell_point']:.2f}，检查持仓 {symbol}")
+            logger.info("价格 $%.2f >= 卖出点 %.2f，检查持仓 %s", last_price, strategy['sell_point'], symbol)
 
-            position_qty = self.api.get_stock_position_qty(
-                symbol,
-                self.exchange_type
-            )
+            if armed:
+                position_qty = armed["position"]
+            else:
+                position_qty = self.api.get_stock_position_qty(
+                    symbol,
+                    self.exchange_type
+                )
 
             if position_qty > 0:
-                logger.info(f"当前持仓: {position_qty} 股，执行卖出 {symbol}")
-
-                # Use limit price if specified in strategy, otherwise use market price
-                sell_price = strategy['sell_limit_price'] if strategy['sell_limit_price'] > 0 else str(last_price+1)
-
-                result = self.api.place_order(
-                    exchangeType=self.exchange_type,
-                    stock_code=symbol,
-                    entrustAmount=quantity,
-                    entrustPrice=sell_price,
-                    entrustBs="2",  # Sell
-                    entrustType="3",  # Limit order if price specified
-                )
+                logger.info("当前持仓: %s 股，执行卖出 %s", position_qty, symbol)
 
-                if result:
-                    logger.info(f"{symbol} 卖出订单已提交")
-
-                    # Record the trade
-                    self.record_trade(
-                        symbol=symbol,
-                        action="sell",
-                        quantity=quantity,
-                        price=last_price,
-                        volume=volume,
-                        order_result=result
-                    )
+                self.submit_order(symbol, "2", quantity, orders["sell_price"], last_price, volume,
+                                  params=orders["sell_params"])
             else:
-                logger.info(f"{symbol} 无持仓，跳过卖出")
+                logger.info("%s 无持仓，跳过卖出", symbol)
 
         else:
             # Price not in buy/sell range
-            logger.info(f"{symbol} 价格 ${last_price:.2f} 不在买卖点范围内，不执行交易")
+            logger.info("%s 价格 $%.2f 不在买卖点范围内，不执行交易", symbol, last_price)
+
+    def submit_order(self, symbol, side, quantity, price, last_price, volume, params=None, max_position=None):
+        """
+        提交限价单
+        - 有订单管理器时异步提交，成交后由 on_order_fill 记录真实成交
+        - 否则同步提交，提交成功即记录（旧行为）
+        Args:
+            symbol: 股票代码
+            side: "1" 买入 / "2" 卖出
+            quantity: 委托数量
+            price: 委托价格
+            last_price: 决策时的最新价
+            volume: 决策时的当日成交量
+            params: 预先生成的 TradeEntrust 参数（同步提交时直接发送）
+            max_position: 策略的最大仓位百分比，由风控检查
+        """
+        action = "buy" if side == "1" else "sell"
+
+        # 不在下单路径上对账：对账在预热（收盘窗口前）和窗口外的定期对账中完成
+        allowed, reason = self.risk.check(symbol, side, quantity, price, max_position)
+        if not allowed:
+            RISK_REJECTS.inc(symbol=symbol, side=side)
+            logger.warning("%s %s订单被风控拒绝: %s", symbol, '买入' if side == "1" else '卖出', reason)
+            return
+
+        if self.order_manager is not None:
+            if self.order_manager.has_open_order(symbol, side):
+                logger.info("%s 已有未完成的%s订单，跳过", symbol, '买入' if side == "1" else '卖出')
+                return
+            # 先记录执行日期再交给提交线程：订单没有任何成交就结束时由 on_order_close 撤销，允许重试
+            self.state.mark_executed(symbol, self.now().date())
+            order, future = self.order_manager.submit(
+                symbol, side, quantity, price,
+                entrust_type="3",
+                trade_date=self.now().date(),
+                context={"action": action, "volume": volume, "last_price": last_price}
+            )
+            if future is not None:
+                self.risk.on_order_submitted(order.key, symbol, side, quantity, price)
+                if not order.is_open:
+                    # 提交线程可能已经失败并在登记之前回调了 on_order_close
+                    self.risk.on_order_update(order.key, order.filled_quantity, False)
+            self.save_state()
+            logger.info("%s %s订单已排队提交", symbol, '买入' if side == "1" else '卖出')
+            return
+
+        if params is None:
+            params = self.api.build_order_params(
+                exchangeType=self.exchange_type,
+                stock_code=symbol,
+                entrustAmount=quantity,
+                entrustPrice=price,
+                entrustBs=side,
+                entrustType="3",  # Limit order if price specified
+            )
+        result = self.api.send_order(params)
+
+        if result:
+            logger.info("%s %s订单已提交", symbol, '买入' if side == "1" else '卖出')
+            self.risk.on_order_submitted(None, symbol, side, quantity, price)
+            # 先记录执行日期：即使写交易记录前崩溃，重启后也不会重复下单
+            self.state.mark_executed(symbol, self.now().date())
+            self.save_state()
+
+            # Record the trade
+            self.record_trade(
+                symbol=symbol,
+                action=action,
+                quantity=quantity,
+                price=last_price,
+                volume=volume,
+                order_result=result
+            )
+
+    def on_order_ack(self, order):
+        """订单对应到网关委托（得到 entrust_id）后保存快照，重启后按委托号恢复，不必再按属性匹配"""
+        self.save_state()
+
+    def on_order_fill(self, order, fill_quantity, fill_price):
+        """订单管理器的成交回调：按真实成交数量和价格写入交易记录"""
+        self.risk.on_order_update(order.key, order.filled_quantity, order.is_open)
+        self.record_trade(
+            symbol=order.symbol,
+            action=order.context.get("action", "buy" if order.side == "1" else "sell"),
+            quantity=fill_quantity,
+            price=fill_price,
+            volume=order.context.get("volume", 0),
+            order_result=order.to_dict()
+        )
+
+    def on_order_close(self, order):
+        """
+        订单进入终态：从风控的未完成订单中移出，包括没有任何成交就结束的订单（废单、撤单、提交失败）；
+        没有任何成交时撤销当日的执行记录，收盘窗口内可以再次下单
+        """
+        self.risk.on_order_update(order.key, order.filled_quantity, False)
+        if order.filled_quantity == 0 and order.status in (STATUS_REJECTED, STATUS_CANCELLED):
+            if self.state.clear_executed(order.symbol, self.now().date()):
+                logger.warning("%s 订单 %s 未成交即结束（%s），允许今日重新下单", order.symbol, order.key, order.status)
+        self.save_state()
+
+    def on_tick(self, symbol, last_price, cum_volume, ts=None):
+        """用一次报价或推送的 tick 更新流式指标"""
+        self.indicators.update(symbol, last_price, cum_volume, ts)
+        self.risk.update_price(symbol, last_price)
+
+    def sample_indicators(self, symbols):
+        """
+        盘中批量拉取一次报价作为指标样本，整个交易时段持续采样，与是否已执行、是否在收盘窗口无关
+        - 距上次采样不足 indicator_interval 时跳过（如为收盘窗口提前醒来），保证样本等间隔
+        - 新的交易日清空指标，窗口不跨越隔夜跳空
+        Args:
+            symbols: 股票列表
+        Returns:
+            本次是否采样
+        """
+        if not self.is_trading_time():
+            return False
+        now = self.now()
+        if self._indicator_date != now.date():
+            self.indicators.reset()
+            self._indicator_date = now.date()
+            self._indicator_sampled_at = None
+        ts = now.timestamp()
+        if self._indicator_sampled_at is not None and ts - self._indicator_sampled_at < self.indicator_interval * 0.9:
+            return False
+        self._indicator_sampled_at = ts
+
+        quotes = self.api.get_realtime_quotes(list(symbols), self.data_type)
+        for symbol, quote in quotes.items():
+            if self.quote_cache is not None:
+                self.quote_cache.observe(symbol, quote)
+            self.on_tick(symbol, quote.get("lastPrice", 0), quote.get("volume"), ts)
+        return True
+
+    def check_indicator_conditions(self, symbol, strategy):
+        """
+        基于流式指标的买入过滤，参数为 0 表示不启用；指标窗口尚未填满时不过滤（记录警告）
+        样本为 sample_indicators 每 indicator_interval 秒一次的报价，默认窗口 20 个样本即最近 20 分钟
+        - max_volatility: 样本间收益率的滚动标准差（%）高于该值时不买入
+        - min_volume_ratio: 最近一个采样间隔的成交量 / 滚动平均成交量 低于该值时不买入
+        """
+        snapshot = self.indicators.snapshot(symbol)
+
+        max_volatility = strategy.get('max_volatility', 0)
+        volatility = snapshot['volatility']
+        if max_volatility > 0 and volatility is None:
+            logger.warning("%s 指标样本不足（%s 个），本次不做波动率过滤", symbol, snapshot['samples'])
+        elif max_volatility > 0 and volatility * 100 > max_volatility:
+            logger.info("%s 波动率 %.3f%% 高于上限 %.3f%%，不买入", symbol, volatility * 100, max_volatility)
+            return False
+
+        min_volume_ratio = strategy.get('min_volume_ratio', 0)
+        volume_ratio = snapshot['volume_ratio']
+        if min_volume_ratio > 0 and volume_ratio is None:
+            logger.warning("%s 指标样本不足（%s 个），本次不做量比过滤", symbol, snapshot['samples'])
+        elif min_volume_ratio > 0 and volume_ratio < min_volume_ratio:
+            logger.info("%s 量比 %.2f 低于下限 %.2f，不买入", symbol, volume_ratio, min_volume_ratio)
+            return False
+
+        return True
 
     def check_buy_conditions(self, symbol, strategy, current_price):
         """
@@ -468,16 +1089,16 @@ class TradingStrategy:
         if days_interval > 0:
             last_buy_date = self.get_last_buy_date(symbol)
             if last_buy_date:
-                days_since_last_buy = (datetime.now(self.et_tz).date() - last_buy_date).days
+                days_since_last_buy = (self.now().date() - last_buy_date).days
                 if days_since_last_buy < days_interval:
-                    logger.info(f"{symbol} 未到买入日期间隔: 距离上次买入 {days_since_last_buy} 天, 需要等待 {days_interval} 天")
+                    logger.info("%s 未到买入日期间隔: 距离上次买入 %s 天, 需要等待 %s 天", symbol, days_since_last_buy, days_interval)
                     return False
             else:
                 # If no previous buy records, we can proceed
-                logger.info(f"{symbol} 无历史买入记录，可以执行买入")
+                logger.info("%s 无历史买入记录，可以执行买入", symbol)
         else:
             # If days interval is 0 or negative, there's no date restriction
-            logger.info(f"{symbol} 买入日期间隔设置为0，无日期限制")
+            logger.info("%s 买入日期间隔设置为0，无日期限制", symbol)
 
         # Check price interval (percentage difference from last executed price)
         # For price interval checking, we need to read the last buy price from the trade history
@@ -485,7 +1106,8 @@ class TradingStrategy:
         if last_buy_price and strategy['buy_price_interval'] > 0:
             price_diff_pct = ((current_price - last_buy_price) / last_buy_price) * 100
             if abs(price_diff_pct) < strategy['buy_price_interval']:
-                logger.info(f"{symbol} 未到买入价格间隔: 当前价格 {current_price:.2f}, 上次买入价 {last_buy_price:.2f}, 价差 {price_diff_pct:.2f}%, 需要至少 {strategy['buy_price_interval']:.2f}%")
+                logger.info("%s 未到买入价格间隔: 当前价格 %.2f, 上次买入价 %.2f, 价差 %.2f%%, 需要至少 %.2f%%",
+                            symbol, current_price, last_buy_price, price_diff_pct, strategy['buy_price_interval'])
                 return False
 
         return True
@@ -498,32 +1120,10 @@ class TradingStrategy:
         Returns:
             Last buy date or None if no previous buy records
         """
-        trade_log_file = f"{symbol.lower()}_trading.csv"
-        if not os.path.exists(trade_log_file):
-            return None
-
-        try:
-            # Read the last few lines of the CSV to find the most recent buy
-            with open(trade_log_file, 'r', encoding='utf-8') as csvfile:
-                lines = csvfile.readlines()
-
-                # Skip header and read from the end
-                for i in range(len(lines) - 1, 0, -1):
-                    line = lines[i].strip()
-                    if line:
-                        parts = line.split(',')
-                        # Format: timestamp, symbol, action, quantity, price, volume, order_result
-                        if len(parts) >= 3 and parts[2].strip() == "buy":
-                            # Extract the date from the timestamp (first field)
-                            # Timestamp format is like: 2023-11-17T10:30:00-05:00
-                            timestamp_str = parts[0].replace('"', '').strip()
-                            # Parse the date part
-                            date_str = timestamp_str.split('T')[0]
-                            return datetime.strptime(date_str, '%Y-%m-%d').date()
-        except Exception as e:
-            logger.error(f"Error reading last buy date for {symbol}: {str(e)}")
-
-        return None
+        armed = self._armed_entry(symbol)
+        if armed is not None:
+            return armed["last_buy_date"]
+        return self._last_buy(symbol)[0]
 
     def get_last_buy_price(self, symbol):
         """
@@ -533,9 +1133,42 @@ class TradingStrategy:
         Returns:
             Last buy price or None if no previous buy records
         """
-        trade_log_file = f"{symbol.lower()}_trading.csv"
-        if not os.path.exists(trade_log_file):
+        armed = self._armed_entry(symbol)
+        if armed is not None:
+            return armed["last_buy_price"]
+        return self._last_buy(symbol)[1]
+
+    def _ledger_signature(self, symbol):
+        """交易记录文件的 (大小, 修改时间)，不存在时为 None"""
+        try:
+            st = os.stat(ledger_path(symbol, self.ledger_dir))
+        except OSError:
             return None
+        return st.st_size, st.st_mtime_ns
+
+    def _last_buy(self, symbol):
+        """
+        最近一次买入的 (日期, 价格)：交易记录未变化时使用状态快照中的缓存，否则扫描交易记录并更新缓存
+        """
+        signature = self._ledger_signature(symbol)
+        cached = self.state.last_buy(symbol, signature)
+        if cached is not None:
+            return cached
+        last_buy = self._scan_last_buy(symbol)
+        if signature is not None:
+            self.state.set_last_buy(symbol, last_buy[0], last_buy[1], signature)
+            self.save_state()
+        return last_buy
+
+    def _scan_last_buy(self, symbol):
+        """
+        从交易记录中查找最近一次买入
+        Returns:
+            (买入日期, 买入价格)，没有买入记录时为 (None, None)
+        """
+        trade_log_file = ledger_path(symbol, self.ledger_dir)
+        if not os.path.exists(trade_log_file):
+            return self._archived_last_buy(symbol)
 
         try:
             # Read the last few lines of the CSV to find the most recent buy
@@ -549,15 +1182,73 @@ class TradingStrategy:
                         parts = line.split(',')
                         # Format: timestamp, symbol, action, quantity, price, volume, order_result
                         if len(parts) >= 5 and parts[2].strip() == "buy":
-                            return float(parts[4])  # Return the price from the last buy
+                            # Timestamp format is like: 2023-11-17T10:30:00-05:00
+                            timestamp_str = parts[0].replace('"', '').strip()
+                            date_str = timestamp_str.split('T')[0]
+                            return datetime.strptime(date_str, '%Y-%m-%d').date(), float(parts[4])
         except Exception as e:
-            logger.error(f"Error reading last buy price for {symbol}: {str(e)}")
+            logger.error("Error reading last buy for %s: %s", symbol, e)
 
-        return None
+        # 热文件只保留当月记录，更早的买入在归档中
+        return self._archived_last_buy(symbol)
 
+    def _archived_last_buy(self, symbol):
+        """
+        从交易记录归档（见 ledger_archive.py）中查找最近一次买入
+        Returns:
+            (买入日期, 买入价格)，没有归档或没有买入记录时为 (None, None)
+        """
+        if not os.path.isdir(archive_dir(self.ledger_dir)):
+            return None, None
+        try:
+            last_buy = last_archived_buy(symbol, self.ledger_dir)
+        except Exception as e:
+            logger.error("Error reading ledger archive for %s: %s", symbol, e)
+            return None, None
+        if last_buy is None:
+            return None, None
+        return last_buy[0].date(), float(last_buy[1])
+
+
+def add_risk_arguments(parser):
+    """风控名义金额上限的命令行参数，单进程和分片版本共用"""
+    parser.add_argument("--max-order-notional", type=float, default=0.0, help="单笔委托金额上限，0 表示不限制")
+    parser.add_argument("--max-symbol-notional", type=float, default=0.0,
+                        help="单票持仓（含未成交买单）金额上限，0 表示不限制")
+    parser.add_argument("--max-gross-notional", type=float, default=0.0,
+                        help="全部持仓（含未成交买单）金额上限，0 表示不限制")
+
+
+def risk_limits_from_args(args):
+    return {
+        "max_order_notional": args.max_order_notional,
+        "max_symbol_notional": args.max_symbol_notional,
+        "max_gross_notional": args.max_gross_notional,
+    }
+
+
+def main(metrics_port=None, log_mode="queued", log_rotate="size", fast_start=False, journal_dir=JOURNAL_DIR,
+         profile_dir=None, state_file=STATE_FILE, valuation_interval=VALUATION_INTERVAL_SEC, risk_limits=None):
+    """
+    主程序
+    Args:
+        metrics_port: 若指定，则在该端口暴露 Prometheus /metrics
+        log_mode: "queued" 后台线程写日志，"sync" 同步写日志
+        log_rotate: "size" / "time" / "none"，trading.log 的轮转方式
+        fast_start: 复用本地缓存的网关会话，跳过登录
+        journal_dir: 网关请求日志目录（每天一个文件），为空表示不记录
+        profile_dir: 剖析结果目录，为空时按环境变量 QTRADE_PROFILE 决定是否开启（见 profiling.py）
+        state_file: 状态快照文件，为空表示不保存（见 strategy_state.py）
+        valuation_interval: 持仓估值间隔（秒），0 表示不估值（见 valuation.py）
+        risk_limits: RiskEngine 的名义金额上限 {"max_order_notional", "max_symbol_notional", "max_gross_notional"}，
+                     缺省或为 0 表示不限制（见 risk.py）
+    """
+    setup_logging(
+        log_file='trading.log',
+        queued=(log_mode == "queued"),
+        rotate=None if log_rotate == "none" else log_rotate
+    )
 
-def main():
-    """主程序"""
     logger.info("=" * 60)
     logger.info("量化交易程序启动")
     logger.info("=" * 60)
@@ -568,11 +1259,34 @@ def main():
     logger.info("  - 每日最多执行一次")
     logger.info("=" * 60)
 
-    # 初始化API
-    api = HuashengGatewayAPI()
+    if metrics_port:
+        start_metrics_server(metrics_port)
+        logger.info(f"指标服务已启动: http://0.0.0.0:{metrics_port}/metrics")
+
+    # 可选剖析：每轮 tick、网关请求和交易记录写入的耗时，以及采样调用栈，退出时写出
+    profiler = profiling.enable("bot", profile_dir)
+    if profiler is not None:
+        logger.info(f"剖析已开启，结果目录: {profiler.output_dir}")
+
+    # 网关请求日志，用于复盘和回放（见 journal_replay.py）
+    journal = None
+    if journal_dir:
+        journal = JournalWriter(os.path.join(journal_dir, f"gateway_{datetime.now().strftime('%Y%m%d')}.qtj"))
+        logger.info(f"网关请求日志: {journal.path}")
 
-    # 创建策略实例
-    strategy = TradingStrategy(api)
+    # 初始化API
+    api = HuashengGatewayAPI(session_file=SESSION_FILE if fast_start else None, journal=journal)
+
+    # 创建策略实例，订单经由订单管理器并发提交，成交后记录
+    order_manager = OrderManager(api)
+    risk = RiskEngine(**(risk_limits or {}))
+    logger.info("风控金额上限: 单笔 %s, 单票 %s, 总持仓 %s（0 表示不限制）",
+                risk.max_order_notional, risk.max_symbol_notional, risk.max_gross_notional)
+    strategy = TradingStrategy(api, order_manager=order_manager, risk=risk, state_file=state_file)
+    order_manager.on_fill = strategy.on_order_fill
+    order_manager.on_ack = strategy.on_order_ack
+    order_manager.on_close = strategy.on_order_close
+    order_manager.exchange_type = strategy.exchange_type
 
     # 获取所有配置的股票
     stocks = list(strategy.stock_strategies.keys())
@@ -583,24 +1297,100 @@ def main():
         logger.info(f"订阅 {stock} 行情...")
         # api.subscribe_stock(stock, strategy.data_type)
 
+    # 后台线程按交易记录和共享行情缓存定时估值，与交易循环共用网关客户端
+    valuation = None
+    if valuation_interval:
+        strategy.quote_cache = QuoteCache(api, strategy.data_type)
+        # 非交易时间只用最后的价格估值，不请求行情
+        valuation = ValuationService(strategy.quote_cache, strategy.ledger_dir, valuation_interval,
+                                     is_trading_time=strategy.is_trading_time).start()
+        logger.info(f"持仓估值间隔: {valuation_interval}秒")
+
     # 检查间隔（秒）
     check_interval = 60
     logger.info(f"检查间隔: {check_interval}秒\n")
 
+    # 启动耗时：到这里即可进入交易循环
+    startup_sec = time.perf_counter() - _PROCESS_START
+    STARTUP_SECONDS.set(startup_sec)
+    if startup_sec > STARTUP_BUDGET_SEC:
+        logger.warning("启动耗时 %.3fs，超出预算 %.1fs（可使用 --fast-start 复用会话）", startup_sec, STARTUP_BUDGET_SEC)
+    else:
+        logger.info("启动耗时 %.3fs", startup_sec)
+
     # 主循环
     try:
         while True:
-            # 对每个配置的股票执行策略
-            for stock in stocks:
-                strategy.execute_strategy(stock)
+            # 盘中等间隔采样流式指标
+            with span("sample_indicators"):
+                strategy.sample_indicators(stocks)
+
+            # 收盘窗口前预热，窗口打开后只剩最终价格判断和发送
+            if strategy.should_prearm():
+                with span("prearm"):
+                    strategy.prearm(stocks)
 
-            time.sleep(check_interval)
+            # 对每个配置的股票执行策略
+            with TICK_LATENCY.time(), span("tick"):
+                for stock in stocks:
+                    with span("execute_strategy"):
+                        strategy.execute_strategy(stock)
+
+            # 批量刷新未完成订单，记录新增成交
+            with span("poll_open_orders"):
+                order_manager.poll_open_orders()
+
+            # 收盘窗口外定期与网关对账风控状态
+            if strategy.should_reconcile_risk():
+                with span("reconcile_risk"):
+                    strategy.reconcile_risk()
+
+            # 已预热时在收盘窗口打开的时刻醒来，而不是等满一个检查间隔
+            sleep_sec = check_interval
+            if strategy.is_armed() and not strategy.is_near_close():
+                until_window = strategy.seconds_until_close_window()
+                if until_window > 0:
+                    sleep_sec = min(check_interval, until_window)
+            time.sleep(sleep_sec)
 
     except KeyboardInterrupt:
         logger.info("\n程序已停止")
     except Exception as e:
         logger.error(f"程序异常: {str(e)}", exc_info=True)
+    finally:
+        if valuation is not None:
+            valuation.stop()
+        order_manager.shutdown(wait=True)
+        if journal is not None:
+            journal.close()
+        if profiler is not None:
+            for path in profiling.disable():
+                logger.info(f"剖析结果: {path}")
+            logger.info("剖析摘要:\n%s", profiler.summary())
 
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description="华盛量化自动交易程序")
+    parser.add_argument("--metrics-port", type=int, default=None,
+                        help="暴露 Prometheus /metrics 的端口（默认不启动）")
+    parser.add_argument("--log-mode", choices=["queued", "sync"], default="queued",
+                        help="日志写出方式：queued 由后台线程写出，sync 同步写出")
+    parser.add_argument("--log-rotate", choices=["size", "time", "none"], default="size",
+                        help="trading.log 轮转方式，轮转后的文件 gzip 压缩")
+    parser.add_argument("--fast-start", action="store_true",
+                        help=f"复用 {SESSION_FILE} 中未过期的网关会话，跳过登录")
+    parser.add_argument("--journal-dir", default=JOURNAL_DIR,
+                        help="网关请求日志目录，用于复盘和回放")
+    parser.add_argument("--no-journal", action="store_true", help="不记录网关请求日志")
+    parser.add_argument("--profile", nargs="?", const="profiles", default=None, metavar="DIR",
+                        help="开启剖析并在退出时把结果写入 DIR（也可设置环境变量 QTRADE_PROFILE）")
+    parser.add_argument("--state-file", default=STATE_FILE, help="状态快照文件，重启时恢复")
+    parser.add_argument("--no-state", action="store_true", help="不保存状态快照")
+    parser.add_argument("--valuation-interval", type=float, default=VALUATION_INTERVAL_SEC,
+                        help="持仓估值间隔（秒），0 表示不估值")
+    add_risk_arguments(parser)
+    args = parser.parse_args()
+    main(metrics_port=args.metrics_port, log_mode=args.log_mode, log_rotate=args.log_rotate,
+         fast_start=args.fast_start, journal_dir=None if args.no_journal else args.journal_dir,
+         profile_dir=args.profile, state_file=None if args.no_state else args.state_file,
+         valuation_interval=args.valuation_interval, risk_limits=risk_limits_from_args(args))
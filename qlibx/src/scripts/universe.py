@@ -0,0 +1,109 @@
+"""
+动态股票池（指数成分股）
+把 qlib 市场（如 csi300、csi500）的成分股进出区间预先展开为 (交易日 × 股票) 的布尔掩码：
+- 只构建一次，按 市场 + 区间 + 数据目录 缓存到磁盘
+- 回测中用向量化的方式屏蔽非成分股，避免固定股票池带来的幸存者偏差
+"""
+
+import hashlib
+import os
+
+import numpy as np
+import pandas as pd
+
+CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".universe_cache")
+
+
+def _cache_path(market, start_time, end_time, provider_uri, cache_dir):
+    # 成分股文件更新后缓存自动失效
+    instruments_file = os.path.join(provider_uri or "", "instruments", f"{market}.txt")
+    mtime = os.path.getmtime(instruments_file) if os.path.exists(instruments_file) else 0
+    raw = f"{market}|{start_time}|{end_time}|{provider_uri}|{mtime}"
+    return os.path.join(cache_dir, f"{market}_{hashlib.sha1(raw.encode('utf-8')).hexdigest()[:12]}.npz")
+
+
+def build_membership_mask(market, start_time, end_time, provider_uri=None, cache_dir=CACHE_DIR):
+    """
+    构建成分股掩码（调用前需已 qlib.init）
+    Args:
+        market: qlib 市场名，如 "csi300"、"csi500"、"all"
+        start_time, end_time: 时间区间
+        provider_uri: qlib 数据目录，用于缓存键和失效判断
+        cache_dir: 缓存目录，None 表示不缓存
+    Returns:
+        (calendar, instruments, mask)
+        calendar: 交易日 DatetimeIndex
+        instruments: 区间内出现过的全部成分股（排序后）
+        mask: bool 数组 (n_dates, n_instruments)，True 表示当日是成分股
+    """
+    path = None
+    if cache_dir:
+        path = _cache_path(market, start_time, end_time, provider_uri, cache_dir)
+        if os.path.exists(path):
+            data = np.load(path, allow_pickle=False)
+            return pd.DatetimeIndex(data["calendar"]), data["instruments"].tolist(), data["mask"]
+
+    from qlib.data import D
+
+    calendar = pd.DatetimeIndex(D.calendar(start_time=start_time, end_time=end_time))
+    spans = D.list_instruments(D.instruments(market), start_time=start_time, end_time=end_time, as_list=False)
+    instruments = sorted(spans)
+
+    mask = np.zeros((len(calendar), len(instruments)), dtype=bool)
+    for j, instrument in enumerate(instruments):
+        for span_start, span_end in spans[instrument]:
+            lo = calendar.searchsorted(pd.Timestamp(span_start))
+            hi = calendar.searchsorted(pd.Timestamp(span_end), side='right')
+            mask[lo:hi, j] = True
+
+    if path:
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_path = path + ".tmp.npz"
+        np.savez(tmp_path, calendar=calendar.values.astype('datetime64[ns]'),
+                 instruments=np.asarray(instruments, dtype=str), mask=mask)
+        os.replace(tmp_path, path)
+    return calendar, instruments, mask
+
+
+def apply_membership(scores, calendar, instruments, mask):
+    """
+    屏蔽非成分股的因子值
+    Args:
+        scores: (instrument, datetime) MultiIndex、单列的因子 DataFrame
+        calendar, instruments, mask: build_membership_mask 的结果
+    Returns:
+        与 scores 同格式的 DataFrame，非成分股的行被去掉
+    """
+    wide = scores.iloc[:, 0].unstack(level='instrument')
+    wide = wide.reindex(index=calendar, columns=instruments)
+    wide = wide.where(mask)
+    long = wide.stack().dropna().swaplevel().sort_index().to_frame(scores.columns[0])
+    long.index.names = ['instrument', 'datetime']
+    return long
+
+
+def top_k_by_date(scores, k, dates=None, ascending=False):
+    """
+    向量化地按日选出因子值最高（或最低）的 k 只股票
+    Args:
+        scores: (instrument, datetime) MultiIndex、单列的因子 DataFrame
+        k: 每日选股数量
+        dates: 只计算这些交易日，默认全部
+        ascending: True 时选最小的 k 只
+    Returns:
+        {交易日: [股票代码, ...]}，按因子值排序
+    """
+    wide = scores.iloc[:, 0].unstack(level='instrument')
+    if dates is not None:
+        wide = wide.reindex(index=dates)
+    values = wide.to_numpy(dtype=np.float64)
+    # NaN（非成分股或缺失）排在最后
+    fill = np.inf if ascending else -np.inf
+    keyed = np.where(np.isnan(values), fill, values)
+    order = np.argsort(keyed if ascending else -keyed, axis=1, kind='stable')[:, :k]
+    valid_counts = np.minimum((~np.isnan(values)).sum(axis=1), k)
+    columns = wide.columns.to_numpy()
+    return {
+        date: columns[order[i, :valid_counts[i]]].tolist()
+        for i, date in enumerate(wide.index)
+    }
@@ -0,0 +1,331 @@
+"""
+实时持仓估值
+由交易记录推算持仓，用共享的行情缓存定价，持续记录当日的估值序列：
+- LedgerHoldings: 每只股票的持仓、成本和已实现盈亏；只读取交易记录新增的行，
+  文件变小（归档压缩后重写）时才从归档 + 热文件重建
+- QuoteCache: 多个使用方共享的最新价缓存；过期的股票合并为批量 hq/BasicQot 请求，两次请求之间至少间隔 min_interval 秒
+- ValuationService: 定时估值，写出
+    valuation/latest.json             最新估值快照（原子替换），后台接口直接返回
+    valuation/valuation_YYYYMMDD.csv  当日估值序列，每次估值追加一行
+没有行情时用该股票最近一次成交价估值；非交易时间不请求行情，用缓存中最后的价格或最近一次成交价估值；
+交易记录中没有现金，市值不含现金
+用法: 交易程序中通过 --valuation-interval 开启；或单独运行 python valuation.py --interval 30
+"""
+
+import argparse
+import csv
+import json
+import logging
+import os
+import threading
+import time
+from datetime import datetime
+
+from bot_metrics import REGISTRY
+from ledger_archive import LEDGER_COLUMNS, ledger_path, list_symbols, read_archived_rows
+
+logger = logging.getLogger(__name__)
+
+VALUATION_DIR = "valuation"
+LATEST_FILE = "latest.json"
+SERIES_COLUMNS = ['timestamp', 'market_value', 'cost', 'unrealized_pnl', 'realized_pnl']
+DEFAULT_INTERVAL_SEC = 30
+
+PORTFOLIO_VALUE = REGISTRY.gauge(
+    "qtrade_portfolio_market_value", "Market value of ledger holdings at the latest marks")
+QUOTE_REQUESTS = REGISTRY.counter(
+    "qtrade_valuation_quote_requests_total", "Batched quote refreshes issued by the valuation quote cache")
+
+
+def series_path(day, base_dir="."):
+    return os.path.join(base_dir, VALUATION_DIR, f"valuation_{day.strftime('%Y%m%d')}.csv")
+
+
+def latest_path(base_dir="."):
+    return os.path.join(base_dir, VALUATION_DIR, LATEST_FILE)
+
+
+class Holding:
+    __slots__ = ("quantity", "cost", "realized_pnl", "last_trade_price")
+
+    def __init__(self):
+        self.quantity = 0
+        self.cost = 0.0            # 当前持仓的总成本（平均成本法）
+        self.realized_pnl = 0.0
+        self.last_trade_price = None
+
+    def apply(self, action, quantity, price):
+        if action == "buy":
+            self.quantity += quantity
+            self.cost += quantity * price
+        elif action == "sell":
+            avg_cost = self.cost / self.quantity if self.quantity > 0 else price
+            closed = min(quantity, max(self.quantity, 0))
+            self.realized_pnl += closed * (price - avg_cost)
+            self.cost -= closed * avg_cost
+            self.quantity -= quantity
+            if self.quantity <= 0:
+                self.cost = 0.0
+        else:
+            return
+        self.last_trade_price = price
+
+
+class LedgerHoldings:
+    """由交易记录增量维护的持仓"""
+
+    def __init__(self, base_dir="."):
+        self.base_dir = base_dir
+        self.holdings = {}    # symbol -> Holding
+        self._offsets = {}    # symbol -> (热文件 inode, 已读取到的字节位置)
+
+    def _apply_row(self, symbol, row):
+        try:
+            quantity, price = int(float(row['quantity'])), float(row['price'])
+        except (KeyError, TypeError, ValueError):
+            return
+        self.holdings.setdefault(symbol, Holding()).apply(row.get('action'), quantity, price)
+
+    def _rebuild(self, symbol, path, inode):
+        """归档记录 + 热文件从头读取"""
+        self.holdings[symbol] = Holding()
+        for row in read_archived_rows(symbol, base_dir=self.base_dir):
+            self._apply_row(symbol, row)
+        self._offsets[symbol] = (inode, 0)
+        if inode is not None:
+            self._tail(symbol, path, inode, 0)
+
+    def _tail(self, symbol, path, inode, offset):
+        """读取 offset 之后完整的行；写到一半的最后一行留到下次"""
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            data = f.read()
+        end = data.rfind(b"\n") + 1
+        if end == 0:
+            return
+        for values in csv.reader(data[:end].decode('utf-8').splitlines()):
+            if not values or values[0] == LEDGER_COLUMNS[0]:
+                continue
+            self._apply_row(symbol, dict(zip(LEDGER_COLUMNS, values)))
+        self._offsets[symbol] = (inode, offset + end)
+
+    def refresh(self):
+        """
+        读取所有交易记录的新增部分
+        Returns:
+            本次有变化的股票
+        """
+        changed = []
+        for symbol in list_symbols(self.base_dir):
+            path = ledger_path(symbol, self.base_dir)
+            try:
+                st = os.stat(path)
+                inode, size = st.st_ino, st.st_size
+            except FileNotFoundError:
+                inode, size = None, 0
+            known = self._offsets.get(symbol)
+            try:
+                if known is None or known[0] != inode or size < known[1]:
+                    # 首次读取，或热文件被归档压缩改写（os.replace 后 inode 改变）
+                    self._rebuild(symbol, path, inode)
+                    changed.append(symbol)
+                elif size > known[1]:
+                    self._tail(symbol, path, inode, known[1])
+                    changed.append(symbol)
+            except Exception as e:
+                logger.error("读取交易记录失败 %s: %s", symbol, e)
+        return changed
+
+    def open_symbols(self):
+        return [symbol for symbol, holding in self.holdings.items() if holding.quantity != 0]
+
+
+class QuoteCache:
+    """
+    共享的最新价缓存，线程安全
+    Args:
+        api: 提供 get_realtime_quotes(codes, data_type, batch_size) 的网关客户端
+        max_age: 报价超过该秒数视为过期
+        min_interval: 两次批量请求之间的最小间隔（秒）
+    """
+
+    def __init__(self, api, data_type=2, max_age=15.0, min_interval=5.0, batch_size=50):
+        self.api = api
+        self.data_type = data_type
+        self.max_age = max_age
+        self.min_interval = min_interval
+        self.batch_size = batch_size
+        self._marks = {}            # symbol -> (价格, time.monotonic())
+        self._lock = threading.Lock()
+        self._fetch_lock = threading.Lock()
+        self._last_request = float("-inf")
+
+    def observe(self, symbol, quote):
+        """记录其他代码路径已取得的报价，避免重复请求"""
+        price = _quote_price(quote)
+        if price is not None:
+            with self._lock:
+                self._marks[symbol] = (price, time.monotonic())
+
+    def marks(self, symbols, refresh=True):
+        """
+        Args:
+            symbols: 股票列表
+            refresh: 为 False 时只返回缓存中的价格，不发请求（如非交易时间）
+        Returns:
+            {symbol: 价格}；过期的股票在未被限流时批量刷新，刷新失败或被限流时返回旧价格，从未取得报价的股票不在结果中
+        """
+        now = time.monotonic()
+        with self._lock:
+            stale = [s for s in symbols if s not in self._marks or now - self._marks[s][1] > self.max_age]
+        if not refresh:
+            stale = []
+        # 同一时刻只有一个使用方发请求，其他使用方直接用缓存
+        if stale and now - self._last_request >= self.min_interval and self._fetch_lock.acquire(blocking=False):
+            try:
+                self._last_request = now
+                QUOTE_REQUESTS.inc()
+                quotes = self.api.get_realtime_quotes(stale, self.data_type, self.batch_size)
+                for symbol, quote in quotes.items():
+                    self.observe(symbol, quote)
+            except Exception as e:
+                logger.error("刷新行情失败: %s", e)
+            finally:
+                self._fetch_lock.release()
+        with self._lock:
+            return {s: self._marks[s][0] for s in symbols if s in self._marks}
+
+
+def _quote_price(quote):
+    try:
+        price = float(quote.get("lastPrice") or 0)
+    except (AttributeError, TypeError, ValueError):
+        return None
+    return price if price > 0 else None
+
+
+class ValuationService:
+    """
+    定时估值
+    Args:
+        quotes: QuoteCache
+        base_dir: 交易记录所在目录，估值结果写到其下的 valuation/
+        interval: 估值间隔（秒）
+        is_trading_time: 无参函数，返回 False 时不刷新行情（夜间、周末）；为空表示始终刷新
+    """
+
+    def __init__(self, quotes, base_dir=".", interval=DEFAULT_INTERVAL_SEC, is_trading_time=None):
+        self.quotes = quotes
+        self.base_dir = base_dir
+        self.interval = interval
+        self.is_trading_time = is_trading_time
+        self.holdings = LedgerHoldings(base_dir)
+        self.latest = None
+        self._stop = threading.Event()
+        self._thread = None
+        os.makedirs(os.path.join(base_dir, VALUATION_DIR), exist_ok=True)
+
+    def value(self, now=None):
+        """估值一次，写出快照并追加到当日序列"""
+        now = now or datetime.now()
+        self.holdings.refresh()
+        held = self.holdings.open_symbols()
+        refresh = self.is_trading_time is None or self.is_trading_time()
+        marks = self.quotes.marks(held, refresh=refresh)
+
+        positions = {}
+        market_value = cost = unrealized = realized = 0.0
+        for symbol, holding in self.holdings.holdings.items():
+            realized += holding.realized_pnl
+            if holding.quantity == 0:
+                continue
+            mark = marks.get(symbol)
+            source = "quote"
+            if mark is None:
+                mark, source = holding.last_trade_price, "trade"
+            value = holding.quantity * mark
+            positions[symbol] = {
+                "quantity": holding.quantity,
+                "mark": mark,
+                "mark_source": source,
+                "market_value": value,
+                "cost": holding.cost,
+                "unrealized_pnl": value - holding.cost,
+                "realized_pnl": holding.realized_pnl,
+            }
+            market_value += value
+            cost += holding.cost
+            unrealized += value - holding.cost
+
+        self.latest = {
+            "timestamp": now.isoformat(),
+            "market_value": market_value,
+            "cost": cost,
+            "unrealized_pnl": unrealized,
+            "realized_pnl": realized,
+            "positions": positions,
+        }
+        PORTFOLIO_VALUE.set(market_value)
+        self._write(now)
+        return self.latest
+
+    def _write(self, now):
+        path = latest_path(self.base_dir)
+        tmp = path + ".tmp"
+        try:
+            with open(tmp, 'w', encoding='utf-8') as f:
+                json.dump(self.latest, f, ensure_ascii=False, separators=(",", ":"))
+            os.replace(tmp, path)
+
+            path = series_path(now, self.base_dir)
+            file_exists = os.path.isfile(path)
+            with open(path, 'a', newline='', encoding='utf-8') as f:
+                writer = csv.writer(f)
+                if not file_exists:
+                    writer.writerow(SERIES_COLUMNS)
+                writer.writerow([self.latest[name] for name in SERIES_COLUMNS])
+        except Exception as e:
+            logger.error("写入估值失败 %s: %s", path, e)
+
+    def _loop(self):
+        while not self._stop.is_set():
+            try:
+                self.value()
+            except Exception as e:
+                logger.error("估值失败: %s", e, exc_info=True)
+            self._stop.wait(self.interval)
+
+    def start(self):
+        """在后台线程中定时估值"""
+        self._thread = threading.Thread(target=self._loop, name="valuation", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="实时持仓估值")
+    parser.add_argument("--base-dir", default=".", help="交易记录所在目录")
+    parser.add_argument("--interval", type=float, default=DEFAULT_INTERVAL_SEC, help="估值间隔（秒）")
+    parser.add_argument("--once", action="store_true", help="只估值一次并打印")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    from tqqq_trading_bot import HuashengGatewayAPI, TradingStrategy
+
+    api = HuashengGatewayAPI()
+    service = ValuationService(QuoteCache(api), args.base_dir, args.interval,
+                               is_trading_time=TradingStrategy(api).is_trading_time)
+    if args.once:
+        print(json.dumps(service.value(), ensure_ascii=False, indent=2))
+    else:
+        service.start()
+        try:
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            service.stop()
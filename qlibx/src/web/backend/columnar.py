@@ -0,0 +1,147 @@
+"""
+列式响应格式（可选）
+默认仍返回逐行的字典列表；客户端可通过 Accept 头或 ?format= 参数选择：
+- format=columns / Accept: application/vnd.qtrade.columns+json
+    {"columns": [...], "length": n, "data": {列名: [值, ...]}}，数值列为数字而不是字符串
+- format=arrow / Accept: application/vnd.apache.arrow.stream
+    Arrow IPC 流（需要 pyarrow，未安装时返回 406）
+列式响应按 Accept-Encoding 压缩：优先 zstd（需要 zstandard），其次 gzip
+有 orjson 时用它编码 JSON
+"""
+
+import gzip
+import json
+
+from fastapi import HTTPException
+
+from http_cache import cached_response
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import pyarrow as pa
+except ImportError:
+    pa = None
+
+ROWS = "rows"
+COLUMNS = "columns"
+ARROW = "arrow"
+
+MEDIA_TYPES = {
+    ROWS: "application/json",
+    COLUMNS: "application/vnd.qtrade.columns+json",
+    ARROW: "application/vnd.apache.arrow.stream",
+}
+
+# 交易记录中的数值列，其余列保持字符串
+LEDGER_COLUMN_TYPES = {'quantity': int, 'price': float, 'volume': int}
+
+
+def negotiate_format(request):
+    """?format= 优先，其次 Accept 头，默认逐行 JSON"""
+    fmt = request.query_params.get("format")
+    if fmt in MEDIA_TYPES:
+        return fmt
+    accept = request.headers.get("accept", "")
+    for name in (ARROW, COLUMNS):
+        if MEDIA_TYPES[name] in accept:
+            return name
+    return ROWS
+
+
+def negotiate_encoding(request):
+    accepted = {item.split(";")[0].strip().lower()
+                for item in request.headers.get("accept-encoding", "").split(",")}
+    if "zstd" in accepted and zstandard is not None:
+        return "zstd"
+    if "gzip" in accepted:
+        return "gzip"
+    return "identity"
+
+
+def compress(body, encoding):
+    if encoding == "zstd":
+        return zstandard.ZstdCompressor(level=3).compress(body)
+    if encoding == "gzip":
+        return gzip.compress(body, compresslevel=5)
+    return body
+
+
+def _convert(value, kind):
+    if value in (None, ""):
+        return None
+    try:
+        return kind(float(value)) if kind is int else kind(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def rows_to_columns(rows, columns, column_types=LEDGER_COLUMN_TYPES):
+    """逐行字典 -> {列名: [值, ...]}，按 column_types 转换数值列"""
+    data = {}
+    for name in columns:
+        kind = column_types.get(name)
+        if kind is None:
+            data[name] = [row.get(name) for row in rows]
+        else:
+            data[name] = [_convert(row.get(name), kind) for row in rows]
+    return data
+
+
+def encode_columns_json(data, columns):
+    payload = {"columns": list(columns), "length": len(data[columns[0]]) if columns else 0, "data": data}
+    if orjson is not None:
+        return orjson.dumps(payload)
+    return json.dumps(payload, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def encode_arrow(data, columns, column_types=LEDGER_COLUMN_TYPES):
+    arrow_types = {int: pa.int64(), float: pa.float64()}
+    schema = pa.schema([(name, arrow_types.get(column_types.get(name), pa.string())) for name in columns])
+    table = pa.Table.from_pydict({name: data[name] for name in columns}, schema=schema)
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue().to_pybytes()
+
+
+def table_response(request, cache, key, version, build_rows, columns, column_types=LEDGER_COLUMN_TYPES):
+    """
+    按协商的格式返回表格数据，各格式/压缩方式分别缓存并有各自的 ETag
+    Args:
+        key: 缓存键（元组）
+        version: 数据版本
+        build_rows: 无参函数，返回逐行字典列表
+        columns: 列式格式中的列及顺序
+    """
+    # 同一个 URL 按 Accept / Accept-Encoding 返回不同内容，所有格式都要声明，共享缓存才不会混用
+    headers = {"Vary": "Accept, Accept-Encoding"}
+    fmt = negotiate_format(request)
+    if fmt == ROWS:
+        return cached_response(request, cache, key, version, build_rows, headers=headers)
+    if fmt == ARROW and pa is None:
+        raise HTTPException(status_code=406, detail="Arrow format is not available (pyarrow is not installed)",
+                            headers=headers)
+
+    encoding = negotiate_encoding(request)
+
+    def encode(rows):
+        data = rows_to_columns(rows, columns, column_types)
+        if fmt == ARROW:
+            body = encode_arrow(data, columns, column_types)
+        else:
+            body = encode_columns_json(data, columns)
+        return compress(body, encoding)
+
+    if encoding != "identity":
+        headers["Content-Encoding"] = encoding
+    return cached_response(request, cache, tuple(key) + (fmt, encoding), version, build_rows,
+                           encode=encode, media_type=MEDIA_TYPES[fmt], headers=headers)
@@ -0,0 +1,203 @@
+"""
+时间序列降采样
+长时间的净值曲线和成交价格按目标点数返回保形的降采样结果，看板不需要接收和绘制全部数据点：
+- lttb: Largest-Triangle-Three-Buckets，保留视觉上的形状
+- minmax: 每个分桶保留最小值和最大值，保留极值（回撤、尖峰）
+- 每个序列预先计算多分辨率层级（每层点数约为上一层的 1/LEVEL_FACTOR，按 minmax 构建）
+  查询时选择区间内点数不超过 目标点数 × OVERSAMPLE 的最细层级，再降采样到目标点数
+  单次查询的计算量只与目标点数有关，与序列总长度无关，多年数据缩放时同样快
+降采样只选取原始数据点，返回的时间标签和数值都是原始值
+"""
+
+import threading
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+from datetime import datetime
+
+LTTB = "lttb"
+MINMAX = "minmax"
+METHODS = (LTTB, MINMAX)
+
+# 相邻层级的点数比例
+LEVEL_FACTOR = 4
+# 点数不超过该值的层级不再继续合并
+MIN_LEVEL_POINTS = 512
+# 选择层级时允许区间内的点数为目标点数的多少倍
+OVERSAMPLE = 4
+DEFAULT_POINTS = 1000
+MAX_POINTS = 10000
+
+
+def _to_epoch(label):
+    return datetime.fromisoformat(label).timestamp()
+
+
+def lttb_indices(xs, ys, n_out):
+    """
+    Largest-Triangle-Three-Buckets
+    Args:
+        xs, ys: 数值序列，xs 升序
+        n_out: 目标点数
+    Returns:
+        选中点的下标（升序），始终包含首尾两点
+    """
+    n = len(xs)
+    if n_out >= n:
+        return list(range(n))
+    if n_out < 3:
+        return [0, n - 1]
+    every = (n - 2) / (n_out - 2)
+    out = [0]
+    a = 0
+    for i in range(n_out - 2):
+        # 下一个分桶的平均点
+        next_start = int((i + 1) * every) + 1
+        next_end = min(int((i + 2) * every) + 1, n)
+        span = next_end - next_start
+        avg_x = sum(xs[next_start:next_end]) / span
+        avg_y = sum(ys[next_start:next_end]) / span
+
+        # 当前分桶中与 a、平均点组成面积最大三角形的点
+        start = int(i * every) + 1
+        end = int((i + 1) * every) + 1
+        ax, ay = xs[a], ys[a]
+        best, best_area = start, -1.0
+        for j in range(start, end):
+            area = abs((ax - avg_x) * (ys[j] - ay) - (ax - xs[j]) * (avg_y - ay))
+            if area > best_area:
+                best, best_area = j, area
+        out.append(best)
+        a = best
+    out.append(n - 1)
+    return out
+
+
+def minmax_indices(ys, n_out):
+    """
+    每个分桶保留最小值和最大值
+    Args:
+        ys: 数值序列
+        n_out: 目标点数（约为分桶数 × 2）
+    Returns:
+        选中点的下标（升序），始终包含首尾两点
+    """
+    n = len(ys)
+    if n_out >= n:
+        return list(range(n))
+    buckets = max(1, n_out // 2)
+    size = n / buckets
+    out = [0]
+    for b in range(buckets):
+        start, end = int(b * size), min(int((b + 1) * size), n)
+        if start >= end:
+            continue
+        lo = hi = start
+        for j in range(start + 1, end):
+            if ys[j] < ys[lo]:
+                lo = j
+            elif ys[j] > ys[hi]:
+                hi = j
+        for j in sorted({lo, hi}):
+            if j > out[-1]:
+                out.append(j)
+    if out[-1] != n - 1:
+        out.append(n - 1)
+    return out
+
+
+class TiledSeries:
+    """一个时间序列及其多分辨率层级；创建后只读，可在多个请求间共享"""
+
+    def __init__(self, labels, values):
+        """
+        Args:
+            labels: ISO 格式的时间标签（"YYYY-MM-DD" 或 isoformat 时间戳），升序
+            values: 对应的数值
+        """
+        points = [(label, float(value)) for label, value in zip(labels, values) if value is not None]
+        self.labels = [label for label, _ in points]
+        self.values = [value for _, value in points]
+        self.xs = [_to_epoch(label) for label in self.labels]
+        # 每个层级为原始数据的下标列表，层级 0 为全部数据
+        self.levels = [list(range(len(self.labels)))]
+        while len(self.levels[-1]) > MIN_LEVEL_POINTS:
+            prev = self.levels[-1]
+            picked = minmax_indices([self.values[i] for i in prev], len(prev) // LEVEL_FACTOR)
+            self.levels.append([prev[i] for i in picked])
+        # 各层级的时间标签，用于按区间二分查找
+        self._level_labels = [[self.labels[i] for i in level] for level in self.levels]
+
+    def __len__(self):
+        return len(self.labels)
+
+    def _range(self, level, start, end):
+        labels = self._level_labels[level]
+        lo = bisect_left(labels, start[:10]) if start else 0
+        # "~" 大于日期后的 "T"、空格等字符，end 当天的所有时间戳都包含在内
+        hi = bisect_right(labels, end[:10] + "~") if end else len(labels)
+        return lo, hi
+
+    def query(self, points=DEFAULT_POINTS, start=None, end=None, method=LTTB):
+        """
+        Args:
+            points: 目标点数
+            start, end: 日期 "YYYY-MM-DD"（含），为空表示不限
+            method: lttb / minmax
+        Returns:
+            {"x": [时间标签], "y": [数值], "level": 使用的层级, "source_points": 该层级区间内的点数, "total": 原始点数}
+        """
+        points = max(3, min(int(points), MAX_POINTS))
+        level = 0
+        lo, hi = self._range(0, start, end)
+        # 选择区间内点数足够多的最粗层级
+        while level + 1 < len(self.levels) and hi - lo > points * OVERSAMPLE:
+            next_lo, next_hi = self._range(level + 1, start, end)
+            if next_hi - next_lo < points:
+                break
+            level, lo, hi = level + 1, next_lo, next_hi
+
+        indices = self.levels[level][lo:hi]
+        if len(indices) > points:
+            ys = [self.values[i] for i in indices]
+            if method == MINMAX:
+                picked = minmax_indices(ys, points)
+            else:
+                picked = lttb_indices([self.xs[i] for i in indices], ys, points)
+            indices = [indices[i] for i in picked]
+        return {
+            "x": [self.labels[i] for i in indices],
+            "y": [self.values[i] for i in indices],
+            "level": level,
+            "source_points": hi - lo,
+            "total": len(self.labels),
+        }
+
+
+class TileCache:
+    """按 (序列键, 数据版本) 缓存 TiledSeries，LRU，线程安全"""
+
+    def __init__(self, max_entries=64):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, version, build):
+        """
+        Args:
+            key: 序列键
+            version: 数据版本，变化时重新构建
+            build: 无参函数，返回 (labels, values)
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == version:
+                self._entries.move_to_end(key)
+                return entry[1]
+        # 构建放在锁外，慢序列不阻塞其他序列
+        series = TiledSeries(*build())
+        with self._lock:
+            self._entries[key] = (version, series)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return series
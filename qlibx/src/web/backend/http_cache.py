@@ -0,0 +1,104 @@
+"""
+条件请求与响应缓存
+- ETag 由数据版本（文件大小、mtime、交易记录版本）计算，不读取文件内容
+- 客户端带 If-None-Match 且版本未变时直接返回 304
+- 序列化后的响应体按 LRU 缓存，版本变化时自然失效
+定时刷新的看板在数据未变化时只需要几次 stat
+"""
+
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+
+from fastapi.responses import Response
+
+
+def make_etag(key, version):
+    """由缓存键和数据版本生成强 ETag"""
+    digest = hashlib.sha1(repr((key, version)).encode('utf-8')).hexdigest()[:20]
+    return f'"{digest}"'
+
+
+def etag_matches(if_none_match, etag):
+    """If-None-Match 比较（按 RFC 7232 使用弱比较）"""
+    if not if_none_match:
+        return False
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate == "*":
+            return True
+        if candidate.startswith("W/"):
+            candidate = candidate[2:]
+        if candidate == etag:
+            return True
+    return False
+
+
+def encode_json(content):
+    """与 FastAPI 的 JSONResponse 相同的编码方式"""
+    return json.dumps(content, ensure_ascii=False, allow_nan=False, indent=None,
+                      separators=(",", ":")).encode("utf-8")
+
+
+class ResponseCache:
+    """序列化后响应体的 LRU 缓存，线程安全（同步接口运行在线程池中）"""
+
+    def __init__(self, max_entries=128):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, etag):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] != etag:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, etag, body):
+        with self._lock:
+            self._entries[key] = (etag, body)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+def cached_response(request, cache, key, version, build, encode=encode_json, media_type="application/json",
+                    headers=None):
+    """
+    带 ETag 的缓存响应
+    Args:
+        request: 当前请求
+        cache: ResponseCache
+        key: 缓存键（路径 + 查询参数等）
+        version: 数据版本，任何可 repr 的值；版本不变时认为响应不变
+        build: 无参函数，缓存未命中时生成响应内容
+        encode: 把 build() 的结果编码为 bytes
+        media_type: 响应类型
+        headers: 额外的响应头（如 Content-Encoding、Vary）
+    """
+    etag = make_etag(key, version)
+    headers = dict(headers or {}, ETag=etag)
+    headers["Cache-Control"] = "no-cache"
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        headers.pop("Content-Encoding", None)
+        return Response(status_code=304, headers=headers)
+
+    body = cache.get(key, etag)
+    if body is None:
+        body = encode(build())
+        cache.put(key, etag, body)
+    return Response(content=body, media_type=media_type, headers=headers)
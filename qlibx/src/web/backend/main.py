@@ -1,9 +1,13 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import Response, StreamingResponse
 from pydantic import BaseModel
+import asyncio
+import csv
 import json
 import os
-import csv
+import sys
+import time
 from typing import Dict, List, Optional
 from datetime import datetime
 
@@ -18,8 +22,52 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-STRATEGY_FILE = "/Users/Zeyu/Documents/q_trade/qlibx/src/scripts/stock_strategy.json"
-SCRIPTS_DIR = "/Users/Zeyu/Documents/q_trade/qlibx/src/scripts"
+# 与本文件的相对位置：qlibx/src/web/backend -> qlibx/src/scripts
+SCRIPTS_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..", "scripts"))
+STRATEGY_FILE = os.path.join(SCRIPTS_DIR, "stock_strategy.json")
+
+# 与交易程序共用 scripts 目录下的工具模块
+if SCRIPTS_DIR not in sys.path:
+    sys.path.append(SCRIPTS_DIR)
+
+from bot_metrics import CONTENT_TYPE as METRICS_CONTENT_TYPE, REGISTRY
+from ledger_archive import LEDGER_COLUMNS, ledger_version, list_symbols, read_ledger_rows
+from http_cache import ResponseCache, cached_response
+from columnar import table_response
+from downsample import DEFAULT_POINTS, METHODS, LTTB, TileCache
+from backtest_service import BacktestService
+from valuation import SERIES_COLUMNS as VALUATION_COLUMNS, latest_path, series_path
+
+QLIB_PROVIDER_URI = "/Users/Zeyu/Documents/q_trade/qlibx/data/qlib_data/cn_data"
+
+HTTP_LATENCY = REGISTRY.histogram(
+    "qtrade_http_request_seconds", "Backend request latency by route", ("method", "route", "status"))
+
+@app.middleware("http")
+async def record_request_latency(request: Request, call_next):
+    start = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        # 使用路由模板而不是原始路径，避免每个 symbol 产生一条时间序列
+        route = request.scope.get("route")
+        route_path = route.path if route is not None else "unmatched"
+        HTTP_LATENCY.observe(time.perf_counter() - start,
+                             method=request.method, route=route_path, status=status)
+
+# 序列化后的响应，按数据版本失效
+RESPONSE_CACHE = ResponseCache(max_entries=256)
+# 时间序列的多分辨率层级，按数据版本失效
+SERIES_TILES = TileCache(max_entries=64)
+# 本进程写策略文件的次数；mtime 精度较粗的文件系统上同一时刻的两次写入也能区分
+_strategies_generation = 0
+
+@app.get("/metrics")
+def metrics():
+    return Response(content=REGISTRY.render(), media_type=METRICS_CONTENT_TYPE)
 
 class StockStrategy(BaseModel):
     name: str
@@ -32,6 +80,18 @@ class StockStrategy(BaseModel):
     buy_day_interval: int
     buy_price_interval: float
     max_position: float
+    max_volatility: float = 0.0
+    min_volume_ratio: float = 0.0
+
+def file_version(path):
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return st.st_size, st.st_mtime_ns
+
+def strategies_version():
+    return file_version(STRATEGY_FILE), _strategies_generation
 
 def load_strategies():
     if os.path.exists(STRATEGY_FILE):
@@ -40,12 +100,14 @@ def load_strategies():
     return {}
 
 def save_strategies(strategies):
+    global _strategies_generation
+    _strategies_generation += 1
     with open(STRATEGY_FILE, 'w', encoding='utf-8') as f:
         json.dump(strategies, f, indent=2, ensure_ascii=False)
 
 @app.get("/api/strategies")
-def get_strategies():
-    return load_strategies()
+def get_strategies(request: Request):
+    return cached_response(request, RESPONSE_CACHE, "strategies", strategies_version(), load_strategies)
 
 @app.post("/api/strategies/{symbol}")
 def update_strategy(symbol: str, strategy: StockStrategy):
@@ -64,42 +126,231 @@ def delete_strategy(symbol: str):
     raise HTTPException(status_code=404, detail="Stock strategy not found")
 
 @app.get("/api/history/{symbol}")
-def get_history(symbol: str):
-    history_file = os.path.join(SCRIPTS_DIR, f"{symbol.lower()}_trading.csv")
-    if not os.path.exists(history_file):
-        return []
-    
-    history = []
+def get_history(request: Request, symbol: str, start: Optional[str] = None, end: Optional[str] = None):
+    # 归档分区按月份裁剪，只读取 start ~ end 覆盖到的部分
+    version = ledger_version(symbol, start, end, base_dir=SCRIPTS_DIR)
     try:
-        with open(history_file, 'r', encoding='utf-8') as f:
-            reader = csv.DictReader(f)
-            for row in reader:
-                history.append(row)
+        return table_response(request, RESPONSE_CACHE, ("history", symbol.upper(), start, end), version,
+                              lambda: read_ledger_rows(symbol, start, end, base_dir=SCRIPTS_DIR),
+                              LEDGER_COLUMNS)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
-    
-    return history
 
-@app.get("/api/all_history")
-def get_all_history():
+def load_all_history(symbols, start=None, end=None):
     all_history = []
-    for filename in os.listdir(SCRIPTS_DIR):
-        if filename.endswith("_trading.csv"):
-            symbol = filename.replace("_trading.csv", "").upper()
-            filepath = os.path.join(SCRIPTS_DIR, filename)
-            try:
-                with open(filepath, 'r', encoding='utf-8') as f:
-                    reader = csv.DictReader(f)
-                    for row in reader:
-                        row['symbol'] = symbol
-                        all_history.append(row)
-            except Exception:
-                continue
+    for symbol in symbols:
+        try:
+            rows = read_ledger_rows(symbol, start, end, base_dir=SCRIPTS_DIR)
+        except Exception:
+            continue
+        for row in rows:
+            row['symbol'] = symbol
+            all_history.append(row)
     
     # Sort by timestamp descending
     all_history.sort(key=lambda x: x.get('timestamp', ''), reverse=True)
     return all_history
 
+@app.get("/api/all_history")
+def get_all_history(request: Request, start: Optional[str] = None, end: Optional[str] = None):
+    symbols = list_symbols(SCRIPTS_DIR)
+    version = tuple((symbol, ledger_version(symbol, start, end, base_dir=SCRIPTS_DIR)) for symbol in symbols)
+    return table_response(request, RESPONSE_CACHE, ("all_history", start, end), version,
+                          lambda: load_all_history(symbols, start, end), LEDGER_COLUMNS)
+
+def series_response(request, key, version, build, points, start, end, method):
+    """
+    降采样后的时间序列；层级按 (key, version) 缓存，响应按查询参数缓存
+    Args:
+        build: 无参函数，返回 (时间标签, 数值)
+    """
+    if method not in METHODS:
+        raise HTTPException(status_code=400, detail=f"method must be one of {', '.join(METHODS)}")
+    return cached_response(request, RESPONSE_CACHE, key + (points, start, end, method), version,
+                           lambda: SERIES_TILES.get(key, version, build).query(points, start, end, method))
+
+def sorted_ledger_rows(symbol):
+    rows = read_ledger_rows(symbol, base_dir=SCRIPTS_DIR)
+    rows.sort(key=lambda row: row.get('timestamp', ''))
+    return rows
+
+def load_trade_prices(symbol):
+    labels, values = [], []
+    for row in sorted_ledger_rows(symbol):
+        try:
+            price = float(row['price'])
+        except (KeyError, TypeError, ValueError):
+            continue
+        labels.append(row['timestamp'])
+        values.append(price)
+    return labels, values
+
+def load_ledger_portfolio(symbols):
+    """
+    由交易记录推算的持仓市值：每笔成交后，各股票持仓 × 该股票最近一次成交价之和
+    交易记录中没有现金，因此不是账户总权益
+    """
+    events = []
+    for symbol in symbols:
+        try:
+            rows = read_ledger_rows(symbol, base_dir=SCRIPTS_DIR)
+        except Exception:
+            continue
+        for row in rows:
+            try:
+                quantity, price = int(float(row['quantity'])), float(row['price'])
+            except (KeyError, TypeError, ValueError):
+                continue
+            sign = 1 if row.get('action') == 'buy' else -1
+            events.append((row.get('timestamp', ''), symbol, sign * quantity, price))
+    events.sort()
+
+    holdings, last_price = {}, {}
+    labels, values = [], []
+    value = 0.0
+    for timestamp, symbol, delta, price in events:
+        # 只更新这只股票的贡献，不重新累加全部持仓
+        value -= holdings.get(symbol, 0) * last_price.get(symbol, 0.0)
+        holdings[symbol] = holdings.get(symbol, 0) + delta
+        last_price[symbol] = price
+        value += holdings[symbol] * price
+        labels.append(timestamp)
+        values.append(value)
+    return labels, values
+
+@app.get("/api/series/backtests/{job_id}")
+def get_backtest_series(request: Request, job_id: str, points: int = DEFAULT_POINTS,
+                        start: Optional[str] = None, end: Optional[str] = None, method: str = LTTB):
+    job = get_backtest_service().get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Backtest job not found")
+    if job.status != "done" or not job.result:
+        raise HTTPException(status_code=409, detail=f"Backtest job is {job.status}")
+    result = job.result
+    # 已完成任务的结果不再变化
+    return series_response(request, ("series", "backtest", job_id), job.key,
+                           lambda: (result["dates"], result["portfolio_value"]), points, start, end, method)
+
+@app.get("/api/series/portfolio")
+def get_portfolio_series(request: Request, points: int = DEFAULT_POINTS,
+                         start: Optional[str] = None, end: Optional[str] = None, method: str = LTTB):
+    symbols = list_symbols(SCRIPTS_DIR)
+    version = tuple((symbol, ledger_version(symbol, base_dir=SCRIPTS_DIR)) for symbol in symbols)
+    return series_response(request, ("series", "portfolio"), version,
+                           lambda: load_ledger_portfolio(symbols), points, start, end, method)
+
+@app.get("/api/series/trades/{symbol}")
+def get_trade_series(request: Request, symbol: str, points: int = DEFAULT_POINTS,
+                     start: Optional[str] = None, end: Optional[str] = None, method: str = LTTB):
+    version = ledger_version(symbol, base_dir=SCRIPTS_DIR)
+    return series_response(request, ("series", "trades", symbol.upper()), version,
+                           lambda: load_trade_prices(symbol), points, start, end, method)
+
+def load_valuation():
+    with open(latest_path(SCRIPTS_DIR), 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+@app.get("/api/valuation")
+def get_valuation(request: Request):
+    # 估值服务每次估值原子替换快照文件，这里只 stat 一次，未变化时返回缓存的响应体
+    version = file_version(latest_path(SCRIPTS_DIR))
+    if version is None:
+        raise HTTPException(status_code=404, detail="Valuation not available")
+    return cached_response(request, RESPONSE_CACHE, "valuation", version, load_valuation)
+
+def load_valuation_series(path, field):
+    labels, values = [], []
+    with open(path, 'r', encoding='utf-8') as f:
+        for row in csv.DictReader(f):
+            try:
+                values.append(float(row[field]))
+            except (KeyError, TypeError, ValueError):
+                continue
+            labels.append(row['timestamp'])
+    return labels, values
+
+@app.get("/api/series/valuation")
+def get_valuation_series(request: Request, day: Optional[str] = None, field: str = "market_value",
+                         points: int = DEFAULT_POINTS, method: str = LTTB):
+    if field not in VALUATION_COLUMNS[1:]:
+        raise HTTPException(status_code=400, detail=f"field must be one of {', '.join(VALUATION_COLUMNS[1:])}")
+    try:
+        date = datetime.strptime(day, "%Y-%m-%d") if day else datetime.now()
+    except ValueError:
+        raise HTTPException(status_code=400, detail="day must be YYYY-MM-DD")
+    path = series_path(date, SCRIPTS_DIR)
+    version = file_version(path)
+    if version is None:
+        raise HTTPException(status_code=404, detail="Valuation series not found")
+    return series_response(request, ("series", "valuation", path, field), version,
+                           lambda: load_valuation_series(path, field), points, None, None, method)
+
+class BacktestRequest(BaseModel):
+    instruments: Optional[List[str]] = None
+    start_time: Optional[str] = None
+    end_time: Optional[str] = None
+    init_cash: Optional[float] = None
+    top_k: Optional[int] = None
+    rebalance_freq: Optional[int] = None
+    chunk_days: Optional[int] = None
+
+_backtest_service = None
+
+def get_backtest_service():
+    # 首次使用时才启动进程池
+    global _backtest_service
+    if _backtest_service is None:
+        _backtest_service = BacktestService(QLIB_PROVIDER_URI, max_workers=2)
+    return _backtest_service
+
+@app.on_event("shutdown")
+def shutdown_backtest_service():
+    if _backtest_service is not None:
+        _backtest_service.shutdown()
+
+@app.post("/api/backtests")
+def submit_backtest(request: BacktestRequest):
+    try:
+        job = get_backtest_service().submit(request.dict())
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except RuntimeError as e:
+        raise HTTPException(status_code=429, detail=str(e))
+    # 命中缓存时直接带上结果
+    return job.to_dict(include_result=job.status == "done")
+
+@app.get("/api/backtests")
+def list_backtests():
+    return get_backtest_service().list_jobs()
+
+@app.get("/api/backtests/{job_id}")
+def get_backtest(job_id: str):
+    job = get_backtest_service().get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Backtest job not found")
+    return job.to_dict(include_result=True)
+
+@app.get("/api/backtests/{job_id}/events")
+async def stream_backtest(job_id: str):
+    job = get_backtest_service().get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Backtest job not found")
+
+    async def events():
+        # Server-Sent Events：进度变化时推送一次，结束时推送完整结果
+        revision = -1
+        while True:
+            if job.revision != revision:
+                revision = job.revision
+                finished = job.status in ("done", "failed")
+                payload = json.dumps(job.to_dict(include_result=finished), ensure_ascii=False)
+                yield f"event: {job.status}\ndata: {payload}\n\n"
+                if finished:
+                    return
+            await asyncio.sleep(0.5)
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8000)